@@ -0,0 +1,137 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+from threading import Condition
+
+__all__ = ["Admission","NoSpace"]
+
+class NoSpace(Exception):
+	pass
+
+class Admission(object):
+	"""
+	Limits the downloads a cache daemon takes on. While max_requests
+	downloads are queued or running, or max_bytes are being downloaded,
+	busy() returns how long clients should wait before trying again.
+	Before a download starts its size is reserved against the free 
+	space of the file system it is written to (path by default), 
+	keeping min_free bytes free, and it waits while max_bytes are 
+	already being downloaded. A limit of 0 means no limit.
+	"""
+	def __init__(self, path, max_requests=0, max_bytes=0, min_free=0, 
+				 retry_after=1.0):
+		self.path = path
+		self.max_requests = max_requests
+		self.max_bytes = max_bytes
+		self.min_free = min_free
+		self.retry_after = retry_after
+		self.cond = Condition()
+		self.requests = 0
+		self.bytes = 0
+		# Bytes reserved on each file system, by path
+		self.reserved = {}
+	
+	def load(self):
+		"""The larger of the fractions of the request and byte limits in use"""
+		load = 0.0
+		if self.max_requests > 0:
+			load = max(load, float(self.requests) / self.max_requests)
+		if self.max_bytes > 0:
+			load = max(load, float(self.bytes) / self.max_bytes)
+		return load
+	
+	def busy(self):
+		"""
+		Return the number of seconds clients should wait before asking
+		for more downloads, or None if there is capacity for them. The
+		wait grows with how far over the limits the daemon is, up to
+		ten times retry_after.
+		"""
+		self.cond.acquire()
+		try:
+			load = self.load()
+		finally:
+			self.cond.release()
+		if load < 1.0:
+			return None
+		return self.retry_after * min(load, 10.0)
+	
+	def queued(self, n=1):
+		self.cond.acquire()
+		try:
+			self.requests += n
+		finally:
+			self.cond.release()
+	
+	def finished(self, n=1):
+		self.cond.acquire()
+		try:
+			self.requests -= n
+		finally:
+			self.cond.release()
+	
+	def free(self, path=None):
+		"""Bytes available on the file system holding path"""
+		st = os.statvfs(path or self.path)
+		return st.f_bavail * st.f_frsize
+	
+	def reserve(self, size, path=None):
+		"""
+		Reserve size bytes for a download to the file system holding 
+		path, waiting while max_bytes are already reserved. Raises 
+		NoSpace if the file would not fit on disk next to the downloads
+		already running there.
+		"""
+		path = path or self.path
+		self.cond.acquire()
+		try:
+			while (self.max_bytes > 0 and self.bytes > 0 and 
+				   self.bytes + size > self.max_bytes):
+				self.cond.wait()
+			# Running downloads have written part of what they reserved,
+			# so this errs on the side of refusing
+			reserved = self.reserved.get(path, 0)
+			if self.free(path) - reserved - size < self.min_free:
+				raise NoSpace("Not enough space for %d bytes in %s" % 
+							  (size, path))
+			self.bytes += size
+			self.reserved[path] = reserved + size
+		finally:
+			self.cond.release()
+	
+	def release(self, size, path=None):
+		path = path or self.path
+		self.cond.acquire()
+		try:
+			self.bytes -= size
+			self.reserved[path] -= size
+			self.cond.notifyAll()
+		finally:
+			self.cond.release()
+
+if __name__ == '__main__':
+	a = Admission("/", max_requests=2, max_bytes=100, retry_after=2)
+	print a.busy()
+	a.queued(3)
+	print a.busy()
+	a.reserve(60)
+	print a.load()
+	a.release(60)
+	try:
+		a.reserve(a.free() + 1)
+	except NoSpace, e:
+		print e
+	a.finished(3)
+	print a.busy(), a.bytes
@@ -15,8 +15,9 @@
 import sys
 import os
 import time
+import fnmatch
 import cPickle as pickle
-from threading import Thread
+from threading import Thread, Lock
 from mule import log, config, bits
 
 try:
@@ -42,7 +43,7 @@ def with_transaction(method, retries=5):
 				txn.abort()
 				deadlocks += 1
 				if deadlocks < retries:
-					self.log.info("Deadlock detected, retrying %d of %d" % (deadlocks,retries))
+					self.log.info("Deadlock detected, retrying %d of %d", deadlocks, retries)
 					continue
 				else:
 					self.log.error("Deadlock detected, aborting")
@@ -52,20 +53,109 @@ def with_transaction(method, retries=5):
 				raise
 	return with_transaction
 
+# Maximum number of keys examined per page, as a multiple of the page 
+# size, so that a selective pattern cannot turn one page into a full scan
+SCAN_FACTOR = 10
+
+def glob_prefix(pattern):
+	"""
+	Return the literal prefix of a glob pattern
+	"""
+	if pattern is None:
+		return ""
+	for i, c in enumerate(pattern):
+		if c in "*?[":
+			return pattern[:i]
+	return pattern
+
+def page(cur, token, limit, pattern, record):
+	"""
+	Read one page of up to limit keys from cursor cur, starting after 
+	key token (or at the beginning if token is None), that match the
+	glob pattern. record(cur, current) converts a matching entry to 
+	an item, and may move the cursor over the duplicates of the 
+	current key. Returns (items, token) where token is None when the 
+	last page has been read.
+	"""
+	prefix = glob_prefix(pattern)
+	if token is not None and token >= prefix:
+		current = cur.set_range(token)
+		if current is not None and current[0] == token:
+			current = cur.next_nodup()
+	elif prefix:
+		current = cur.set_range(prefix)
+	else:
+		current = cur.first()
+	
+	items = []
+	scanned = 0
+	last = token
+	while current is not None:
+		key = current[0]
+		if not key.startswith(prefix):
+			return items, None
+		if len(items) >= limit or scanned >= limit * SCAN_FACTOR:
+			return items, last
+		if pattern is None or fnmatch.fnmatchcase(key, pattern):
+			items.append(record(cur, current))
+		last = key
+		scanned += 1
+		current = cur.next_nodup()
+	return items, None
+
+def serialized(method):
+	"""
+	Run method while holding self.write_lock. If it fails then
+	self.reset() is called to discard any in-memory state it changed.
+	"""
+	def serialized(self, *args, **kwargs):
+		self.write_lock.acquire()
+		try:
+			try:
+				return method(self, *args, **kwargs)
+			except:
+				self.reset()
+				raise
+		finally:
+			self.write_lock.release()
+	return serialized
+
+def seq_key(seq):
+	return "%020d" % seq
+
+# Commit flags for each durability mode
+DURABILITY = {
+	'nosync': bdb.DB_TXN_NOSYNC,
+	'write_nosync': bdb.DB_TXN_WRITE_NOSYNC,
+	'sync': 0
+}
+
+# Defaults for the [bdb] tuning options in mule.conf
+CACHE_SIZE = 64*1024*1024
+PAGE_SIZE = 8*1024
+LOG_BUFFER = 1024*1024
+
 class DatabaseManagerThread(Thread):
-	def __init__(self, env, interval=300):
+	"""
+	Checks every interval seconds whether kbytes of log have been 
+	written or minutes have passed since the last checkpoint, and 
+	takes one if so. This bounds the amount of log that recovery has
+	to replay at startup, even during write bursts.
+	"""
+	def __init__(self, env, interval=30, kbytes=10240, minutes=5):
 		Thread.__init__(self)
 		self.setDaemon(True)
 		self.log = log.get_log("bdb manager")
 		self.env = env
 		self.interval = interval
+		self.kbytes = kbytes
+		self.minutes = minutes
 	
 	def run(self):
 		while True:
 			try:
 				time.sleep(self.interval)
-				self.log.debug("checkpointing database")
-				self.env.txn_checkpoint(0,0)
+				self.env.txn_checkpoint(self.kbytes, self.minutes)
 				if not hasattr(self.env, "log_set_config"):
 					self.log.debug("archiving logs")
 					self.env.log_archive(bdb.DB_ARCH_REMOVE)
@@ -76,77 +166,490 @@ class DatabaseManagerThread(Thread):
 class Database(object):
 	max_txns = 1000
 	
-	def __init__(self, path, name, duplicates=False):
+	def __init__(self, path, name, duplicates=False, multiversion=False):
 		self.path = path
+		self.multiversion = multiversion
 		self.dbpath = os.path.join(self.path, name)
 		
 		if not os.path.isdir(self.path):
 			os.makedirs(self.path)
 		
+		max_txns = config.getint("bdb", "max_txns", self.max_txns)
+		durability = config.get("bdb", "durability", "nosync")
+		if durability not in DURABILITY:
+			raise Exception("Invalid durability in config: %s" % durability)
+		self.page_size = config.getsize("bdb", "page_size", PAGE_SIZE)
+		
 		self.env = bdb.DBEnv()
-		self.env.set_tx_max(self.max_txns)
-		self.env.set_lk_max_lockers(self.max_txns*2)
-		self.env.set_lk_max_locks(self.max_txns*2)
-		self.env.set_lk_max_objects(self.max_txns*2)
+		self.env.set_tx_max(max_txns)
+		self.env.set_lk_max_lockers(config.getint("bdb", "max_lockers", max_txns*2))
+		self.env.set_lk_max_locks(config.getint("bdb", "max_locks", max_txns*2))
+		self.env.set_lk_max_objects(config.getint("bdb", "max_objects", max_txns*2))
 		self.env.set_lk_detect(bdb.DB_LOCK_DEFAULT)
-		self.env.set_flags(bdb.DB_TXN_NOSYNC, True)
+		cache_size = config.getsize("bdb", "cache_size", CACHE_SIZE)
+		gbytes = cache_size / 1024**3
+		self.env.set_cachesize(gbytes, cache_size - gbytes * 1024**3)
+		self.env.set_lg_bsize(config.getsize("bdb", "log_buffer", LOG_BUFFER))
+		if DURABILITY[durability]:
+			self.env.set_flags(DURABILITY[durability], True)
+		if multiversion:
+			# Allows snapshot transactions that do not block writers
+			self.env.set_flags(bdb.DB_MULTIVERSION, True)
 		if hasattr(self.env, "log_set_config"):
 			self.env.log_set_config(bdb.DB_LOG_AUTO_REMOVE, True)
 		self.env.open(self.path, bdb.DB_CREATE | bdb.DB_INIT_LOCK | 
 				bdb.DB_INIT_LOG | bdb.DB_INIT_MPOOL | bdb.DB_INIT_TXN | 
 				bdb.DB_RECOVER | bdb.DB_THREAD)
 		
-		self.db = bdb.DB(self.env)
+		self.dbs = []
+		self.db = self.open_db(name, duplicates)
+			
+		self.thread = DatabaseManagerThread(self.env,
+			config.getint("checkpoint", "interval", 30),
+			config.getint("checkpoint", "kbytes", 10240),
+			config.getint("checkpoint", "minutes", 5))
+		self.thread.start()
+		
+		self.stats_time = 0
+		self.stats_cache = {}
+	
+	def open_db(self, name, duplicates=False):
+		"""
+		Open (or create) another database in this environment
+		"""
+		dbpath = os.path.join(self.path, name)
+		db = bdb.DB(self.env)
 		if duplicates:
-			self.db.set_flags(bdb.DB_DUPSORT)
+			db.set_flags(bdb.DB_DUPSORT)
+		db.set_pagesize(self.page_size)
+		flags = bdb.DB_CREATE|bdb.DB_THREAD
+		if self.multiversion:
+			flags |= bdb.DB_MULTIVERSION
 		if bdb.version() > (4,1):
 			txn = self.env.txn_begin()
-			self.db.open(self.dbpath, name, flags=bdb.DB_CREATE|bdb.DB_THREAD,
-				dbtype=bdb.DB_BTREE, txn=txn)
+			db.open(dbpath, name, flags=flags, dbtype=bdb.DB_BTREE, txn=txn)
 			txn.commit()
 		else:
-			self.db.open(self.dbpath, name, flags=bdb.DB_CREATE|bdb.DB_THREAD,
-				dbtype=bdb.DB_BTREE)
-			
-		self.thread = DatabaseManagerThread(self.env)
-		self.thread.start()
+			db.open(dbpath, name, flags=flags, dbtype=bdb.DB_BTREE)
+		self.dbs.append(db)
+		return db
+	
+	def stats(self):
+		"""
+		Return a dict of environment statistics. They are cached for
+		a second so that rendering several metrics reads them once.
+		"""
+		now = time.time()
+		if now - self.stats_time > 1:
+			mp = self.env.memp_stat()[0]
+			lk = self.env.lock_stat()
+			tx = self.env.txn_stat()
+			hits = mp.get('cache_hit', 0)
+			misses = mp.get('cache_miss', 0)
+			self.stats_cache = {
+				'cache_hit_ratio': float(hits) / max(1, hits + misses),
+				'pages_in': mp.get('page_in', 0),
+				'pages_out': mp.get('page_out', 0),
+				'lock_waits': lk.get('lock_wait', lk.get('nconflicts', 0)),
+				'deadlocks': lk.get('ndeadlocks', 0),
+				'locks': lk.get('nlocks', 0),
+				'txn_active': tx.get('nactive', 0),
+				'txn_commits': tx.get('ncommits', 0),
+				'txn_aborts': tx.get('naborts', 0)
+			}
+			self.stats_time = now
+		return self.stats_cache
+	
+	def register_metrics(self, registry):
+		"""
+		Add the environment statistics to a metrics registry: totals
+		since the environment was opened as counters, the rest as gauges
+		"""
+		for name, help in [
+			('cache_hit_ratio', "Fraction of page requests found in the BDB cache"),
+			('locks', "Locks currently held"),
+			('txn_active', "Active transactions")]:
+			registry.gauge("mule_bdb_" + name, help,
+				lambda name=name: self.stats()[name])
+		for name, help in [
+			('pages_in', "Pages read into the BDB cache"),
+			('pages_out', "Pages written from the BDB cache"),
+			('lock_waits', "Lock requests that had to wait"),
+			('deadlocks', "Deadlocks detected"),
+			('txn_commits', "Committed transactions"),
+			('txn_aborts', "Aborted transactions")]:
+			registry.counter_function("mule_bdb_%s_total" % name, help,
+				lambda name=name: self.stats()[name])
 	
 	def close(self):
 		self.env.log_flush()
-		self.db.close()
+		for db in self.dbs:
+			db.close()
 		self.env.close()
 		
 class RLSDatabase(Database):
-	def __init__(self):
+	"""
+	Every change is given a sequence number and, unless this is a 
+	replica, appended to a change log in the same transaction. Writes
+	are serialized so that changes commit in sequence order, which 
+	lets replicas follow the log with a simple cursor.
+	"""
+	def __init__(self, path=None, replica=False):
 		self.log = log.get_log("rls_database")
-		home = config.get_home()
-		path = os.path.join(home, "var", "rls")
-		Database.__init__(self, path, "rls", duplicates=True)
+		if path is None:
+			path = os.path.join(config.get_home(), "var", "rls")
+		Database.__init__(self, path, "rls", duplicates=True,
+						  multiversion=True)
+		# Attributes of each mapping, keyed by lfn\0pfn
+		self.attrs = self.open_db("attrs")
+		# Mappings registered by each host, host -> lfn\0pfn
+		self.hosts = self.open_db("hosts", duplicates=True)
+		# Lease expiry time of each host
+		self.leases = self.open_db("leases")
+		# Change log, keyed by sequence number
+		self.changes = self.open_db("changes")
+		# Last sequence number written or applied
+		self.meta = self.open_db("meta")
+		self.replica = replica
+		self.write_lock = Lock()
+		self.reset()
+	
+	@with_transaction
+	def _get_seq(self, txn):
+		seq = self.meta.get("seq", None, txn)
+		if seq is None:
+			return 0
+		return int(seq)
+	
+	def reset(self):
+		"""
+		Reload the sequence number after a failed write
+		"""
+		self.seq = self._get_seq()
+	
+	def _log(self, txn, *change):
+		if self.replica:
+			return
+		self.seq += 1
+		self.changes.put(seq_key(self.seq), pickle.dumps(change), txn)
+		self.meta.put("seq", str(self.seq), txn)
+	
+	def _attrs_key(self, lfn, pfn):
+		return "%s\0%s" % (lfn, pfn)
+	
+	def _get_attrs(self, txn, lfn, pfn):
+		attrs = self.attrs.get(self._attrs_key(lfn, pfn), None, txn)
+		if attrs is None:
+			return {}
+		return pickle.loads(attrs)
+	
+	def _owner(self, attrs):
+		# The hosts index is keyed by the cache that registered the
+		# mapping (host:port), or by host for older registrations
+		return attrs.get('owner', attrs.get('host'))
+	
+	def _unindex(self, txn, host, key):
+		cur = self.hosts.cursor(txn)
+		try:
+			if cur.set_both(host, key) is not None:
+				cur.delete()
+		finally:
+			cur.close()
+	
+	def _delete_attrs(self, txn, lfn, pfn):
+		key = self._attrs_key(lfn, pfn)
+		attrs = self.attrs.get(key, None, txn)
+		if attrs is None:
+			# Mappings added before attributes were recorded
+			return
+		host = self._owner(pickle.loads(attrs))
+		if host is not None:
+			self._unindex(txn, host, key)
+		self.attrs.delete(key, txn)
+	
+	def _add(self, txn, lfn, pfn, attrs):
+		if self.db.get_both(lfn, pfn, txn) is None:
+			self.db.put(lfn, pfn, txn)
+		key = self._attrs_key(lfn, pfn)
+		# Re-adding a mapping keeps the attributes it already has
+		rec = self._get_attrs(txn, lfn, pfn)
+		old = self._owner(rec)
+		rec['registered'] = time.time()
+		if attrs:
+			rec.update(attrs)
+		host = self._owner(rec)
+		if old is not None and old != host:
+			self._unindex(txn, old, key)
+		if host is not None and self.hosts.get_both(host, key, txn) is None:
+			self.hosts.put(host, key, txn)
+		self.attrs.put(key, pickle.dumps(rec), txn)
+		self._log(txn, 'add', lfn, pfn, rec)
 		
+	@serialized
+	@with_transaction
+	def add(self, txn, lfn, pfn, attrs=None):
+		self._add(txn, lfn, pfn, attrs)
+	
+	@serialized
 	@with_transaction
-	def add(self, txn, lfn, pfn):
+	def add_many(self, txn, mappings):
+		"""
+		Add a list of (lfn, pfn, attrs) mappings in one transaction
+		"""
+		for lfn, pfn, attrs in mappings:
+			self._add(txn, lfn, pfn, attrs)
+	
+	def _load(self, txn, lfn, pfn, attrs):
 		if self.db.get_both(lfn, pfn, txn) is None:
 			self.db.put(lfn, pfn, txn)
+		if not attrs:
+			return
+		key = self._attrs_key(lfn, pfn)
+		old = self._owner(self._get_attrs(txn, lfn, pfn))
+		host = self._owner(attrs)
+		if old is not None and old != host:
+			self._unindex(txn, old, key)
+		if host is not None and self.hosts.get_both(host, key, txn) is None:
+			self.hosts.put(host, key, txn)
+		self.attrs.put(key, pickle.dumps(attrs), txn)
 	
+	@serialized
 	@with_transaction
-	def delete(self, txn, lfn, pfn=None):
+	def load_many(self, txn, mappings):
+		"""
+		Add a list of (lfn, pfn, attrs) mappings in one transaction for
+		a bulk load. Only the mappings and their attributes are written;
+		the change log gets a single 'load' entry, which tells replicas
+		to copy everything instead of following the log.
+		"""
+		for lfn, pfn, attrs in mappings:
+			self._load(txn, lfn, pfn, attrs)
+		self._log(txn, 'load')
+	
+	def _delete(self, txn, lfn, pfn):
 		cur = self.db.cursor(txn)
 		try:
 			if pfn is None:
 				current = cur.set(lfn)
 				while current is not None:
+					self._delete_attrs(txn, lfn, current[1])
 					cur.delete()
 					current = cur.next_dup()
 			else:
 				current = cur.set_both(lfn, pfn)
 				if current is not None:
+					self._delete_attrs(txn, lfn, pfn)
 					cur.delete()
 		finally:
 			cur.close()
+		self._log(txn, 'delete', lfn, pfn)
 	
+	@serialized
 	@with_transaction
-	def clear(self, txn):
+	def delete(self, txn, lfn, pfn=None):
+		self._delete(txn, lfn, pfn)
+	
+	@serialized
+	@with_transaction
+	def delete_many(self, txn, mappings):
+		"""
+		Delete a list of (lfn, pfn) mappings in one transaction. pfn 
+		can be None to delete all the mappings of lfn.
+		"""
+		for lfn, pfn in mappings:
+			self._delete(txn, lfn, pfn)
+	
+	@serialized
+	@with_transaction
+	def _delete_host_batch(self, txn, host, limit, keep, start):
+		hcur = self.hosts.cursor(txn)
+		cur = self.db.cursor(txn)
+		try:
+			deleted = 0
+			visited = 0
+			if start is None:
+				current = hcur.set(host)
+			else:
+				current = hcur.get(host, start, bdb.DB_GET_BOTH_RANGE)
+			while current is not None:
+				if visited == limit:
+					# Resume from this mapping in the next transaction
+					return deleted, current[1]
+				visited += 1
+				if keep is not None and current[1] in keep:
+					current = hcur.next_dup()
+					continue
+				lfn, pfn = current[1].split("\0", 1)
+				if cur.set_both(lfn, pfn) is not None:
+					cur.delete()
+				try:
+					self.attrs.delete(current[1], txn)
+				except bdb.DBNotFoundError:
+					pass
+				hcur.delete()
+				self._log(txn, 'delete', lfn, pfn)
+				deleted += 1
+				current = hcur.next_dup()
+			return deleted, None
+		finally:
+			cur.close()
+			hcur.close()
+	
+	def delete_host(self, host, batch=1000, keep=None):
+		"""
+		Delete all the mappings registered by host, apart from those
+		whose lfn\0pfn key is in the set keep. This uses several
+		transactions of at most batch mappings each so that large hosts
+		do not exhaust the lock table. Returns the number deleted.
+		"""
+		total = 0
+		start = None
+		while True:
+			deleted, start = self._delete_host_batch(host, batch, keep, start)
+			total += deleted
+			if start is None:
+				return total
+	
+	def _set_lease(self, txn, host, expires):
+		self.leases.put(host, repr(expires), txn)
+		self._log(txn, 'lease', host, expires)
+	
+	@serialized
+	@with_transaction
+	def set_lease(self, txn, host, expires):
+		self._set_lease(txn, host, expires)
+	
+	def _delete_lease(self, txn, host):
+		try:
+			self.leases.delete(host, txn)
+		except bdb.DBNotFoundError:
+			pass
+		self._log(txn, 'unlease', host)
+	
+	@serialized
+	@with_transaction
+	def delete_lease(self, txn, host):
+		self._delete_lease(txn, host)
+	
+	@with_transaction
+	def get_leases(self, txn):
+		"""
+		Return a dict of host -> lease expiry time
+		"""
+		cur = self.leases.cursor(txn)
+		try:
+			result = {}
+			current = cur.first()
+			while current is not None:
+				result[current[0]] = float(current[1])
+				current = cur.next()
+			return result
+		finally:
+			cur.close()
+	
+	def _clear(self, txn):
 		self.db.truncate(txn)
+		self.attrs.truncate(txn)
+		self.hosts.truncate(txn)
+		self.leases.truncate(txn)
+		self._log(txn, 'clear')
+	
+	@serialized
+	@with_transaction
+	def clear(self, txn):
+		self._clear(txn)
+	
+	@serialized
+	@with_transaction
+	def apply(self, txn, changes):
+		"""
+		Apply a list of [seq, op, args...] changes from a primary's 
+		change log, in one transaction
+		"""
+		for change in changes:
+			seq, op, args = change[0], change[1], change[2:]
+			if op == 'add':
+				self._add(txn, *args)
+			elif op == 'delete':
+				self._delete(txn, *args)
+			elif op == 'lease':
+				self._set_lease(txn, *args)
+			elif op == 'unlease':
+				self._delete_lease(txn, *args)
+			elif op == 'clear':
+				self._clear(txn)
+			elif op == 'load':
+				raise Exception("A bulk load cannot be replayed: copy all mappings instead")
+			else:
+				raise Exception("Unknown change: %s" % op)
+			self.seq = seq
+		self.meta.put("seq", str(self.seq), txn)
+	
+	@serialized
+	@with_transaction
+	def set_seq(self, txn, seq):
+		"""
+		Set the sequence number of a replica after a full copy
+		"""
+		self.seq = seq
+		self.meta.put("seq", str(seq), txn)
+	
+	@with_transaction
+	def get_changes(self, txn, since, limit=1000):
+		"""
+		Return up to limit [seq, op, args...] changes after since
+		"""
+		cur = self.changes.cursor(txn)
+		try:
+			result = []
+			current = cur.set_range(seq_key(since + 1))
+			while current is not None and len(result) < limit:
+				result.append([int(current[0])] + list(pickle.loads(current[1])))
+				current = cur.next()
+			return result
+		finally:
+			cur.close()
+	
+	@with_transaction
+	def first_seq(self, txn):
+		"""
+		Return the oldest sequence number in the change log, or the 
+		next one to be written if the log is empty
+		"""
+		cur = self.changes.cursor(txn)
+		try:
+			current = cur.first()
+			if current is None:
+				return self.seq + 1
+			return int(current[0])
+		finally:
+			cur.close()
+	
+	@with_transaction
+	def _trim_batch(self, txn, last, limit):
+		cur = self.changes.cursor(txn)
+		try:
+			deleted = 0
+			current = cur.first()
+			while current is not None and deleted < limit and int(current[0]) <= last:
+				cur.delete()
+				deleted += 1
+				current = cur.next()
+			return deleted
+		finally:
+			cur.close()
+	
+	def trim_changes(self, keep, batch=1000):
+		"""
+		Delete all but the last keep entries from the change log
+		"""
+		last = self.seq - keep
+		total = 0
+		while True:
+			deleted = self._trim_batch(last, batch)
+			total += deleted
+			if deleted < batch:
+				return total
 					
 	@with_transaction
 	def lookup(self, txn, lfn):
@@ -160,13 +663,152 @@ class RLSDatabase(Database):
 			return result
 		finally:
 			cur.close()
+	
+	def load(self, mappings, batch=10000):
+		"""
+		Add an iterable of (lfn, pfn, attrs) mappings, batch mappings 
+		per transaction. This is fastest when the mappings are sorted
+		by lfn, because then each batch fills pages in order. Returns 
+		the number of mappings added. Replicas copy all mappings again
+		when they reach the load in the change log.
+		"""
+		total = 0
+		chunk = []
+		for m in mappings:
+			chunk.append(m)
+			if len(chunk) >= batch:
+				self.load_many(chunk)
+				total += len(chunk)
+				chunk = []
+		if len(chunk) > 0:
+			self.load_many(chunk)
+			total += len(chunk)
+		return total
+	
+	def export(self, write, snapshot=True):
+		"""
+		Call write(lfn, pfn, attrs) for every mapping in lfn order. If
+		snapshot is true then a snapshot transaction is used so that
+		writers are not blocked while the export runs. Returns the 
+		number of mappings exported.
+		"""
+		if snapshot:
+			txn = self.env.txn_begin(flags=bdb.DB_TXN_SNAPSHOT)
+		else:
+			txn = self.env.txn_begin()
+		try:
+			cur = self.db.cursor(txn)
+			try:
+				n = 0
+				current = cur.first()
+				while current is not None:
+					lfn, pfn = current
+					write(lfn, pfn, self._get_attrs(txn, lfn, pfn))
+					n += 1
+					current = cur.next()
+				return n
+			finally:
+				cur.close()
+		finally:
+			# Nothing was written, so there is nothing to commit
+			txn.abort()
+	
+	@with_transaction
+	def list_page(self, txn, token=None, limit=1000, pattern=None, attrs=False):
+		"""
+		Return (items, token) for one page of lfns matching pattern,
+		where each item is [lfn, [pfn...]], or [lfn, [[pfn, attrs]...]]
+		if attrs is true. Pass the returned token to get the next page;
+		it is None after the last page.
+		"""
+		def record(cur, current):
+			lfn = current[0]
+			pfns = [current[1]]
+			while True:
+				dup = cur.next_dup()
+				if dup is None:
+					break
+				pfns.append(dup[1])
+			if attrs:
+				pfns = [[pfn, self._get_attrs(txn, lfn, pfn)] for pfn in pfns]
+			return [lfn, pfns]
+		cur = self.db.cursor(txn)
+		try:
+			return page(cur, token, limit, pattern, record)
+		finally:
+			cur.close()
+	
+	@with_transaction
+	def lookup_attrs(self, txn, lfn):
+		"""
+		Return a list of (pfn, attributes) pairs for lfn
+		"""
+		cur = self.db.cursor(txn)
+		try:
+			result = []
+			current = cur.set(lfn)
+			while current is not None:
+				pfn = current[1]
+				result.append((pfn, self._get_attrs(txn, lfn, pfn)))
+				current = cur.next_dup()
+			return result
+		finally:
+			cur.close()
 		
 class CacheDatabase(Database):
-	def __init__(self):
+	def __init__(self, path=None):
 		self.log = log.get_log("cache_database")
-		home = config.get_home()
-		path = os.path.join(home, "var", "cache")
+		if path is None:
+			path = os.path.join(config.get_home(), "var", "cache")
 		Database.__init__(self, path, "cache", duplicates=False)
+		# Location of packed entries, uuid -> {pack, offset, size, mtime}
+		self.packs = self.open_db("packs")
+	
+	@with_transaction
+	def pack_get(self, txn, uuid):
+		current = self.packs.get(uuid, None, txn)
+		if current is not None:
+			return pickle.loads(current)
+		return None
+	
+	@with_transaction
+	def pack_put(self, txn, uuid, loc):
+		self.packs.put(uuid, pickle.dumps(loc), txn)
+	
+	@with_transaction
+	def pack_move(self, txn, uuid, old, new):
+		"""
+		Change the location of uuid from old to new, unless it has 
+		been removed or changed. Returns True if it was moved.
+		"""
+		current = self.packs.get(uuid, None, txn, bdb.DB_RMW)
+		if current is None or pickle.loads(current) != old:
+			return False
+		self.packs.put(uuid, pickle.dumps(new), txn)
+		return True
+	
+	@with_transaction
+	def pack_delete(self, txn, uuid):
+		try:
+			self.packs.delete(uuid, txn)
+		except bdb.DBNotFoundError:
+			pass
+	
+	@with_transaction
+	def pack_list(self, txn):
+		"""
+		Return a list of (uuid, location) for all packed entries
+		"""
+		cur = self.packs.cursor(txn)
+		try:
+			result = []
+			current = cur.first()
+			while current is not None:
+				result.append((current[0], pickle.loads(current[1])))
+				current = cur.next()
+			return result
+		finally:
+			cur.close()
 	
 	@with_transaction
 	def get(self, txn, lfn):
@@ -176,10 +818,83 @@ class CacheDatabase(Database):
 		else:
 			return None
 		
+	@with_transaction
+	def get_many(self, txn, lfns):
+		"""
+		Return a dict of lfn -> record (or None) for a list of lfns
+		"""
+		result = {}
+		for lfn in lfns:
+			current = self.db.get(lfn, None, txn)
+			if current is not None:
+				result[lfn] = pickle.loads(current)
+			else:
+				result[lfn] = None
+		return result
+		
 	@with_transaction
 	def put(self, txn, lfn):
 		next = { 'status': 'unready' }
 		self.db.put(lfn, pickle.dumps(next), txn)
+	
+	def _status(self, txn, lfn, flags):
+		current = self.db.get(lfn, None, txn, flags)
+		if current is None:
+			return None
+		return pickle.loads(current)['status']
+	
+	def _read_for_update(self, txn, lfns, retry=False):
+		# Read without holding locks first, so that hits do not lock 
+		# popular keys. Then write-lock and read again only the keys
+		# that may be claimed, in sorted order so that concurrent 
+		# batches over the same lfns wait for each other instead of 
+		# deadlocking
+		status = {}
+		for lfn in set(lfns):
+			status[lfn] = self._status(txn, lfn, bdb.DB_READ_COMMITTED)
+		claimable = [None]
+		if retry:
+			claimable.append('failed')
+		for lfn in sorted([l for l in status if status[l] in claimable]):
+			status[lfn] = self._status(txn, lfn, bdb.DB_RMW)
+		return status
+	
+	def _claim(self, txn, status):
+		unready = pickle.dumps({ 'status': 'unready' })
+		for lfn in sorted(status.keys()):
+			if status[lfn] is None:
+				self.db.put(lfn, unready, txn, bdb.DB_NOOVERWRITE)
+				status[lfn] = 'created'
+	
+	@with_transaction
+	def classify(self, txn, lfns, retry=False, partial=False):
+		"""
+		Look up a list of lfns in one transaction and claim the ones 
+		that are missing by adding unready records for them. Returns a
+		dict of lfn -> status, where the status of claimed lfns is
+		'created'. If any lfn has failed then nothing is claimed, and
+		the status of missing lfns is None, unless partial is True. If
+		retry is True then failed lfns are claimed again.
+		"""
+		status = self._read_for_update(txn, lfns, retry)
+		if retry:
+			for lfn in status:
+				if status[lfn] == 'failed':
+					self.db.delete(lfn, txn)
+					status[lfn] = None
+		if partial or 'failed' not in status.values():
+			self._claim(txn, status)
+		return status
+	
+	@with_transaction
+	def claim(self, txn, lfns):
+		"""
+		Claim the missing lfns in a list by adding unready records for
+		them, in one transaction. Returns the set of lfns claimed.
+		"""
+		status = self._read_for_update(txn, lfns)
+		self._claim(txn, status)
+		return set([lfn for lfn in status if status[lfn] == 'created'])
 			
 	@with_transaction
 	def remove(self, txn, lfn):
@@ -199,28 +914,104 @@ class CacheDatabase(Database):
 			return result
 		finally:
 			cur.close()
+	
+	@with_transaction
+	def list_page(self, txn, token=None, limit=1000, pattern=None):
+		"""
+		Return (records, token) for one page of lfns matching pattern.
+		Pass the returned token to get the next page; it is None after
+		the last page.
+		"""
+		def record(cur, current):
+			rec = pickle.loads(current[1])
+			rec['lfn'] = current[0]
+			return rec
+		cur = self.db.cursor(txn)
+		try:
+			return page(cur, token, limit, pattern, record)
+		finally:
+			cur.close()
 			
 	@with_transaction
-	def get_bloom_filter(self, txn, m=36*1024*8, k=3):
+	def get_bloom_filter(self, txn, m=bits.DEFAULT_SIZE, k=bits.DEFAULT_HASHES,
+						 fpr=None):
 		cur = self.db.cursor(txn)
 		try:
-			bf = bits.BloomFilter(m, k)
+			lfns = []
 			current = cur.first()
 			while current is not None:
-				bf.add(current[0])
+				lfns.append(current[0])
 				current = cur.next()
+			if fpr is not None:
+				k = bits.optimal_hashes(fpr)
+				m = bits.optimal_size(len(lfns), fpr, m)
+			bf = bits.BloomFilter(m, k)
+			bf.add_many(lfns)
 			return bf
 		finally:
 			cur.close()
 					
 	@with_transaction
-	def update(self, txn, lfn, status):
+	def update(self, txn, lfn, status, device=0):
 		next = { 'status': status }
+		if device:
+			next['device'] = device
 		self.db.put(lfn, pickle.dumps(next), txn)
+	
+	@with_transaction
+	def update_many(self, txn, lfns, status, device=0):
+		next = { 'status': status }
+		if device:
+			next['device'] = device
+		next = pickle.dumps(next)
+		for lfn in sorted(lfns):
+			self.db.put(lfn, next, txn)
+	
+	@with_transaction
+	def _remove_device_batch(self, txn, device, start, limit):
+		cur = self.db.cursor(txn)
+		try:
+			lfns = []
+			if start is None:
+				current = cur.first()
+			else:
+				current = cur.set_range(start)
+			visited = 0
+			while current is not None:
+				if visited == limit:
+					# Resume from this record in the next transaction
+					return lfns, current[0]
+				visited += 1
+				rec = pickle.loads(current[1])
+				if rec['status'] == 'ready' and rec.get('device', 0) == device:
+					lfns.append(current[0])
+					cur.delete()
+				current = cur.next()
+			return lfns, None
+		finally:
+			cur.close()
+	
+	def remove_device(self, device, batch=1000):
+		"""
+		Remove the records of the ready files stored on device. Returns
+		their lfns. This uses several transactions of at most batch 
+		records each so that large caches do not exhaust the lock table.
+		Claims of downloads in progress are kept, since they do not say
+		which device they are on; a download to a failed device fails 
+		by itself.
+		"""
+		lfns = []
+		start = None
+		while True:
+			removed, start = self._remove_device_batch(device, start, batch)
+			lfns.extend(removed)
+			if start is None:
+				return lfns
 		
 	@with_transaction
 	def clear(self, txn):
 		self.db.truncate(txn)
+		self.packs.truncate(txn)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,482 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import time
+import json
+import math
+import random
+import shutil
+import signal
+import socket
+import urllib
+import posixpath
+import tempfile
+import subprocess
+from threading import Thread, Lock
+from Queue import Queue, Empty
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+from mule import config, rls, cache
+
+LOOPBACK = "127.0.0.1"
+BASE_PORT = 13880
+BLOCK = os.urandom(64*1024)
+
+def parse_size(s):
+	"""
+	Parse a size like 512, 64K, 10M or 1G into a number of bytes
+	"""
+	units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+	s = s.strip().upper()
+	if s and s[-1] in units:
+		return int(float(s[:-1]) * units[s[-1]])
+	return int(s)
+
+def size_distribution(spec):
+	"""
+	Return a function that generates file sizes according to spec,
+	which is one of fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA
+	"""
+	rec = spec.split(':')
+	if rec[0] == 'fixed' and len(rec) == 2:
+		size = parse_size(rec[1])
+		return lambda: size
+	elif rec[0] == 'uniform' and len(rec) == 3:
+		lo = parse_size(rec[1])
+		hi = parse_size(rec[2])
+		return lambda: random.randint(lo, hi)
+	elif rec[0] == 'lognormal' and len(rec) == 3:
+		mu = math.log(parse_size(rec[1]))
+		sigma = float(rec[2])
+		return lambda: int(random.lognormvariate(mu, sigma))
+	raise ValueError("Invalid size distribution: %s" % spec)
+
+def write_file(path, size):
+	"""
+	Create a file of the given size
+	"""
+	f = open(path, 'wb')
+	try:
+		while size > 0:
+			n = min(size, len(BLOCK))
+			f.write(BLOCK[:n])
+			size -= n
+	finally:
+		f.close()
+
+def percentile(values, p):
+	"""
+	Return the pth percentile of values
+	"""
+	if len(values) == 0:
+		return None
+	values = sorted(values)
+	i = int(math.ceil(p / 100.0 * len(values))) - 1
+	return values[max(0, min(i, len(values) - 1))]
+
+def summarize(latencies):
+	if len(latencies) == 0:
+		return {'count': 0}
+	return {
+		'count': len(latencies),
+		'mean': sum(latencies) / len(latencies),
+		'p50': percentile(latencies, 50),
+		'p99': percentile(latencies, 99),
+		'max': max(latencies)
+	}
+
+class OriginHandler(SimpleHTTPRequestHandler):
+	def translate_path(self, path):
+		path = path.split('?', 1)[0].split('#', 1)[0]
+		path = posixpath.normpath(urllib.unquote(path)).lstrip('/')
+		return os.path.join(self.server.root, path)
+
+	def log_message(self, format, *args):
+		pass
+
+class Origin(ThreadingMixIn, HTTPServer):
+	"""
+	A plain HTTP server that plays the part of the workflow's input
+	file server
+	"""
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, root, port):
+		self.root = root
+		HTTPServer.__init__(self, (LOOPBACK, port), OriginHandler)
+
+class LocalCluster(object):
+	"""
+	An RLS, a set of caches and an HTTP origin running on the loopback
+	interface. Each daemon gets its own port and directories under
+	workdir.
+	"""
+	def __init__(self, workdir, caches, threads=4, base_port=BASE_PORT):
+		self.workdir = workdir
+		self.threads = threads
+		self.rls_port = base_port
+		self.cache_ports = [base_port + 1 + i for i in range(0, caches)]
+		self.origin_port = base_port + caches + 1
+		self.origin_dir = os.path.join(workdir, "origin")
+		self.procs = []
+		self.origin = None
+
+	def _spawn(self, exe, name, args):
+		out = open(os.path.join(self.workdir, "%s.out" % name), "w")
+		exe = os.path.join(config.get_home(), "bin", exe)
+		args = [sys.executable, exe, "-f"] + [str(a) for a in args]
+		p = subprocess.Popen(args, stdout=out, stderr=subprocess.STDOUT)
+		self.procs.append(p)
+		return p
+
+	def _wait(self, name, function, timeout=60):
+		start = time.time()
+		while True:
+			try:
+				function()
+				return
+			except socket.error:
+				if time.time() - start > timeout:
+					raise Exception("%s did not start" % name)
+				time.sleep(0.2)
+
+	def start(self):
+		if not os.path.isdir(self.origin_dir):
+			os.makedirs(self.origin_dir)
+
+		d = os.path.join(self.workdir, "rls")
+		self._spawn("mule-rls", "rls", ["-p", self.rls_port,
+			"-D", d, "-l", d + ".log"])
+		self._wait("rls", self.rls().ready)
+
+		for i in range(0, len(self.cache_ports)):
+			d = os.path.join(self.workdir, "cache%d" % i)
+			self._spawn("mule-cache", "cache%d" % i, [
+				"-p", self.cache_ports[i],
+				"-r", "%s:%d" % (LOOPBACK, self.rls_port),
+				"-d", os.path.join(d, "files"),
+				"-D", os.path.join(d, "db"),
+				"-l", d + ".log",
+				"-t", self.threads,
+				"-n", LOOPBACK])
+		for i in range(0, len(self.cache_ports)):
+			self._wait("cache%d" % i, self.cache(i).stats)
+
+		self.origin = Origin(self.origin_dir, self.origin_port)
+		t = Thread(target=self.origin.serve_forever)
+		t.setDaemon(True)
+		t.start()
+
+	def stop(self):
+		if self.origin is not None:
+			self.origin.shutdown()
+		for p in self.procs:
+			try:
+				os.kill(p.pid, signal.SIGTERM)
+			except OSError:
+				pass
+		for p in self.procs:
+			p.wait()
+		self.procs = []
+
+	def rls(self):
+		return rls.connect(LOOPBACK, self.rls_port)
+
+	def cache(self, i):
+		return cache.connect(LOOPBACK, self.cache_ports[i])
+
+	def origin_url(self, name):
+		return "http://%s:%d/%s" % (LOOPBACK, self.origin_port, name)
+
+	def add_origin_file(self, name, size):
+		"""
+		Create a file on the origin server and return its URL
+		"""
+		write_file(os.path.join(self.origin_dir, name), size)
+		return self.origin_url(name)
+
+	def stats(self):
+		"""
+		Return the sum of the statistics of all the caches
+		"""
+		total = {}
+		for i in range(0, len(self.cache_ports)):
+			st = self.cache(i).stats()
+			for k in st:
+				if isinstance(st[k], int):
+					total[k] = total.get(k, 0) + st[k]
+		return total
+
+def run_parallel(function, items, concurrency):
+	"""
+	Call function on each item using concurrency threads. Returns the
+	number of calls that failed.
+	"""
+	queue = Queue()
+	for item in items:
+		queue.put(item)
+	failures = [0]
+	lock = Lock()
+	def worker():
+		while True:
+			try:
+				item = queue.get_nowait()
+			except Empty:
+				return
+			try:
+				function(item)
+			except Exception, e:
+				sys.stderr.write("ERROR: %s\n" % e)
+				lock.acquire()
+				failures[0] += 1
+				lock.release()
+	threads = [Thread(target=worker) for i in range(0, concurrency)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return failures[0]
+
+def rls_bench(cluster, ops, concurrency, batch):
+	"""
+	Measure how many mappings per second the RLS can add and look up
+	with concurrency clients sending batches of batch mappings
+	"""
+	batches = [["bench_%d_%d" % (b, i) for i in range(0, batch)]
+		for b in range(0, max(1, ops // batch))]
+
+	def add(lfns):
+		cluster.rls().multiadd([[l, cluster.origin_url(l)] for l in lfns])
+	def lookup(lfns):
+		cluster.rls().multilookup(lfns)
+
+	result = {}
+	for name, function in [('add', add), ('lookup', lookup)]:
+		start = time.time()
+		failures = run_parallel(function, batches, concurrency)
+		elapsed = time.time() - start
+		result[name] = {
+			'ops': len(batches) * batch,
+			'seconds': elapsed,
+			'ops_per_second': len(batches) * batch / elapsed,
+			'failed_batches': failures
+		}
+	cluster.rls().clear()
+	return result
+
+class Workflow(object):
+	"""
+	A synthetic workflow of levels of tasks. Each task runs on a
+	random cache, gets fan_in files produced by the previous level
+	(or the origin), and puts fan_out new files.
+	"""
+	def __init__(self, cluster, workdir, levels, tasks, inputs, fan_in,
+				 fan_out, sizes, concurrency):
+		self.cluster = cluster
+		self.workdir = workdir
+		self.levels = levels
+		self.tasks = tasks
+		self.inputs = inputs
+		self.fan_in = fan_in
+		self.fan_out = fan_out
+		self.sizes = sizes
+		self.concurrency = concurrency
+		self.lock = Lock()
+		self.get_latency = []
+		self.put_latency = []
+		self.bytes = 0
+
+	def record(self, latencies, elapsed, nbytes=0):
+		self.lock.acquire()
+		try:
+			latencies.append(elapsed)
+			self.bytes += nbytes
+		finally:
+			self.lock.release()
+
+	def run_task(self, task):
+		level, n, inputs = task
+		conn = self.cluster.cache(random.randint(0, len(self.cluster.cache_ports) - 1))
+		d = os.path.join(self.workdir, "tasks", "%d_%d" % (level, n))
+		os.makedirs(d)
+
+		pairs = [[lfn, os.path.join(d, "in_%d" % i)]
+			for i, (lfn, size) in enumerate(inputs)]
+		start = time.time()
+		conn.multiget(pairs, True)
+		self.record(self.get_latency, time.time() - start,
+			sum([size for lfn, size in inputs]))
+
+		outputs = []
+		pairs = []
+		for i in range(0, self.fan_out):
+			lfn = "file_%d_%d_%d" % (level, n, i)
+			size = self.sizes()
+			path = os.path.join(d, "out_%d" % i)
+			write_file(path, size)
+			outputs.append((lfn, size))
+			pairs.append([path, lfn])
+		start = time.time()
+		conn.multiput(pairs, True)
+		self.record(self.put_latency, time.time() - start)
+		return outputs
+
+	def run(self):
+		# Create the workflow inputs on the origin
+		pool = []
+		mappings = []
+		for i in range(0, self.inputs):
+			lfn = "input_%d" % i
+			size = self.sizes()
+			mappings.append([lfn, self.cluster.add_origin_file(lfn, size)])
+			pool.append((lfn, size))
+		self.cluster.rls().multiadd(mappings)
+
+		start = time.time()
+		failures = 0
+		for level in range(0, self.levels):
+			outputs = []
+			lock = Lock()
+			def task(t):
+				result = self.run_task(t)
+				lock.acquire()
+				outputs.extend(result)
+				lock.release()
+			tasks = [(level, n, random.sample(pool, min(self.fan_in, len(pool))))
+				for n in range(0, self.tasks)]
+			failures += run_parallel(task, tasks, self.concurrency)
+			pool = outputs
+		elapsed = time.time() - start
+
+		stats = self.cluster.stats()
+		gets = max(1, stats.get('gets', 0))
+		return {
+			'seconds': elapsed,
+			'tasks': self.levels * self.tasks,
+			'failed_tasks': failures,
+			'bytes': self.bytes,
+			'throughput_mb_per_second': self.bytes / elapsed / 1e6,
+			'multiget': summarize(self.get_latency),
+			'multiput': summarize(self.put_latency),
+			'hit_rate': float(stats.get('hits', 0)) / gets,
+			'near_miss_rate': float(stats.get('near_misses', 0)) / gets,
+			'miss_rate': float(stats.get('misses', 0)) / gets,
+			'cache_stats': stats
+		}
+
+def main():
+	parser = OptionParser("Usage: %prog [options]")
+	parser.add_option("-c", "--caches", action="store", dest="caches",
+		default=4, type="int", metavar="N",
+		help="Number of cache daemons [default: %default]")
+	parser.add_option("-t", "--threads", action="store", dest="threads",
+		default=4, type="int", metavar="N",
+		help="Download threads per cache [default: %default]")
+	parser.add_option("-j", "--concurrency", action="store", dest="concurrency",
+		default=8, type="int", metavar="N",
+		help="Number of concurrent tasks or RLS clients [default: %default]")
+	parser.add_option("-L", "--levels", action="store", dest="levels",
+		default=3, type="int", metavar="N",
+		help="Number of workflow levels [default: %default]")
+	parser.add_option("-n", "--tasks", action="store", dest="tasks",
+		default=50, type="int", metavar="N",
+		help="Tasks per level [default: %default]")
+	parser.add_option("-i", "--inputs", action="store", dest="inputs",
+		default=100, type="int", metavar="N",
+		help="Number of workflow input files on the origin [default: %default]")
+	parser.add_option("--fan-in", action="store", dest="fan_in",
+		default=4, type="int", metavar="N",
+		help="Input files per task [default: %default]")
+	parser.add_option("--fan-out", action="store", dest="fan_out",
+		default=2, type="int", metavar="N",
+		help="Output files per task [default: %default]")
+	parser.add_option("-s", "--sizes", action="store", dest="sizes",
+		default="lognormal:64K:1.5", metavar="DIST",
+		help="File sizes: fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA [default: %default]")
+	parser.add_option("-r", "--rls-ops", action="store", dest="rls_ops",
+		default=20000, type="int", metavar="N",
+		help="Mappings to add and look up in the RLS benchmark, 0 to skip [default: %default]")
+	parser.add_option("-b", "--batch", action="store", dest="batch",
+		default=100, type="int", metavar="N",
+		help="Mappings per RLS request [default: %default]")
+	parser.add_option("-p", "--port", action="store", dest="port",
+		default=BASE_PORT, type="int", metavar="PORT",
+		help="First port to use [default: %default]")
+	parser.add_option("-w", "--workdir", action="store", dest="workdir",
+		default=None, metavar="DIR",
+		help="Working directory [default: temporary directory]")
+	parser.add_option("-k", "--keep", action="store_true", dest="keep",
+		default=False, help="Do not remove the working directory")
+	parser.add_option("--seed", action="store", dest="seed",
+		default=None, type="int", help="Random seed")
+	parser.add_option("-o", "--output", action="store", dest="output",
+		default=None, metavar="FILE",
+		help="Write JSON results to FILE [default: stdout]")
+	(options, args) = parser.parse_args()
+
+	if len(args) > 0:
+		parser.error("Invalid argument")
+
+	try:
+		sizes = size_distribution(options.sizes)
+	except ValueError, e:
+		parser.error(str(e))
+
+	random.seed(options.seed)
+
+	if options.workdir:
+		workdir = os.path.abspath(options.workdir)
+		os.makedirs(workdir)
+	else:
+		workdir = tempfile.mkdtemp(prefix="mule-bench-")
+
+	cluster = LocalCluster(workdir, options.caches, options.threads, options.port)
+	results = {
+		'caches': options.caches,
+		'threads': options.threads,
+		'concurrency': options.concurrency,
+		'sizes': options.sizes
+	}
+	try:
+		cluster.start()
+		if options.rls_ops > 0:
+			results['rls'] = rls_bench(cluster, options.rls_ops,
+				options.concurrency, options.batch)
+		wf = Workflow(cluster, workdir, options.levels, options.tasks,
+			options.inputs, options.fan_in, options.fan_out, sizes,
+			options.concurrency)
+		results['workflow'] = wf.run()
+	finally:
+		cluster.stop()
+		if not options.keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+	output = json.dumps(results, indent=2, sort_keys=True)
+	if options.output:
+		f = open(options.output, 'w')
+		try:
+			f.write(output + "\n")
+		finally:
+			f.close()
+	else:
+		print output
+
+if __name__ == '__main__':
+	main()
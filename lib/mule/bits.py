@@ -1,28 +1,124 @@
 import math
-import array
 import base64
+import binascii
+import hashlib
+import struct
 
-# This is required because Condor doesn't allow ads larger 
+# This is required because Condor doesn't allow ads larger
 # than 8192 chars in cronjob classads. Note: it takes x bytes
 # to base64-encode .75x bytes, so this should give us 8000
 # character chunks.
 CHUNK_SIZE = (8000 * 3) / 4
 
+# Default (and maximum) filter size in bits and number of hashes.
+# Autotuned filters are DEFAULT_SIZE folded in half as many times
+# as the number of entries allows, so every filter in the pool can
+# be folded down to the size of any other.
+DEFAULT_SIZE = 32*1024*8
+DEFAULT_HASHES = 3
+MIN_SIZE = 1024
+
+# Sparse filters are encoded as SPARSE_PREFIX + "<m>:<base64>" where
+# the base64 data is the list of set bit positions, delta-encoded as
+# varints. The prefix is not a base64 character, so bloom_compare
+# can tell the two encodings apart.
+SPARSE_PREFIX = '!'
+
+def optimal_hashes(p):
+	"""Return the number of hashes that minimises the false-positive
+	rate of a filter with target false-positive rate p"""
+	return max(1, int(round(-math.log(p, 2))))
+
+def optimal_size(n, p, max_size=DEFAULT_SIZE):
+	"""Return the size of a filter for n entries with false-positive
+	rate p. The result is max_size halved as many times as possible
+	so that filters of different sizes can still be compared."""
+	want = max(MIN_SIZE, -n * math.log(p) / (math.log(2) ** 2))
+	m = max_size
+	while m % 16 == 0 and m // 2 >= want:
+		m //= 2
+	return m
+
+def num_chunks(m):
+	"""Return the number of base64 chunks needed for an m-bit filter"""
+	return ((m+7)//8 + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+def _tolong(buf):
+	"""Convert a byte buffer into a (big-endian) long"""
+	if len(buf) == 0:
+		return 0L
+	return long(binascii.hexlify(buf), 16)
+
+def _fromlong(value, nbytes):
+	"""Convert a long back into a byte buffer of nbytes bytes"""
+	if nbytes == 0:
+		return bytearray()
+	return bytearray(binascii.unhexlify('%0*x' % (nbytes*2, value)))
+
 class BitSet(object):
 	def __init__(self, size):
 		"""Create a bitset capable of storing 'size' bits"""
-		self.bits = array.array('B',[0 for i in range((size+7)//8)] )
-	
+		self.size = size
+		self.bits = bytearray((size+7)//8)
+
 	def set(self, n):
 		"""Set the nth bit in the set"""
-		byte = self.bits[n//8]
-		self.bits[n//8] = byte | 1 << (n % 8)
-	
+		self.bits[n >> 3] |= 1 << (n & 7)
+
 	def get(self, n):
 		"""Get the value of the nth bit in the set"""
-		byte = self.bits[n//8]
-		return (byte >> (n % 8)) & 1
-		
+		return (self.bits[n >> 3] >> (n & 7)) & 1
+
+	def set_many(self, indices):
+		"""Set all the bits in indices"""
+		bits = self.bits
+		for n in indices:
+			bits[n >> 3] |= 1 << (n & 7)
+
+	def popcount(self):
+		"""Count the number of bits that are set"""
+		return bin(_tolong(self.bits)).count('1')
+
+	def _combine(self, other, op):
+		if self.size != other.size:
+			raise ValueError("BitSets are different sizes: %d != %d" %
+							 (self.size, other.size))
+		result = BitSet(self.size)
+		value = op(_tolong(self.bits), _tolong(other.bits))
+		result.bits = _fromlong(value, len(self.bits))
+		return result
+
+	def union(self, other):
+		"""Return a new bitset containing the bits set in self or other"""
+		return self._combine(other, lambda a, b: a | b)
+
+	def intersect(self, other):
+		"""Return a new bitset containing the bits set in self and other"""
+		return self._combine(other, lambda a, b: a & b)
+
+	__or__ = union
+	__and__ = intersect
+
+	def fold(self, size):
+		"""Return a copy of the bitset folded in half (by ORing the two
+		halves together) until it is size bits long. Bit n of the result
+		is set if any bit n + i*size was set in the original."""
+		if size > self.size:
+			raise ValueError("Cannot fold %d bits into %d" % (self.size, size))
+		value = _tolong(self.bits)
+		nbytes = len(self.bits)
+		m = self.size
+		while m > size:
+			if m % 16 != 0:
+				raise ValueError("Cannot fold %d bits into %d" % (self.size, size))
+			m //= 2
+			nbytes //= 2
+			shift = nbytes * 8
+			value = (value >> shift) | (value & ((1L << shift) - 1))
+		result = BitSet(m)
+		result.bits = _fromlong(value, nbytes)
+		return result
+
 	def tobase64(self):
 		"""Generate a base64-encoded copy of the bitset"""
 		start = 0
@@ -30,20 +126,84 @@ class BitSet(object):
 		result = []
 		while end < len(self.bits):
 			end = min(len(self.bits), start + CHUNK_SIZE)
-			result.append(base64.standard_b64encode(self.bits[start:end]))
+			result.append(base64.standard_b64encode(str(self.bits[start:end])))
 			start = end
 		return result
 
-def hashpjw(s):
-	"""A simple and reasonable string hash function due to Peter Weinberger"""
-	val = 0
-	for c in s:
-		val = (val << 4) + ord(c)
-		tmp = val & 0xf0000000
-		if tmp != 0:
-			val = val ^ (tmp >> 24)
-			val = val ^ tmp
-	return val
+	@classmethod
+	def frombase64(cls, chunks):
+		"""Create a bitset from the chunks generated by tobase64"""
+		data = ''.join([base64.standard_b64decode(c) for c in chunks])
+		bs = cls(len(data)*8)
+		bs.bits = bytearray(data)
+		return bs
+
+	def tosparse(self):
+		"""Generate a sparse encoding of the bitset"""
+		deltas = bytearray()
+		last = 0
+		for i, byte in enumerate(self.bits):
+			if byte == 0:
+				continue
+			for j in xrange(8):
+				if (byte >> j) & 1:
+					n = i*8 + j
+					delta = n - last
+					last = n
+					while delta >= 0x80:
+						deltas.append((delta & 0x7f) | 0x80)
+						delta >>= 7
+					deltas.append(delta)
+		return "%s%d:%s" % (SPARSE_PREFIX, self.size,
+							base64.standard_b64encode(str(deltas)))
+
+	@classmethod
+	def fromsparse(cls, s):
+		"""Create a bitset from the string generated by tosparse"""
+		size, data = s[len(SPARSE_PREFIX):].split(':', 1)
+		bs = cls(int(size))
+		n = 0
+		delta = 0
+		shift = 0
+		for byte in bytearray(base64.standard_b64decode(data)):
+			delta |= (byte & 0x7f) << shift
+			if byte & 0x80:
+				shift += 7
+				continue
+			n += delta
+			bs.set(n)
+			delta = 0
+			shift = 0
+		return bs
+
+	def encode(self):
+		"""Generate the most compact encoding of the bitset as a list
+		of ClassAd-sized chunks"""
+		dense = self.tobase64()
+		if sum([len(c) for c in dense]) <= 4 * CHUNK_SIZE // 3:
+			return dense
+		sparse = self.tosparse()
+		if len(sparse) <= 4 * CHUNK_SIZE // 3 and \
+				len(sparse) < sum([len(c) for c in dense]):
+			return [sparse]
+		return dense
+
+	@classmethod
+	def decode(cls, chunks):
+		"""Create a bitset from the chunks generated by encode. Empty
+		chunks are ignored."""
+		chunks = [c for c in chunks if c]
+		if len(chunks) == 1 and chunks[0].startswith(SPARSE_PREFIX):
+			return cls.fromsparse(chunks[0])
+		return cls.frombase64(chunks)
+
+def hash2(s):
+	"""Derive two 64-bit hashes of s from a single MD5 digest. Unlike
+	the builtin hash() the result is the same in every process, which
+	is required for filters built on different hosts to be comparable."""
+	if isinstance(s, unicode):
+		s = s.encode('utf-8')
+	return struct.unpack('<QQ', hashlib.md5(s).digest())
 
 class BloomFilter(object):
 	def __init__(self, m, k):
@@ -54,29 +214,111 @@ class BloomFilter(object):
 
 	def _hash(self, s):
 		"""Hash s into k bit-vector indices for an m-bit Bloom filter"""
-		indices = []
-		h1 = hash(s)
-		h2 = hashpjw(s)
-		for i in xrange(1, self.k+1):
-			indices.append((h1 + i*h2) % self.m)
-		return indices
+		h1, h2 = hash2(s)
+		m = self.m
+		return [(h1 + i*h2) % m for i in xrange(1, self.k+1)]
 
 	def add(self, s):
 		"""Insert s into the Bloom filter"""
-		for i in self._hash(s): 
-			self.bits.set(i)
+		self.bits.set_many(self._hash(s))
+
+	def add_many(self, strings):
+		"""Insert all of the strings into the Bloom filter"""
+		m = self.m
+		r = xrange(1, self.k+1)
+		bits = self.bits.bits
+		for s in strings:
+			h1, h2 = hash2(s)
+			for i in r:
+				n = (h1 + i*h2) % m
+				bits[n >> 3] |= 1 << (n & 7)
 
 	def contains(self, s):
 		"""Return True if s is in the Bloom filter"""
+		get = self.bits.get
 		for i in self._hash(s):
-			if self.bits.get(i) != 1:
+			if get(i) != 1:
 				return False
 		return True
-		
+
+	def contains_many(self, strings):
+		"""Return a list of booleans indicating which strings are in the
+		Bloom filter"""
+		m = self.m
+		r = xrange(1, self.k+1)
+		bits = self.bits.bits
+		result = []
+		for s in strings:
+			h1, h2 = hash2(s)
+			found = True
+			for i in r:
+				n = (h1 + i*h2) % m
+				if not (bits[n >> 3] >> (n & 7)) & 1:
+					found = False
+					break
+			result.append(found)
+		return result
+
+	def _check(self, other):
+		if self.m != other.m or self.k != other.k:
+			raise ValueError("Bloom filters have different parameters: "
+							 "m=%d,k=%d != m=%d,k=%d" %
+							 (self.m, self.k, other.m, other.k))
+
+	def union(self, other):
+		"""Return a new filter containing the entries of self and other"""
+		self._check(other)
+		bf = BloomFilter(self.m, self.k)
+		bf.bits = self.bits.union(other.bits)
+		return bf
+
+	def intersect(self, other):
+		"""Return a new filter containing the bits that self and other
+		have in common"""
+		self._check(other)
+		bf = BloomFilter(self.m, self.k)
+		bf.bits = self.bits.intersect(other.bits)
+		return bf
+
+	__or__ = union
+	__and__ = intersect
+
+	def popcount(self):
+		"""Return the number of bits set in the filter"""
+		return self.bits.popcount()
+
+	def fold(self, m):
+		"""Return a copy of the filter folded down to m bits. Because
+		indices are reduced mod m this is the filter that would have been
+		built with m bits in the first place."""
+		bf = BloomFilter(m, self.k)
+		bf.bits = self.bits.fold(m)
+		return bf
+
 	def tobase64(self):
 		"""Generate a base64-encoded copy of the bloom filter"""
 		return self.bits.tobase64()
 
+	@classmethod
+	def frombase64(cls, chunks, k):
+		"""Create a bloom filter from the chunks generated by tobase64"""
+		bits = BitSet.frombase64(chunks)
+		bf = cls(bits.size, k)
+		bf.bits = bits
+		return bf
+
+	def encode(self):
+		"""Generate the most compact encoding of the bloom filter"""
+		return self.bits.encode()
+
+	@classmethod
+	def decode(cls, chunks, k):
+		"""Create a bloom filter from the chunks generated by encode"""
+		bits = BitSet.decode(chunks)
+		bf = cls(bits.size, k)
+		bf.bits = bits
+		return bf
+
 if __name__ == '__main__':
 	bs = BitSet(8)
 	bs.set(1)
@@ -88,5 +330,14 @@ if __name__ == '__main__':
 	print bf.contains("gideon_0")
 	print bf.contains("juve")
 	print bf._hash("gideon")
+	bf2 = BloomFilter(65536, 1)
+	bf2.add_many(["gideon_%d" % i for i in range(500,1500)])
+	print bf2.contains_many(["gideon_0", "gideon_500", "juve"])
+	print bf.popcount(), bf2.popcount()
+	print (bf & bf2).popcount(), (bf | bf2).popcount()
+	print BloomFilter.frombase64(bf.tobase64(), 1).contains("gideon_0")
+	print BloomFilter.decode(bf.encode(), 1).contains("gideon_0")
+	print bf.fold(1024).contains("gideon_0")
+	print optimal_size(1000, 0.01), optimal_hashes(0.01)
+	print BloomFilter(DEFAULT_SIZE, DEFAULT_HASHES).encode()
 	print bf.tobase64()
-
@@ -19,28 +19,71 @@ import signal
 import socket
 import time
 import urllib2
-import hashlib
-from threading import Lock, Thread, Event
+from threading import Thread, Event, Lock, Condition
 from Queue import Queue
 from optparse import OptionParser
-from xmlrpclib import ServerProxy
-import random
+from urlparse import urlparse
 
-from mule import config, log, util, rls, server
+from mule import config, log, util, rls, server, metrics, trace, replay, hot, pack, local
+from mule import admission
+from mule.rpc import CACHE_PORT, Busy, connect
+from mule.device import Device, place
 from mule import bdb as db
 
 BLOCK_SIZE = int(os.getenv("MULE_BLOCK_SIZE", 64*1024))
-DEFAULT_DIR = os.getenv("MULE_CACHE_DIR", "/tmp/mule")
+DEFAULT_DIR = local.DEFAULT_DIR
 DEFAULT_RLS = os.getenv("MULE_RLS")
+DEFAULT_RACK = os.getenv("MULE_RACK")
+DEFAULT_LEASE = int(os.getenv("MULE_LEASE", 300))
 
-CACHE_PORT = 3881
+# Size of the in-memory hot tier, and the largest file it holds
+HOT_SIZE = config.getsize("cache", "hot_size", 64*1024*1024)
+HOT_MAX = config.getsize("cache", "hot_max", 64*1024)
 
-def connect(host='localhost',port=CACHE_PORT):
-	"""
-	Connect to the cache server running at host:port
-	"""
-	uri = "http://%s:%s" % (host, port)
-	return ServerProxy(uri, allow_none=True)
+# Files up to PACK_MAX bytes are stored in pack files of PACK_SIZE
+# bytes instead of one file each, 0 to disable
+PACK_MAX = config.getsize("cache", "pack_max", 0)
+PACK_SIZE = config.getsize("cache", "pack_size", 256*1024*1024)
+
+# Packs that are less than COMPACT_THRESHOLD live are compacted every
+# COMPACT_INTERVAL seconds
+COMPACT_THRESHOLD = 0.5
+COMPACT_INTERVAL = 600
+
+# Streaming sessions that have not been polled for SESSION_TTL seconds
+# are dropped. Items waiting for another request's download are 
+# checked every SESSION_POLL seconds.
+SESSION_TTL = 600
+SESSION_POLL = 1
+
+# Admission control: gets that need downloads are refused with Busy 
+# while MAX_DOWNLOADS downloads are queued or running, or MAX_INFLIGHT
+# bytes are being downloaded. A download only starts if it leaves 
+# MIN_FREE bytes free in the cache directory. 0 means no limit.
+MAX_DOWNLOADS = config.getint("cache", "max_downloads", 10000)
+MAX_INFLIGHT = config.getsize("cache", "max_inflight", 0)
+MIN_FREE = config.getsize("cache", "min_free", 0)
+
+# Seconds refused clients are asked to wait, at the limits
+RETRY_AFTER = config.getint("cache", "retry_after", 2)
+
+# Downloads and serves that may use one cache directory at once, and
+# how often the directories are checked for failures, in seconds
+DEVICE_DOWNLOADS = config.getint("cache", "device_downloads", 4)
+DEVICE_SERVES = config.getint("cache", "device_serves", 16)
+DEVICE_CHECK = config.getint("cache", "device_check", 30)
+
+# Errors that mean a cache directory has failed, not just one file
+DEVICE_ERRORS = (errno.EIO, errno.EROFS, errno.ENODEV, errno.ENXIO)
+
+# Longest time stream_poll waits for a result
+MAX_POLL_WAIT = 30
+
+# Maximum number of records returned by list_page
+MAX_PAGE = 10000
+
+# Records of a failed device handled per transaction and RLS call
+PURGE_BATCH = 1000
 
 def num_cpus():
 	# Python 2.6+
@@ -80,28 +123,50 @@ def copy(src, dest):
 		if f: f.close()
 		if g: g.close()
 
-def copyobj(src, dest):
+def copyobj(src, dest, length=None):
 	"""
-	Copy file-like object src to file-like object dest
+	Copy file-like object src, or the next length bytes of it, to 
+	file-like object dest and return the number of bytes copied
 	"""
+	total = 0
 	while 1:
-		buf = src.read(BLOCK_SIZE)
+		n = BLOCK_SIZE
+		if length is not None:
+			n = min(n, length - total)
+			if n <= 0: break
+		buf = src.read(n)
 		if not buf: break
 		dest.write(buf)
+		total += len(buf)
+	return total
 		
-def download(url, path):
+def download(url, path, trace_id=None, admit=None, root=None):
 	"""
-	Download url and store it at path
+	Download url and store it at path. Returns the number of bytes
+	downloaded. If admit is given then the size of the file is 
+	reserved with it, on the file system holding root, before 
+	anything is written.
 	"""
 	f = None
 	g = None
+	reserved = 0
 	try:
-		f = urllib2.urlopen(url)
+		req = urllib2.Request(url)
+		if trace_id is not None:
+			req.add_header(trace.HEADER, trace_id)
+		f = urllib2.urlopen(req)
+		if admit is not None:
+			# Servers that do not send the length get no reservation
+			size = int(f.info().getheader('Content-Length') or 0)
+			admit.reserve(size, root)
+			reserved = size
 		g = open(path, 'wb')
-		copyobj(f, g)
+		return copyobj(f, g)
 	finally:
 		if f: f.close()
 		if g: g.close()
+		if reserved > 0:
+			admit.release(reserved, root)
 		
 def ensure_path(path):
 	"""
@@ -114,31 +179,33 @@ def ensure_path(path):
 			if e.errno != errno.EEXIST:
 				raise
 
-class Statistic(object):
-	def __init__(self, value=0):
-		self.lock = Lock()
-		self._value = value
-		
-	def increment(self, i=1):
-		self.lock.acquire()
-		try:
-			self._value += i
-		finally:
-			self.lock.release()
-	
-	def value(self):
-		return self._value
-		
 class Statistics(object):
 	def __init__(self):
 		self.since = time.ctime()
-		self.gets = Statistic()
-		self.puts = Statistic()
-		self.hits = Statistic()
-		self.misses = Statistic()
-		self.near_misses = Statistic()
-		self.failures = Statistic()
-		self.duplicates = Statistic()
+		self.registry = metrics.Registry()
+		r = self.registry
+		self.gets = r.counter("mule_cache_gets_total", "LFNs requested")
+		self.puts = r.counter("mule_cache_puts_total", "LFNs stored")
+		self.hits = r.counter("mule_cache_hits_total", "Gets that were already cached")
+		self.misses = r.counter("mule_cache_misses_total", "Gets that had to be downloaded")
+		self.near_misses = r.counter("mule_cache_near_misses_total",
+			"Gets that waited for another request's download")
+		self.failures = r.counter("mule_cache_failures_total", "Gets that failed")
+		self.rejected = r.counter("mule_cache_rejected_total",
+			"Gets refused as busy because of admission limits")
+		self.duplicates = r.counter("mule_cache_duplicates_total", "Puts that were already cached")
+		self.phases = r.histogram("mule_cache_phase_seconds",
+			"Time spent in each phase of a request", ["phase"])
+		self.bytes_in = r.counter("mule_cache_bytes_in_total",
+			"Bytes downloaded from each peer", ["peer"])
+		self.bytes_out = r.counter("mule_cache_bytes_out_total",
+			"Bytes served to each peer", ["peer"])
+		
+	def phase(self, name):
+		"""
+		Return a context manager that times a phase of a request
+		"""
+		return self.phases.labels(name).time()
 		
 	def get_map(self):
 		return {
@@ -149,15 +216,20 @@ class Statistics(object):
 			'misses': self.misses.value(),
 			'near_misses': self.near_misses.value(),
 			'failures': self.failures.value(),
+			'rejected': self.rejected.value(),
 			'duplicates': self.duplicates.value()
 		}
 		
 class DownloadRequest(object):
-	def __init__(self, lfn, pfns):
+	def __init__(self, lfn, pfns, trace_id=None, callback=None):
 		self.event = Event()
 		self.lfn = lfn
 		self.pfns = pfns
+		self.trace_id = trace_id
+		self.callback = callback
+		self.device = 0
 		self.exception = None
+		self.created = time.time()
 
 class DownloadThread(Thread):
 	num = 1
@@ -167,54 +239,293 @@ class DownloadThread(Thread):
 		DownloadThread.num += 1
 		self.setDaemon(True)
 		self.cache = cache
+		self.busy = False
 		
 	def run(self):
 		while True:
 			req = self.cache.queue.get()
+			self.busy = True
+			self.cache.st.phases.labels('queue_wait').observe(time.time() - req.created)
 			try:
-				self.cache.fetch(req.lfn, req.pfns)
-				self.cache.db.update(req.lfn, 'ready')
+				req.device = self.cache.fetch(req.lfn, req.pfns, req.trace_id)
+				self.cache.db.update(req.lfn, 'ready', req.device)
 			except Exception, e:
 				req.exception = e
 				self.cache.db.update(req.lfn, 'failed')
 			finally:
+				self.busy = False
+				self.cache.admission.finished()
 				req.event.set()
+			if req.callback is not None:
+				try:
+					req.callback(req)
+				except Exception, e:
+					self.log.exception(e)
 		
+class HeartbeatThread(Thread):
+	"""
+	Registers the contents of the cache with the RLS when the cache
+	starts, and then renews its lease every lease/3 seconds. If the
+	RLS has dropped the cache's mappings then they are re-registered.
+	"""
+	def __init__(self, cache):
+		Thread.__init__(self)
+		self.log = log.get_log("heartbeat")
+		self.setDaemon(True)
+		self.cache = cache
+		
+	def run(self):
+		registered = False
+		while True:
+			try:
+				conn = rls.connect(self.cache.rls_host)
+				if not registered:
+					self.cache.register()
+					registered = True
+				elif not conn.heartbeat(self.cache.owner, self.cache.lease):
+					self.log.warning("RLS lost our lease, registering again")
+					self.cache.register()
+			except Exception, e:
+				self.log.exception(e)
+			time.sleep(self.cache.lease / 3.0)
+
+class Session(object):
+	"""
+	A streaming multiget. Items are submitted in batches and the 
+	result of each, [lfn, path, status, reason, seconds], is queued for
+	the client as soon as the file has been linked into place or has 
+	failed.
+	"""
+	def __init__(self, symlink, trace_id):
+		self.symlink = symlink
+		self.trace_id = trace_id
+		self.cond = Condition()
+		self.results = []
+		# Items that another request is downloading: (lfn, path, start)
+		self.waiting = []
+		self.touched = time.time()
+		
+	def finish(self, lfn, path, start, reason=None):
+		if reason is None:
+			status = 'ok'
+		else:
+			status = 'failed'
+		self.cond.acquire()
+		try:
+			self.results.append([lfn, path, status, reason, time.time() - start])
+			self.cond.notify()
+		finally:
+			self.cond.release()
+	
+	def wait_for(self, lfn, path, start):
+		self.cond.acquire()
+		try:
+			self.waiting.append((lfn, path, start))
+		finally:
+			self.cond.release()
+	
+	def take_waiting(self):
+		self.cond.acquire()
+		try:
+			waiting = self.waiting
+			self.waiting = []
+			return waiting
+		finally:
+			self.cond.release()
+	
+	def take(self, wait):
+		"""
+		Return the results that have arrived, waiting up to wait 
+		seconds for one if there are none
+		"""
+		self.cond.acquire()
+		try:
+			self.touched = time.time()
+			if len(self.results) == 0 and wait > 0:
+				self.cond.wait(wait)
+			results = self.results
+			self.results = []
+			return results
+		finally:
+			self.cond.release()
+
+class SessionThread(Thread):
+	"""
+	Links the items of streaming sessions that were waiting for other
+	requests' downloads, and drops sessions that are no longer polled
+	"""
+	def __init__(self, cache):
+		Thread.__init__(self)
+		self.log = log.get_log("sessions")
+		self.setDaemon(True)
+		self.cache = cache
+		
+	def run(self):
+		while True:
+			time.sleep(SESSION_POLL)
+			try:
+				self.cache.check_sessions()
+			except Exception, e:
+				self.log.exception(e)
+
+class CompactionThread(Thread):
+	"""
+	Periodically rewrites pack files that are mostly removed entries
+	"""
+	def __init__(self, cache, interval=COMPACT_INTERVAL):
+		Thread.__init__(self)
+		self.log = log.get_log("compaction")
+		self.setDaemon(True)
+		self.cache = cache
+		self.interval = interval
+		
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				self.cache.compact()
+			except Exception, e:
+				self.log.exception(e)
+
+class DeviceThread(Thread):
+	"""
+	Checks that the cache directories can still be written every
+	interval seconds, and stops using the ones that cannot
+	"""
+	def __init__(self, cache, interval=DEVICE_CHECK):
+		Thread.__init__(self)
+		self.log = log.get_log("devices")
+		self.setDaemon(True)
+		self.cache = cache
+		self.interval = interval
+		
+	def run(self):
+		while True:
+			try:
+				self.cache.check_devices()
+			except Exception, e:
+				self.log.exception(e)
+			time.sleep(self.interval)
+
 class CacheHandler(server.MuleRequestHandler):
+	def send_file_headers(self, size, mtime):
+		self.send_response(200)
+		self.send_header("Content-type", "application/octet-stream")
+		self.send_header("Content-Length", str(size))
+		self.send_header("Last-Modified", self.date_time_string(mtime))
+		self.end_headers()
+		
 	def do_GET(self):
+		if self.path == '/metrics':
+			server.MuleRequestHandler.do_GET(self)
+			return
+		cache = self.server.cache
+		# /UUID for the first cache directory, /DEVICE/UUID for the others
 		head, uuid = os.path.split(self.path)
-		path = self.server.cache.get_cfn(uuid)
-		f = None
 		try:
-			f = open(path, 'rb')
-			fs = os.fstat(f.fileno())
-			self.send_response(200)
-			self.send_header("Content-type", "application/octet-stream")
-			self.send_header("Content-Length", str(fs[6]))
-			self.send_header("Last-Modified", 
-							 self.date_time_string(fs.st_mtime))
-			self.end_headers()
-			copyobj(f, self.wfile)
-		except IOError:
+			device = int(head.strip('/') or 0)
+		except ValueError:
+			device = -1
+		if device < 0 or device >= len(cache.devices):
 			self.send_error(404, "File not found")
+			return
+		dev = cache.devices[device]
+		f = None
+		sp = trace.span(self.headers.get(trace.HEADER), 'serve',
+						uuid=uuid, peer=self.client_address[0])
+		try:
+			with sp:
+				try:
+					data, f, size, mtime = cache.read_hot(uuid, dev.index)
+					self.send_file_headers(size, mtime)
+					if data is not None:
+						self.wfile.write(data)
+						n = len(data)
+					else:
+						with dev.reading():
+							n = copyobj(f, self.wfile, size)
+					cache.st.bytes_out.labels(self.client_address[0]).increment(n)
+					sp.set('bytes', n)
+				except IOError, e:
+					cache.check_error(dev, e)
+					sp.set('status', 404)
+					self.send_error(404, "File not found")
 		finally:
 			if f: f.close()
 		
 class Cache(object):
-	def __init__(self, rls_host, cache_dir, threads, hostname=fqdn()):
+	def __init__(self, rls_host, cache_dirs, threads, hostname=fqdn(),
+				 port=CACHE_PORT, db_path=None, rack=DEFAULT_RACK,
+				 lease=DEFAULT_LEASE, hot_size=HOT_SIZE, hot_max=HOT_MAX,
+				 pack_max=PACK_MAX, max_downloads=MAX_DOWNLOADS,
+				 max_inflight=MAX_INFLIGHT, min_free=MIN_FREE):
 		self.log = log.get_log("cache")
+		# Per-request messages, sampled so busy servers are not slowed down
+		self.requests = log.get_log("cache requests", sampled=True)
 		self.rls_host = rls_host
-		self.cache_dir = cache_dir
+		# New files are spread over the cache directories. Packs, and 
+		# files cached before there were several, are in the first.
+		if isinstance(cache_dirs, basestring):
+			cache_dirs = cache_dirs.split(",")
+		self.devices = [Device(i, d, DEVICE_DOWNLOADS, DEVICE_SERVES) 
+						for i, d in enumerate(cache_dirs)]
+		self.devices_lock = Lock()
+		self.cache_dir = cache_dirs[0]
 		self.hostname = hostname
-		self.st = Statistics()
-		self.server = server.MuleServer('', CACHE_PORT,
+		# Leases and registrations are owned by host:port so that
+		# several caches can run on one host
+		self.owner = "%s:%s" % (hostname, port)
+		self.rack = rack
+		self.lease = lease
+		self.port = port
+		self.db_path = db_path
+		self.db = None
+		self.hot = hot.HotTier(hot_size, hot_max)
+		self.pack_max = pack_max
+		self.packs = None
+		if pack_max > 0:
+			self.packs = pack.PackStore(os.path.join(self.cache_dir, "packs"), PACK_SIZE)
+		self.server = server.MuleServer('', port,
 		                                requestHandler=CacheHandler)
 		self.server.cache = self
-		self.lock = Lock()
 		self.queue = Queue()
+		self.admission = admission.Admission(self.cache_dir, max_downloads,
+			max_inflight, min_free, RETRY_AFTER)
+		self.sessions = {}
+		self.sessions_lock = Lock()
+		self.threads = []
+		self.reset_statistics()
 		for i in range(0, threads):
 			t = DownloadThread(self)
+			self.threads.append(t)
 			t.start()
+	
+	def reset_statistics(self):
+		"""
+		Start collecting a new set of statistics
+		"""
+		st = Statistics()
+		st.registry.gauge("mule_cache_queue_depth",
+			"Downloads waiting for a thread", self.queue.qsize)
+		st.registry.gauge("mule_cache_active_downloads",
+			"Download threads that are busy",
+			lambda: len([t for t in self.threads if t.busy]))
+		st.registry.gauge("mule_cache_inflight_bytes",
+			"Bytes reserved by running downloads", 
+			lambda: self.admission.bytes)
+		st.registry.gauge("mule_cache_failed_devices",
+			"Cache directories that have failed",
+			lambda: len([d for d in self.devices if d.failed]))
+		st.registry.gauge("mule_cache_hot_bytes",
+			"Bytes of files held in the hot tier", lambda: self.hot.bytes)
+		st.registry.counter_function("mule_cache_hot_hits_total",
+			"Requests served from the hot tier", lambda: self.hot.hits)
+		st.registry.counter_function("mule_cache_hot_misses_total",
+			"Requests for files not in the hot tier", lambda: self.hot.misses)
+		if self.db is not None:
+			self.db.register_metrics(st.registry)
+		self.st = st
+		self.server.metrics = st.registry
 					
 	def stop(self, signum=None, frame=None):
 		self.log.info("Stopping cache...")
@@ -224,14 +535,28 @@ class Cache(object):
 	def run(self):
 		try:
 			self.log.info("Starting cache...")
-			self.db = db.CacheDatabase()
+			self.db = db.CacheDatabase(self.db_path)
+			self.db.register_metrics(self.st.registry)
+			# Directories marked as failed stay out of use until the
+			# marker is removed
+			for dev in self.devices:
+				if dev.quarantined():
+					self.fail_device(dev, "marked as failed")
 			signal.signal(signal.SIGTERM, self.stop)
 			self.server.register_function(self.get)
 			self.server.register_function(self.multiget)
+			self.server.register_function(self.hits)
+			self.server.register_function(self.stream_open)
+			self.server.register_function(self.stream_submit)
+			self.server.register_function(self.stream_poll)
+			self.server.register_function(self.stream_close)
+			self.server.register_function(self.stream_put)
 			self.server.register_function(self.put)
 			self.server.register_function(self.multiput)
 			self.server.register_function(self.remove)
 			self.server.register_function(self.list)
+			self.server.register_function(self.list_page)
+			self.server.register_function(self.rls_list_page)
 			self.server.register_function(self.rls_delete)
 			self.server.register_function(self.rls_add)
 			self.server.register_function(self.rls_lookup)
@@ -239,6 +564,13 @@ class Cache(object):
 			self.server.register_function(self.stats)
 			self.server.register_function(self.rls_clear)
 			self.server.register_function(self.clear)
+			self.server.register_function(self.compact)
+			SessionThread(self).start()
+			DeviceThread(self).start()
+			if self.lease > 0:
+				HeartbeatThread(self).start()
+			if self.packs is not None:
+				CompactionThread(self).start()
 			self.server.serve_forever()
 		except KeyboardInterrupt:
 			self.stop()
@@ -247,76 +579,309 @@ class Cache(object):
 		"""
 		Generate a unique ID for lfn
 		"""
-		return hashlib.sha1(lfn).hexdigest()
+		return local.get_uuid(lfn)
 		
-	def get_cfn(self, uuid):
+	def get_cfn(self, uuid, device=0):
 		"""
 		Generate a path for a given uuid in the cache
 		"""
-		l1 = uuid[0:2]
-		l2 = uuid[2:4]
-		return os.path.join(self.cache_dir, l1, l2, uuid)
+		return local.get_cfn(self.devices[device].root, uuid)
 		
-	def get_pfn(self, uuid):
+	def get_pfn(self, uuid, device=0):
 		"""
 		Get a pfn for the given uuid
 		"""
-		return "http://%s:%s/%s" % (self.hostname, CACHE_PORT, uuid)
+		if device == 0:
+			return "http://%s:%s/%s" % (self.hostname, self.port, uuid)
+		return "http://%s:%s/%d/%s" % (self.hostname, self.port, device, uuid)
+	
+	def get_device(self, lfn):
+		"""
+		Return the index of the cache directory holding lfn
+		"""
+		if len(self.devices) == 1:
+			return 0
+		rec = self.db.get(lfn)
+		if rec is None:
+			return 0
+		return rec.get('device', 0)
+	
+	def get_attrs(self, lfn, device=None):
+		"""
+		Get the RLS attributes for a cached copy of lfn
+		"""
+		attrs = { 'cache': True, 'host': self.hostname, 'owner': self.owner }
+		if self.rack:
+			attrs['rack'] = self.rack
+		size = self.cached_size(lfn, device)
+		if size is not None:
+			# XML-RPC ints are limited to 32 bits
+			attrs['size'] = float(size)
+		return attrs
+	
+	def get_hint(self):
+		"""
+		Get the locality hint used to rank PFNs from the RLS
+		"""
+		return { 'host': self.hostname, 'rack': self.rack }
+		
+	def cached_size(self, lfn, device=None):
+		"""
+		Return the size of the cached copy of lfn, or None
+		"""
+		uuid = self.get_uuid(lfn)
+		loc = self.pack_location(uuid)
+		if loc is not None:
+			return loc['size']
+		if device is None:
+			device = self.get_device(lfn)
+		try:
+			return os.path.getsize(self.get_cfn(uuid, device))
+		except OSError:
+			return None
+	
+	def pack_location(self, uuid):
+		"""
+		Return the location of uuid if it is stored in a pack, or None
+		"""
+		if self.packs is None:
+			return None
+		return self.db.pack_get(uuid)
+	
+	def open_cached(self, uuid, device=0):
+		"""
+		Open the cached copy of uuid. Returns (f, size, mtime) where f
+		is positioned at the start of the file, which is size bytes long.
+		Raises IOError if uuid is not cached.
+		"""
+		loc = self.pack_location(uuid)
+		if loc is None:
+			f = open(self.get_cfn(uuid, device), 'rb')
+			fs = os.fstat(f.fileno())
+			return (f, fs.st_size, fs.st_mtime)
+		try:
+			f = self.packs.open(loc['pack'], loc['offset'])
+		except IOError:
+			# The pack may have been compacted since we looked it up
+			loc = self.pack_location(uuid)
+			if loc is None:
+				raise IOError(errno.ENOENT, "%s is not cached" % uuid)
+			f = self.packs.open(loc['pack'], loc['offset'])
+		return (f, loc['size'], loc['mtime'])
+	
+	def store(self, uuid, part, device=0):
+		"""
+		Move the complete file part into the cache as uuid: into a pack
+		if it is small enough, otherwise to its cfn on device. Clients 
+		serve hits themselves by looking for the cfn, so a file must not
+		appear there until it is complete or disappear from there until
+		it is removed. Returns the device the file ended up on; packs 
+		are on the first.
+		"""
+		fs = os.stat(part)
+		if self.packs is not None and fs.st_size <= self.pack_max:
+			p, offset, size = self.packs.append_file(part)
+			try:
+				self.db.pack_put(uuid, {'pack': p, 'offset': offset, 
+										'size': size, 'mtime': fs.st_mtime})
+			finally:
+				self.packs.done(p)
+			os.unlink(part)
+			return 0
+		os.rename(part, self.get_cfn(uuid, device))
+		return device
+	
+	def copy_in(self, path, uuid, device=0):
+		"""
+		Copy path into the cache as uuid. Returns the device it is on.
+		"""
+		part = self.get_cfn(uuid, device) + local.PART
+		try:
+			copy(path, part)
+			return self.store(uuid, part, device)
+		except:
+			if os.path.exists(part):
+				os.unlink(part)
+			raise
+	
+	def compact(self, threshold=None):
+		"""
+		Rewrite the live entries of packs that are less than threshold
+		(default COMPACT_THRESHOLD) live into the current pack, and 
+		remove the old packs. Returns the number of bytes reclaimed.
+		"""
+		if self.packs is None:
+			return 0.0
+		if threshold is None:
+			threshold = COMPACT_THRESHOLD
+		# Packs before the current one get no new entries, so the index
+		# read after this is complete for those of them that have no 
+		# entries still being indexed
+		current = self.packs.current
+		busy = self.packs.busy()
+		live = {}
+		entries = {}
+		for uuid, loc in self.db.pack_list():
+			live[loc['pack']] = live.get(loc['pack'], 0) + loc['size']
+			entries.setdefault(loc['pack'], []).append((uuid, loc))
+		reclaimed = 0
+		for p in self.packs.packs():
+			if p >= current or p in busy:
+				continue
+			size = self.packs.size(p)
+			if size == 0 or live.get(p, 0) >= threshold * size:
+				continue
+			self.log.info("Compacting pack %d: %d of %d bytes live",
+						  p, live.get(p, 0), size)
+			for uuid, loc in entries.get(p, []):
+				data = self.packs.read(p, loc['offset'], loc['size'])
+				np, offset, n = self.packs.append_data(data)
+				new = {'pack': np, 'offset': offset, 
+					   'size': n, 'mtime': loc['mtime']}
+				# Skip entries that were removed while we copied them
+				try:
+					self.db.pack_move(uuid, loc, new)
+				finally:
+					self.packs.done(np)
+			reclaimed += self.packs.size(p) - live.get(p, 0)
+			self.packs.remove(p)
+		# XML-RPC ints are limited to 32 bits
+		return float(reclaimed)
+	
+	def recorded(self, op, lfns, function, *args):
+		"""
+		Call function(outcomes, *args) and, if recording is enabled,
+		record the call along with the outcome function stored in 
+		outcomes for each of lfns
+		"""
+		if replay.RECORDER is None:
+			return function({}, *args)
+		start = time.time()
+		outcomes = {}
+		error = None
+		try:
+			return function(outcomes, *args)
+		except Exception, e:
+			error = str(e)
+			raise
+		finally:
+			items = [[lfn, self.cached_size(lfn), outcomes.get(lfn, 'fail')]
+				for lfn in lfns]
+			replay.record(op, start, items, error)
 		
-	def get(self, lfn, path, symlink=True):
+	def get(self, lfn, path, symlink=True, trace_id=None):
 		"""
 		Get lfn and store it at path
 		"""
-		self.log.debug("get %s %s" % (lfn, path))
-		self.multiget([[lfn, path]], symlink)
+		self.requests.debug("get %s %s", lfn, path)
+		with trace.span(trace_id, 'get', lfns=1):
+			self.recorded('get', [lfn], self._multiget, 
+						  [[lfn, path]], symlink, trace_id)
 	
-	def multiget(self, pairs, symlink=True):
+	def multiget(self, pairs, symlink=True, trace_id=None):
 		"""
 		For each [lfn, path] pair get lfn and store at path
 		"""
+		with trace.span(trace_id, 'multiget', lfns=len(pairs)):
+			self.recorded('multiget', [p[0] for p in pairs], self._multiget,
+						  pairs, symlink, trace_id)
+	
+	def hits(self, lfns, trace_id=None):
+		"""
+		Count gets of lfns that the client served itself from the cache
+		directory, as if they had been hits here
+		"""
+		self.requests.debug("hits %d", len(lfns))
+		with trace.span(trace_id, 'local_hits', lfns=len(lfns)):
+			self.st.gets.increment(len(lfns))
+			self.st.hits.increment(len(lfns))
+			for lfn in lfns:
+				self.hot.touch(self.get_uuid(lfn))
+			if replay.RECORDER is not None:
+				replay.record('multiget', time.time(),
+					[[lfn, self.cached_size(lfn), 'hit'] for lfn in lfns])
+	
+	def categorise(self, pairs):
+		"""
+		Sort [lfn, path] pairs into those that were created (and need
+		to be downloaded), those that are ready, and those that some
+		other request is downloading
+		"""
+		self.st.gets.increment(len(pairs))
+		with self.st.phase('db_lookup'):
+			status = self.db.classify([lfn for lfn, path in pairs])
+		
 		created = []
 		ready = []
 		unready = []
+		claimed = set()
 		for lfn, path in pairs:
-			self.st.gets.increment()
-			rec = self.db.get(lfn)
-			if rec is None:
-				self.lock.acquire()
-				try:
-					rec = self.db.get(lfn)
-					if rec is None:
-						self.db.put(lfn)
-						created.append((lfn,path))
-						self.st.misses.increment()
-					else:
-						unready.append((lfn,path))
-						self.st.near_misses.increment()
-				finally:
-					self.lock.release()
-			elif rec['status'] == 'ready':
+			s = status[lfn]
+			if s == 'created' and lfn not in claimed:
+				claimed.add(lfn)
+				created.append((lfn,path))
+				self.st.misses.increment()
+			elif s == 'ready':
 				ready.append((lfn,path))
 				self.st.hits.increment()
-			elif rec['status'] == 'unready':
+			elif s in ('unready', 'created'):
+				# created is for an lfn that appears twice in pairs
 				unready.append((lfn,path))
 				self.st.near_misses.increment()
-			elif rec['status'] == 'failed':
+			elif s == 'failed':
 				self.st.failures.increment()
 				raise Exception("Unable to get %s: failed" % lfn)
-			else:
-				raise Exception("Unrecognized status: %s" % rec['status'])
+			elif s is not None:
+				raise Exception("Unrecognized status: %s" % s)
+		return created, ready, unready
+	
+	def admit(self, lfns, retry=False):
+		"""
+		Raise Busy if the cache is at its admission limits and some of
+		lfns would have to be downloaded. Requests that only hit or wait
+		for downloads already running are always let in. A request is
+		admitted whole, so a large one can take the cache over its limits.
+		"""
+		retry_after = self.admission.busy()
+		if retry_after is None:
+			return
+		recs = self.db.get_many(lfns)
+		for rec in recs.values():
+			if rec is None or (retry and rec['status'] == 'failed'):
+				self.st.rejected.increment(len(lfns))
+				self.requests.info("Busy, asking to retry after %.1fs", retry_after)
+				raise Busy(retry_after)
+	
+	def enqueue(self, req):
+		self.admission.queued()
+		self.queue.put(req)
+	
+	def _multiget(self, outcomes, pairs, symlink, trace_id):
+		self.admit([lfn for lfn, path in pairs])
+		with trace.span(trace_id, 'categorise') as sp:
+			created, ready, unready = self.categorise(pairs)
+			sp.set('hits', len(ready))
+			sp.set('misses', len(created))
+			sp.set('near_misses', len(unready))
+		for lfns, outcome in [(created, 'miss'), (ready, 'hit'), (unready, 'near')]:
+			for lfn, path in lfns:
+				outcomes[lfn] = outcome
 		
 		conn = rls.connect(self.rls_host)
 		
 		if len(created) > 0:
 			requests = []
-			mappings = conn.multilookup([i[0] for i in created])
+			with self.st.phase('rls_lookup'):
+				with trace.span(trace_id, 'multilookup', lfns=len(created)):
+					mappings = conn.multilookup([i[0] for i in created], trace_id,
+												self.get_hint())
 			for lfn, path in created:
-				req = DownloadRequest(lfn, mappings[lfn])
-				self.queue.put(req)
+				req = DownloadRequest(lfn, mappings[lfn], trace_id)
+				self.enqueue(req)
 				requests.append(req)
 		
 		for lfn, path in ready:
-			self.get_cached(lfn, path, symlink)
+			self.get_cached(lfn, path, symlink, trace_id)
 		
 		if len(created) > 0:	
 			mappings = []
@@ -324,11 +889,12 @@ class Cache(object):
 				req.event.wait()
 				if req.exception is None:
 					uuid = self.get_uuid(req.lfn)
-					pfn = self.get_pfn(uuid)
-					mappings.append([req.lfn, pfn])
+					pfn = self.get_pfn(uuid, req.device)
+					mappings.append([req.lfn, pfn, 
+									 self.get_attrs(req.lfn, req.device)])
 			
 			if len(mappings) > 0:
-				conn.multiadd(mappings)
+				conn.multiadd(mappings, trace_id)
 				
 			for req in requests:
 				if req.exception:
@@ -340,12 +906,14 @@ class Cache(object):
 		while len(unready) > 0:
 			u = unready[:]
 			unready = []
+			recs = self.db.get_many([lfn for lfn, path in u])
 			for lfn, path in u:
-				rec = self.db.get(lfn)
+				rec = recs[lfn]
 				if rec is None:
 					raise Exception("Record disappeared for %s" % lfn)
 				elif rec['status'] == 'ready':
-					self.get_cached(lfn, path, symlink)
+					self.get_cached(lfn, path, symlink, trace_id, 
+									rec.get('device', 0))
 				elif rec['status'] == 'failed':
 					self.st.failures.increment()
 					raise Exception("Unable to get %s: failed" % lfn)
@@ -354,22 +922,226 @@ class Cache(object):
 			if len(unready) > 0:
 				time.sleep(5)
 	
-	def get_cached(self, lfn, path, symlink=True):
-		uuid = self.get_uuid(lfn)
-		cfn = self.get_cfn(uuid)
-		if not os.path.exists(cfn):
-			raise Exception("%s was not found in cache" % (lfn))
-		# This is to support nested directories inside working dirs
-		ensure_path(os.path.dirname(path))
-		if symlink:
-			os.symlink(cfn, path)
-		else:
-			copy(cfn, path)
+	def stream_open(self, symlink=True, trace_id=None):
+		"""
+		Start a streaming multiget and return its session id
+		"""
+		sid = trace.new_id()
+		self.sessions_lock.acquire()
+		try:
+			self.sessions[sid] = Session(symlink, trace_id)
+		finally:
+			self.sessions_lock.release()
+		return sid
+	
+	def get_session(self, sid):
+		self.sessions_lock.acquire()
+		try:
+			session = self.sessions.get(sid)
+		finally:
+			self.sessions_lock.release()
+		if session is None:
+			raise Exception("Unknown session %s" % sid)
+		return session
+	
+	def stream_submit(self, sid, pairs, retry=False):
+		"""
+		Start getting a batch of [lfn, path] pairs in session sid, and
+		return without waiting for them. The results are collected with
+		stream_poll. A failed item does not affect the others. If retry
+		is True then lfns whose download failed earlier are downloaded 
+		again.
+		"""
+		session = self.get_session(sid)
+		trace_id = session.trace_id
+		start = time.time()
+		self.admit([lfn for lfn, path in pairs], retry)
+		self.st.gets.increment(len(pairs))
+		with trace.span(trace_id, 'stream_submit', lfns=len(pairs)):
+			with self.st.phase('db_lookup'):
+				status = self.db.classify([lfn for lfn, path in pairs], 
+										  retry, True)
+			created = []
+			claimed = set()
+			for lfn, path in pairs:
+				s = status[lfn]
+				if s == 'created' and lfn not in claimed:
+					claimed.add(lfn)
+					created.append((lfn, path))
+					self.st.misses.increment()
+				elif s == 'ready':
+					self.st.hits.increment()
+					self.link(session, lfn, path, start)
+				elif s in ('unready', 'created'):
+					self.st.near_misses.increment()
+					session.wait_for(lfn, path, start)
+				else:
+					self.st.failures.increment()
+					session.finish(lfn, path, start, "download failed earlier")
+			
+			if len(created) == 0:
+				return len(pairs)
+			try:
+				conn = rls.connect(self.rls_host)
+				with self.st.phase('rls_lookup'):
+					with trace.span(trace_id, 'multilookup', lfns=len(created)):
+						mappings = conn.multilookup([i[0] for i in created], 
+													trace_id, self.get_hint())
+			except Exception, e:
+				# Fail the claims, so that they are claimed again on retry
+				for lfn, path in created:
+					self.db.update(lfn, 'failed')
+					session.finish(lfn, path, start, str(e))
+				return len(pairs)
+			for lfn, path in created:
+				def done(req, path=path):
+					self.downloaded(session, req, path, start)
+				self.enqueue(DownloadRequest(lfn, mappings[lfn], trace_id, done))
+		return len(pairs)
+	
+	def downloaded(self, session, req, path, start):
+		"""
+		Finish a streaming item once its download is done
+		"""
+		if req.exception is not None:
+			self.st.failures.increment()
+			session.finish(req.lfn, path, start, str(req.exception))
+			return
+		try:
+			pfn = self.get_pfn(self.get_uuid(req.lfn), req.device)
+			conn = rls.connect(self.rls_host)
+			conn.add(req.lfn, pfn, session.trace_id, 
+					 self.get_attrs(req.lfn, req.device))
+		except Exception, e:
+			# The file is cached; it is registered by the next heartbeat
+			self.log.exception(e)
+		self.link(session, req.lfn, path, start, req.device)
+	
+	def link(self, session, lfn, path, start, device=None):
+		try:
+			self.get_cached(lfn, path, session.symlink, session.trace_id,
+							device)
+		except Exception, e:
+			self.st.failures.increment()
+			session.finish(lfn, path, start, str(e))
+			return
+		session.finish(lfn, path, start)
+	
+	def check_sessions(self):
+		"""
+		Link or fail the waiting items of all sessions, and drop the 
+		sessions that have not been polled for SESSION_TTL seconds
+		"""
+		self.sessions_lock.acquire()
+		try:
+			now = time.time()
+			for sid, session in self.sessions.items():
+				if now - session.touched > SESSION_TTL:
+					self.log.warning("Dropping idle session %s", sid)
+					del self.sessions[sid]
+			sessions = self.sessions.values()
+		finally:
+			self.sessions_lock.release()
+		for session in sessions:
+			waiting = session.take_waiting()
+			if len(waiting) == 0:
+				continue
+			recs = self.db.get_many([lfn for lfn, path, start in waiting])
+			for lfn, path, start in waiting:
+				rec = recs[lfn]
+				if rec is None:
+					session.finish(lfn, path, start, "record disappeared")
+				elif rec['status'] == 'ready':
+					self.link(session, lfn, path, start, rec.get('device', 0))
+				elif rec['status'] == 'failed':
+					self.st.failures.increment()
+					session.finish(lfn, path, start, "download failed")
+				else:
+					session.wait_for(lfn, path, start)
+	
+	def stream_poll(self, sid, wait=0):
+		"""
+		Return the results of session sid that have arrived since the
+		last poll, as a list of [lfn, path, status, reason, seconds]
+		where status is 'ok' or 'failed'. Waits up to wait seconds for
+		a result if there are none.
+		"""
+		session = self.get_session(sid)
+		return session.take(min(wait, MAX_POLL_WAIT))
+	
+	def stream_close(self, sid):
+		"""
+		End session sid. Items still in progress are finished, but 
+		their results are discarded.
+		"""
+		self.sessions_lock.acquire()
+		try:
+			self.sessions.pop(sid, None)
+		finally:
+			self.sessions_lock.release()
+	
+	def get_cached(self, lfn, path, symlink=True, trace_id=None, device=None):
+		with self.st.phase('link'):
+			with trace.span(trace_id, 'get_cached', lfn=lfn):
+				uuid = self.get_uuid(lfn)
+				if device is None:
+					device = self.get_device(lfn)
+				cfn = self.get_cfn(uuid, device)
+				packed = self.pack_location(uuid) is not None
+				if not packed and not os.path.exists(cfn):
+					raise Exception("%s was not found in cache" % (lfn))
+				# This is to support nested directories inside working dirs
+				ensure_path(os.path.dirname(path))
+				if symlink and not packed:
+					os.symlink(cfn, path)
+				else:
+					# Packed files cannot be linked, so they are copied
+					data, f, size, mtime = self.read_hot(uuid, device)
+					try:
+						g = open(path, 'wb')
+						try:
+							if data is not None:
+								# Small file: write it from memory
+								g.write(data)
+							else:
+								copyobj(f, g, size)
+						finally:
+							g.close()
+					finally:
+						if f: f.close()
+	
+	def read_hot(self, uuid, device=0):
+		"""
+		Return (data, f, size, mtime) for a cached file. For a small
+		file data is its contents, from the hot tier if it is resident,
+		otherwise read from disk and offered to the hot tier. For a
+		file too big for the hot tier, or if the tier is disabled, data
+		is None and f is the open file, which the caller must close.
+		"""
+		if self.hot.enabled():
+			entry = self.hot.get(uuid)
+			if entry is not None:
+				data, mtime = entry
+				return (data, None, len(data), mtime)
+		generation = self.hot.generation(uuid)
+		f, size, mtime = self.open_cached(uuid, device)
+		if not self.hot.enabled() or size > self.hot.max_size:
+			return (None, f, size, mtime)
+		try:
+			data = f.read(size)
+		finally:
+			f.close()
+		# Not if the file was removed while it was read
+		self.hot.admit(uuid, data, mtime, generation)
+		return (data, None, size, mtime)
 			
-	def fetch(self, lfn, pfns):
-		# Add some randomness so not all files are fetched
-		# from the same server.
-		random.shuffle(pfns)
+	def fetch(self, lfn, pfns, trace_id=None):
+		"""
+		Download lfn into the cache from the first of pfns that works,
+		and return the device it was stored on
+		"""
+		# The RLS returns pfns nearest first, with random
+		# ordering among equally near copies.
 		
 		# Also try the lfn if it is a URL
 		for protocol in ['http://','https://','ftp://']:
@@ -384,97 +1156,203 @@ class Cache(object):
 			raise Exception("%s not found in RLS" % lfn)
 		
 		# Create new name
+		dev = self.choose_device()
 		uuid = self.get_uuid(lfn)
-		cfn = self.get_cfn(uuid)
+		cfn = self.get_cfn(uuid, dev.index)
 		if os.path.exists(cfn):
-			self.log.warning("Duplicate uuid detected: %s" % uuid)
-			
-		# Create dir if needed
-		d = os.path.dirname(cfn)
-		ensure_path(d)
-			
-		# Download the file
-		success = False
-		for p in pfns:
-			try:
-				download(p, cfn)
-				success = True
-				break
-			except Exception, e:
-				self.log.exception(e)
+			self.log.warning("Duplicate uuid detected: %s", uuid)
 		
-		if not success:
-			raise Exception('Unable to get %s: all pfns failed' % lfn)
+		# Download the file. It only gets its real name once it is
+		# complete, because clients look for it there.
+		part = cfn + local.PART
+		device = None
+		failure = 'all pfns failed'
+		with dev.writing():
+			for p in pfns:
+				try:
+					# Create dir if needed
+					ensure_path(os.path.dirname(cfn))
+					with self.st.phase('download'):
+						with trace.span(trace_id, 'fetch', lfn=lfn, pfn=p) as sp:
+							n = download(p, part, trace_id, self.admission, dev.root)
+							sp.set('bytes', n)
+					device = self.store(uuid, part, dev.index)
+					self.st.bytes_in.labels(urlparse(p)[1] or 'local').increment(n)
+					break
+				except admission.NoSpace, e:
+					# Other pfns are the same file, so they do not fit either
+					self.log.error(str(e))
+					failure = str(e)
+					break
+				except Exception, e:
+					self.log.exception(e)
+					if self.check_error(dev, e):
+						failure = str(e)
+						break
+		
+		if device is None:
+			try:
+				if os.path.exists(part):
+					os.unlink(part)
+			except OSError:
+				pass
+			raise Exception('Unable to get %s: %s' % (lfn, failure))
+		return device
 		
-	def put(self, path, lfn, smart_move=True):
+	def put(self, path, lfn, smart_move=True, trace_id=None):
 		"""
 		Put path into cache as lfn
 		"""
-		self.log.debug("put %s %s" % (path, lfn))
-		self.multiput([[path, lfn]], smart_move)
+		self.requests.debug("put %s %s", path, lfn)
+		with trace.span(trace_id, 'put', lfns=1):
+			self.recorded('put', [lfn], self._multiput,
+						  [[path, lfn]], smart_move, trace_id)
 		
-	def multiput(self, pairs, smart_move=True):
+	def multiput(self, pairs, smart_move=True, trace_id=None):
 		"""
 		For all [path, lfn] pairs put path into the cache as lfn
 		"""
-		# Make sure the files exist
+		with trace.span(trace_id, 'multiput', lfns=len(pairs)):
+			self.recorded('multiput', [p[1] for p in pairs], self._multiput,
+						  pairs, smart_move, trace_id)
+	
+	def stream_put(self, pairs, smart_move=True, trace_id=None):
+		"""
+		Like multiput, but an item that fails does not stop the others.
+		Returns a list of [path, lfn, status, reason, seconds] where 
+		status is 'ok', 'dup' or 'failed'.
+		"""
+		results = []
+		with trace.span(trace_id, 'stream_put', lfns=len(pairs)):
+			self.recorded('multiput', [p[1] for p in pairs], self._multiput,
+						  pairs, smart_move, trace_id, results)
+		return results
+	
+	def _multiput(self, outcomes, pairs, smart_move, trace_id, results=None):
+		# Make sure the files exist. If results is a list then failures
+		# are reported there instead of raised.
+		present = []
 		for path, lfn in pairs:
-			if not os.path.exists(path):
-				raise Exception("%s does not exist", path)
+			if os.path.exists(path):
+				present.append((path, lfn))
+			elif results is None:
+				raise Exception("%s does not exist" % path)
+			else:
+				results.append([path, lfn, 'failed', "%s does not exist" % path, 0.0])
+		pairs = present
+		
+		# Create entries in the cache db for all the lfns that
+		# are not already cached, in one transaction
+		claimed = self.db.claim([lfn for path, lfn in pairs])
 		
 		# Add them to the cache
 		mappings = []
-		for path, lfn in pairs:
-			self.st.puts.increment()
-			
-			# If its already in cache, then skip it
-			if self.db.get(lfn) is not None:
-				self.log.warning("%s already cached" % lfn)
-				self.st.duplicates.increment()
-				continue
-		
-			# Create new names
-			uuid = self.get_uuid(lfn)
-			cfn = self.get_cfn(uuid)
-			pfn = self.get_pfn(uuid)
-			if os.path.exists(cfn):
-				self.log.warning("Possible duplicate uuid detected: %s" % uuid)
-		
-			# Create dir if needed
-			d = os.path.dirname(cfn)
-			ensure_path(d)
-		
-			# Create an entry in the cache db
-			self.db.put(lfn)
-		
-			# Move path to cache
-			if smart_move:
+		# device -> lfns stored on it
+		done = {}
+		try:
+			for path, lfn in pairs:
+				start = time.time()
+				self.st.puts.increment()
+				
+				# If its already in cache, then skip it
+				if lfn not in claimed:
+					self.log.warning("%s already cached", lfn)
+					self.st.duplicates.increment()
+					outcomes[lfn] = 'dup'
+					if results is not None:
+						results.append([path, lfn, 'dup', None, 0.0])
+					continue
+				
 				try:
-					os.rename(path, cfn)
-					os.symlink(cfn, path)
-				except OSError:
-					#Looks like we can't rename, probably because the files are on different volumes
-					self.log.warning("Simple rename failed, falling back to copy")
-					copy(path, cfn)
-			else:
-				copy(path, cfn)
-		
+					mapping, device = self.put_one(path, lfn, smart_move)
+					mappings.append(mapping)
+				except Exception, e:
+					if results is None:
+						raise
+					self.log.exception(e)
+					results.append([path, lfn, 'failed', str(e), time.time() - start])
+					continue
+			
+				claimed.remove(lfn)
+				done.setdefault(device, []).append(lfn)
+				outcomes[lfn] = 'put'
+				if results is not None:
+					results.append([path, lfn, 'ok', None, time.time() - start])
+		finally:
+			# Release the lfns that were not stored
+			for lfn in claimed:
+				self.db.remove(lfn)
+			
 			# Update the cache db
-			self.db.update(lfn, 'ready')
-		
-			mappings.append([lfn, pfn])
+			for device, lfns in done.items():
+				self.db.update_many(lfns, 'ready', device)
 		
 		# Register lfn->pfn mappings
 		conn = rls.connect(self.rls_host)
-		conn.multiadd(mappings)
+		with trace.span(trace_id, 'multiadd', lfns=len(mappings)):
+			try:
+				conn.multiadd(mappings, trace_id)
+			except Exception, e:
+				if results is None:
+					raise
+				# The files are cached; the next heartbeat registers them
+				self.log.exception(e)
+	
+	def put_one(self, path, lfn, smart_move):
+		"""
+		Move or copy path into the cache as lfn, which must have been
+		claimed. Returns the RLS mapping for it and the device it was
+		stored on.
+		"""
+		# Create new names
+		dev = self.choose_device()
+		device = dev.index
+		uuid = self.get_uuid(lfn)
+		cfn = self.get_cfn(uuid, device)
+		if os.path.exists(cfn):
+			self.log.warning("Possible duplicate uuid detected: %s", uuid)
+	
+		with dev.writing():
+			try:
+				# Create dir if needed
+				d = os.path.dirname(cfn)
+				ensure_path(d)
+			
+				# Small files go into a pack, which cannot be linked to,
+				# so they are copied and the original is left in place
+				if smart_move and self.packs is not None and \
+				   os.path.getsize(path) <= self.pack_max:
+					smart_move = False
+			
+				# Move path to cache
+				if smart_move:
+					try:
+						os.rename(path, cfn)
+						os.symlink(cfn, path)
+					except OSError:
+						#Looks like we can't rename, probably because the files are on different volumes
+						self.log.warning("Simple rename failed, falling back to copy")
+						device = self.copy_in(path, uuid, device)
+				else:
+					device = self.copy_in(path, uuid, device)
+			except (IOError, OSError), e:
+				self.check_error(dev, e)
+				raise
+		
+		pfn = self.get_pfn(uuid, device)
+		return [lfn, pfn, self.get_attrs(lfn, device)], device
 		
 	def remove(self, lfn, force=False):
 		"""
 		Remove lfn from cache
 		"""
-		self.log.debug("remove %s" % lfn)
+		self.requests.debug("remove %s", lfn)
+		self.recorded('remove', [lfn], self._remove, lfn, force)
+	
+	def _remove(self, outcomes, lfn, force):
 		rec = self.db.get(lfn)
 		if rec is None:
+			outcomes[lfn] = 'absent'
 			return
 			
 		if not force and rec['status'] != 'ready':
@@ -482,56 +1360,193 @@ class Cache(object):
 		
 		# Remove from database
 		self.db.remove(lfn)
+		outcomes[lfn] = 'removed'
 		
 		if rec['status'] == 'ready':
 			uuid = self.get_uuid(lfn)
+			device = rec.get('device', 0)
 			
 			# Remove RLS mapping
-			pfn = self.get_pfn(uuid)
+			pfn = self.get_pfn(uuid, device)
 			conn = rls.connect(self.rls_host)
 			conn.delete(lfn, pfn)
 
-			# Remove cached copy
-			cfn = self.get_cfn(uuid)
+			# Remove cached copy. The hot tier is invalidated last, so
+			# that a read that began before cannot admit it again
+			if self.packs is not None:
+				self.db.pack_delete(uuid)
+			cfn = self.get_cfn(uuid, device)
 			if os.path.isfile(cfn):
 				os.unlink(cfn)
+			self.hot.invalidate(uuid)
 		
+	def choose_device(self):
+		"""
+		Choose the device for a new file
+		"""
+		dev = place(self.devices)
+		if dev is None:
+			raise Exception("All cache directories have failed")
+		return dev
+	
+	def check_error(self, dev, e):
+		"""
+		Fail dev if e means that the device, rather than one file, is 
+		broken. Returns True if it does.
+		"""
+		if getattr(e, 'errno', None) not in DEVICE_ERRORS:
+			return False
+		self.fail_device(dev, str(e))
+		return True
+	
+	def check_devices(self):
+		"""
+		Fail the cache directories that can no longer be written, and
+		retry forgetting the files of failed ones
+		"""
+		for dev in self.devices:
+			if not dev.failed and not dev.check():
+				self.fail_device(dev, "cannot write to %s" % dev.root)
+			elif dev.failed and not dev.purged:
+				self.purge_device(dev)
+	
+	def fail_device(self, dev, reason):
+		"""
+		Stop using a failed cache directory, and forget the files on it.
+		The files on the other directories are not affected.
+		"""
+		self.devices_lock.acquire()
+		try:
+			first = not dev.failed
+			dev.failed = True
+		finally:
+			self.devices_lock.release()
+		if first:
+			self.log.error("Cache directory %s failed: %s", dev.root, reason)
+			# Before the records go, so clients do not link files that
+			# are about to be forgotten
+			if not dev.quarantine():
+				self.log.error("Unable to rename or mark %s: clients may still use its files", dev.root)
+		self.purge_device(dev)
+	
+	def purge_device(self, dev):
+		"""
+		Delete the mappings of the files on a failed device from the 
+		RLS, then remove their records, so that they are fetched from 
+		elsewhere. Every step can be repeated, so if one fails the 
+		device check tries again later. Returns True once it is done.
+		"""
+		if not dev.purge_lock.acquire(False):
+			# Another thread is purging it
+			return False
+		try:
+			if dev.purged:
+				return True
+			try:
+				n = 0
+				token = None
+				while True:
+					items, token = self.db.list_page(token, PURGE_BATCH)
+					mappings = []
+					for rec in items:
+						if rec['status'] != 'ready' or rec.get('device', 0) != dev.index:
+							continue
+						uuid = self.get_uuid(rec['lfn'])
+						self.hot.invalidate(uuid)
+						if self.packs is not None and dev.index == 0:
+							self.db.pack_delete(uuid)
+						mappings.append([rec['lfn'], self.get_pfn(uuid, dev.index)])
+					if len(mappings) > 0:
+						conn = rls.connect(self.rls_host)
+						conn.multidelete(mappings)
+					n += len(mappings)
+					if token is None:
+						break
+				self.db.remove_device(dev.index)
+			except Exception, e:
+				self.log.error("Unable to drop the files on %s, will retry: %s", dev.root, e)
+				return False
+			dev.purged = True
+			self.log.warning("Dropped %d files on %s", n, dev.root)
+			return True
+		finally:
+			dev.purge_lock.release()
+	
 	def list(self):
 		"""
 		List all cached files
 		"""
 		self.log.debug("list")
 		return self.db.list()
+	
+	def list_page(self, token=None, limit=1000, pattern=None):
+		"""
+		List one page of up to limit cached files whose LFNs match the
+		glob pattern, starting after token. Returns {'items': [...], 
+		'token': token} where token is None after the last page.
+		"""
+		self.requests.debug("list_page %s %s %s", token, limit, pattern)
+		limit = max(1, min(limit, MAX_PAGE))
+		items, token = self.db.list_page(token, limit, pattern)
+		return { 'items': items, 'token': token }
+	
+	def register(self):
+		"""
+		Replace this cache's mappings in the RLS with the files that
+		are ready in the cache, in one call
+		"""
+		mappings = []
+		for rec in self.db.list():
+			if rec['status'] == 'ready':
+				lfn = rec['lfn']
+				device = rec.get('device', 0)
+				if self.devices[device].failed:
+					# Its files are being forgotten
+					continue
+				pfn = self.get_pfn(self.get_uuid(lfn), device)
+				mappings.append([lfn, pfn, self.get_attrs(lfn, device)])
+		self.log.info("Registering %d files with RLS", len(mappings))
+		conn = rls.connect(self.rls_host)
+		conn.register(self.owner, mappings, self.lease)
 		
 	def rls_delete(self, lfn, pfn=None):
 		"""
 		Delete lfn->pfn mapping
 		"""
-		self.log.debug("delete %s %s" % (lfn, pfn))
+		self.requests.debug("delete %s %s", lfn, pfn)
 		conn = rls.connect(self.rls_host)
 		conn.delete(lfn, pfn)
 		
-	def rls_add(self, lfn, pfn):
+	def rls_add(self, lfn, pfn, attrs=None):
 		"""
 		Add lfn->pfn mapping to rls
 		"""
-		self.log.debug("add %s %s" % (lfn, pfn))
+		self.requests.debug("add %s %s", lfn, pfn)
 		conn = rls.connect(self.rls_host)
-		conn.add(lfn, pfn)
+		conn.add(lfn, pfn, None, attrs)
 		
 	def rls_lookup(self, lfn):
 		"""
-		Lookup RLS mappings for lfn
+		Lookup RLS mappings for lfn, nearest to this cache first
+		"""
+		self.requests.debug("lookup %s", lfn)
+		conn = rls.connect(self.rls_host)
+		return conn.lookup(lfn, None, self.get_hint())
+		
+	def rls_list_page(self, token=None, limit=1000, pattern=None):
+		"""
+		List one page of RLS mappings
 		"""
-		self.log.debug("lookup %s" % lfn)
 		conn = rls.connect(self.rls_host)
-		return conn.lookup(lfn)
+		return conn.list_page(token, limit, pattern)
 		
-	def get_bloom_filter(self, m, k):
+	def get_bloom_filter(self, m, k, fpr=None):
 		"""
-		Return a bloom filter containing all the lfns in the cache
+		Return a bloom filter containing all the lfns in the cache. If
+		fpr is given then k is chosen to match it and the filter is 
+		folded down from m bits to fit the number of lfns.
 		"""
-		return self.db.get_bloom_filter(m, k).tobase64()
+		return self.db.get_bloom_filter(m, k, fpr).encode()
 		
 	def stats(self):
 		"""
@@ -542,6 +1557,9 @@ class Cache(object):
 	def clear(self):
 		# Clear database
 		self.db.clear()
+		self.hot.clear()
+		if self.packs is not None:
+			self.packs.clear()
 		
 		# Remove files in cache
 		def remove_all(directory):
@@ -551,10 +1569,18 @@ class Cache(object):
 					remove_all(path)
 				else:
 					os.unlink(path)
-		remove_all(self.cache_dir)
+		for dev in self.devices:
+			if dev.failed:
+				dev.discard()
+			else:
+				remove_all(dev.root)
+		
+		# Drop our mappings from the RLS
+		if self.lease > 0:
+			self.register()
 		
 		# Clear stats
-		self.st = Statistics()
+		self.reset_statistics()
 		
 	def rls_clear(self):
 		self.log.debug("rls clear")
@@ -570,25 +1596,77 @@ def main():
 		default=DEFAULT_RLS, metavar="HOST",
 		help="RLS host [default: %default]")
 	parser.add_option("-d", "--dir", action="store", dest="cache_dir",
-		default=DEFAULT_DIR, metavar="DIR",
-		help="Cache directory [default: %default]")
+		default=DEFAULT_DIR, metavar="DIR[,DIR...]",
+		help="Cache directories, one per disk [default: %default]")
 	parser.add_option("-t", "--threads", action="store", dest="threads",
-		default=num_cpus(), metavar="N",
+		default=num_cpus(), type="int", metavar="N",
 		help="Number of download threads [default: %default]")
+	parser.add_option("-p", "--port", action="store", dest="port",
+		default=CACHE_PORT, type="int", metavar="PORT",
+		help="Port to listen on [default: %default]")
+	parser.add_option("-D", "--db", action="store", dest="db",
+		default=None, metavar="DIR",
+		help="Database directory [default: MULE_HOME/var/cache]")
+	parser.add_option("-l", "--log", action="store", dest="log",
+		default=None, metavar="FILE",
+		help="Log file [default: MULE_HOME/var/cache.log]")
+	parser.add_option("-n", "--hostname", action="store", dest="hostname",
+		default=fqdn(), metavar="HOST",
+		help="Host name to use in PFNs [default: %default]")
+	parser.add_option("-k", "--rack", action="store", dest="rack",
+		default=DEFAULT_RACK, metavar="RACK",
+		help="Rack or site label used to rank PFNs [default: MULE_RACK environment]")
+	parser.add_option("-H", "--hot-size", action="store", dest="hot_size",
+		default=str(HOT_SIZE), metavar="SIZE",
+		help="Memory for frequently requested small files, 0 to disable [default: %default]")
+	parser.add_option("-M", "--hot-max", action="store", dest="hot_max",
+		default=str(HOT_MAX), metavar="SIZE",
+		help="Largest file kept in memory [default: %default]")
+	parser.add_option("-P", "--pack-max", action="store", dest="pack_max",
+		default=str(PACK_MAX), metavar="SIZE",
+		help="Store files up to SIZE in pack files, 0 to disable [default: %default]")
+	parser.add_option("-m", "--max-downloads", action="store", dest="max_downloads",
+		default=MAX_DOWNLOADS, type="int", metavar="N",
+		help="Refuse gets that need downloads while N are queued or running, 0 for no limit [default: %default]")
+	parser.add_option("-B", "--max-inflight", action="store", dest="max_inflight",
+		default=str(MAX_INFLIGHT), metavar="SIZE",
+		help="Limit the bytes being downloaded at once, 0 for no limit [default: %default]")
+	parser.add_option("-F", "--min-free", action="store", dest="min_free",
+		default=str(MIN_FREE), metavar="SIZE",
+		help="Do not start downloads that would leave less than SIZE free [default: %default]")
+	parser.add_option("-L", "--lease", action="store", dest="lease",
+		default=DEFAULT_LEASE, type="int", metavar="SECONDS",
+		help="Lease time of RLS registrations, 0 to disable heartbeats [default: %default]")
+	parser.add_option("-T", "--trace", action="store", dest="trace",
+		default=None, metavar="FILE",
+		help="Record request spans in FILE [default: no tracing]")
+	parser.add_option("-R", "--record", action="store", dest="record",
+		default=None, metavar="FILE",
+		help="Record a trace of cache calls in FILE for mule-replay [default: no recording]")
 
 	(options, args) = parser.parse_args()
 	
 	if len(args) > 0:
 		parser.error("Invalid argument")
 	
+	for opt in ['trace','record','db','log']:
+		if getattr(options, opt):
+			setattr(options, opt, os.path.abspath(getattr(options, opt)))
+	cache_dirs = [os.path.abspath(d) for d in options.cache_dir.split(",")]
+	
 	if not options.rls:
 		parser.error("Specify --rls or MULE_RLS environment")
 	
-	if os.path.isfile(options.cache_dir):
-		parser.error("--directory argument is a file")
+	for d in cache_dirs:
+		if os.path.isfile(d):
+			parser.error("--dir argument %s is a file" % d)
 		
-	if not os.path.isdir(options.cache_dir):
-		os.makedirs(options.cache_dir)
+		# A directory that cannot be created is failed once running
+		if not os.path.isdir(d):
+			try:
+				os.makedirs(d)
+			except OSError, e:
+				print "WARNING: Unable to create %s: %s" % (d, e)
 		
 	# See if RLS is ready
 	try:
@@ -603,12 +1681,20 @@ def main():
 		
 	os.chdir(config.get_home())
 	
-	# Configure logging (after the fork)
-	log.configure()
+	# Configure logging and tracing (after the fork)
+	log.configure(options.log)
+	trace.configure(options.trace)
+	replay.configure(options.record)
 	
 	l = log.get_log("cache")
 	try:
-		a = Cache(options.rls, options.cache_dir, options.threads)
+		a = Cache(options.rls, cache_dirs, options.threads,
+				  options.hostname, options.port, options.db, options.rack,
+				  options.lease, config.parse_size(options.hot_size),
+				  config.parse_size(options.hot_max),
+				  config.parse_size(options.pack_max), options.max_downloads,
+				  config.parse_size(options.max_inflight),
+				  config.parse_size(options.min_free))
 		a.run()
 	except Exception, e:
 		l.exception(e)
@@ -0,0 +1,200 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import time
+import json
+from optparse import OptionParser
+
+# Note: mule.rls and mule.bdb are imported inside the functions that
+# use them because mule.rls imports this module, and because bsddb
+# is not needed to parse or format catalog files.
+
+__all__ = ["format_mapping","parse_mapping","read_mappings"]
+
+def format_mapping(lfn, pfn, attrs=None):
+	"""
+	Format a mapping as a catalog line: LFN PFN [ATTRS], where ATTRS
+	is a JSON object without spaces
+	"""
+	if attrs:
+		return "%s %s %s\n" % (lfn, pfn, json.dumps(attrs, separators=(',',':')))
+	return "%s %s\n" % (lfn, pfn)
+
+def parse_mapping(line):
+	"""
+	Parse a catalog line into (lfn, pfn, attrs). Returns None for
+	blank lines and comments.
+	"""
+	line = line.strip()
+	if len(line) == 0 or line.startswith('#'):
+		return None
+	fields = line.split(None, 2)
+	if len(fields) < 2:
+		raise ValueError("Invalid mapping: %s" % line)
+	attrs = None
+	if len(fields) > 2:
+		attrs = {}
+		# json gives unicode, but bsddb keys must be str
+		for k, v in json.loads(fields[2]).items():
+			if isinstance(v, unicode):
+				v = v.encode('utf-8')
+			attrs[k.encode('utf-8')] = v
+	return (fields[0], fields[1], attrs)
+
+def read_mappings(f, path="input"):
+	"""
+	Yield the mappings in catalog file f. Prints a warning if the
+	lfns are not sorted, because loading is much slower then.
+	"""
+	last = None
+	warned = False
+	for i, line in enumerate(f):
+		try:
+			m = parse_mapping(line)
+		except ValueError, e:
+			raise ValueError("%s line %d: %s" % (path, i+1, e))
+		if m is None:
+			continue
+		if not warned and last is not None and m[0] < last:
+			sys.stderr.write("WARNING: %s is not sorted by LFN (line %d), "
+							 "loading will be slow\n" % (path, i+1))
+			warned = True
+		last = m[0]
+		yield m
+
+def open_file(path, mode):
+	if path == '-':
+		if 'r' in mode:
+			return sys.stdin
+		return sys.stdout
+	return open(path, mode)
+
+def check_stopped(host):
+	"""
+	Raise an exception if an RLS is answering on host. The offline
+	commands open the database directly, which is not safe while the
+	RLS has it open.
+	"""
+	from mule import rls
+	try:
+		conn = rls.connect(host)
+		conn.ready()
+	except Exception:
+		return
+	raise Exception("RLS at %s is running: stop it first or use --force" % host)
+
+def load(db_path, path, batch):
+	from mule import bdb
+	db = bdb.RLSDatabase(db_path)
+	try:
+		f = open_file(path, 'r')
+		try:
+			start = time.time()
+			n = db.load(read_mappings(f, path), batch)
+			elapsed = time.time() - start
+		finally:
+			if f is not sys.stdin:
+				f.close()
+	finally:
+		db.close()
+	sys.stderr.write("Loaded %d mappings in %.2f seconds\n" % (n, elapsed))
+
+def export(db_path, path):
+	from mule import bdb
+	db = bdb.RLSDatabase(db_path)
+	try:
+		f = open_file(path, 'w')
+		try:
+			def write(lfn, pfn, attrs):
+				f.write(format_mapping(lfn, pfn, attrs))
+			n = db.export(write, snapshot=False)
+		finally:
+			if f is not sys.stdout:
+				f.close()
+	finally:
+		db.close()
+	sys.stderr.write("Exported %d mappings\n" % n)
+
+def snapshot(host, name):
+	from mule import rls
+	conn = rls.connect(host)
+	start = time.time()
+	n = conn.export(name)
+	elapsed = time.time() - start
+	sys.stderr.write("Exported %d mappings in %.2f seconds\n" % (n, elapsed))
+
+def usage():
+	sys.stderr.write("Usage: %s COMMAND\n" % os.path.basename(sys.argv[0]))
+	sys.stderr.write("""
+Commands:
+   load FILE          Load mappings from FILE into a stopped RLS
+   export FILE        Export all mappings from a stopped RLS to FILE
+   snapshot NAME      Ask a running RLS to export a snapshot to NAME in 
+                      its export directory
+
+FILE has one mapping per line: LFN PFN [ATTRS], where ATTRS is a JSON
+object. Use - for stdin/stdout.
+""")
+	sys.exit(1)
+
+def main():
+	from mule import rls
+	if len(sys.argv) < 2:
+		usage()
+
+	cmd = sys.argv[1]
+	args = sys.argv[2:]
+
+	if cmd in ['load','export']:
+		parser = OptionParser("Usage: %%prog %s [options] FILE" % cmd)
+		parser.add_option("-D", "--db", action="store", dest="db",
+			default=None, metavar="DIR",
+			help="Database directory [default: MULE_HOME/var/rls]")
+		parser.add_option("-H", "--host", action="store", dest="host",
+			default="localhost:%d" % rls.RLS_PORT, metavar="HOST",
+			help="Address of the RLS that must be stopped [default: %default]")
+		parser.add_option("-F", "--force", action="store_true", dest="force",
+			default=False, help="Do not check that the RLS is stopped")
+		if cmd == 'load':
+			parser.add_option("-b", "--batch", action="store", dest="batch",
+				default=10000, type="int", metavar="N",
+				help="Mappings per transaction [default: %default]")
+		(options, args) = parser.parse_args(args=args)
+		if len(args) != 1:
+			parser.error("Specify FILE")
+		if not options.force:
+			try:
+				check_stopped(options.host)
+			except Exception, e:
+				parser.error(str(e))
+		if cmd == 'load':
+			load(options.db, args[0], options.batch)
+		else:
+			export(options.db, args[0])
+	elif cmd in ['snapshot']:
+		parser = OptionParser("Usage: %prog snapshot [options] NAME")
+		parser.add_option("-H", "--host", action="store", dest="host",
+			default="localhost:%d" % rls.RLS_PORT, metavar="HOST",
+			help="RLS to snapshot [default: %default]")
+		(options, args) = parser.parse_args(args=args)
+		if len(args) != 1:
+			parser.error("Specify PATH")
+		snapshot(options.host, args[0])
+	else:
+		usage()
+
+if __name__ == '__main__':
+	main()
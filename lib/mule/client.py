@@ -17,22 +17,57 @@ import os
 import time
 from optparse import OptionParser
 
-from mule import cache
-from mule import rls
+# Only lightweight modules are imported here: the client runs once per 
+# transfer, so its start-up time matters. Modules that are only needed
+# by some commands (rls, bits, cluster) are imported by those commands.
+from mule import rpc
+from mule import local
+from mule import trace
 
 SYMLINK = os.getenv("MULE_SYMLINK","false").lower() == "true"
 SMART_MOVE = os.getenv("MULE_SMART_MOVE","false").lower() == "true"
+# Serve hits from the local cache directory without calling the daemon
+LOCAL_HITS = os.getenv("MULE_LOCAL_HITS","true").lower() == "true"
+# Seconds to wait for the daemon to take the count of local hits
+HITS_TIMEOUT = 1
+CACHE_DIR = local.DEFAULT_DIR
+TRACE_LOG = os.getenv("MULE_TRACE_LOG")
+PAGE_SIZE = 1000
+
+# Items per call, and retries of failed items, for --stream
+STREAM_BATCH = 100
+STREAM_RETRIES = 1
+# Seconds to wait for results once all items are submitted
+POLL_WAIT = 10
+
+# Passed to the cache daemon so that the spans it records for this
+# invocation can be matched up using mule-trace
+TRACE_ID = trace.new_id()
 
 def timed(function):
 	def timer(*args, **kwargs):
 		try:
 			start = time.time()
-			return function(*args, **kwargs)
+			with trace.span(TRACE_ID, 'client', command=function.__name__):
+				return function(*args, **kwargs)
 		finally:
 			end = time.time()
-			sys.stderr.write("Called %s in %f seconds\n" % (function.__name__, end-start))
+			sys.stderr.write("Called %s in %f seconds (trace %s)\n" % (function.__name__, end-start, TRACE_ID))
 	return timer
 
+def report_hits(lfns):
+	"""
+	Tell the daemon about gets served from the cache directory, in one
+	call, so that its statistics, traces and hot tier count them. The
+	files are already in place, so errors are ignored.
+	"""
+	if len(lfns) == 0:
+		return
+	try:
+		rpc.connect(timeout=HITS_TIMEOUT).hits(lfns, TRACE_ID)
+	except Exception, e:
+		sys.stderr.write("Unable to report local hits: %s\n" % e)
+
 @timed
 def get(lfn, path, symlink):
 	if not os.path.isabs(path):
@@ -41,13 +76,18 @@ def get(lfn, path, symlink):
 	if os.path.exists(path):
 		sys.stderr.write("Path %s already exists. Removing." % path)
 		os.unlink(path)
+	
+	if LOCAL_HITS and local.get_local(lfn, path, symlink, CACHE_DIR):
+		report_hits([lfn])
+		return
 		
-	conn = cache.connect()
-	conn.get(lfn, path, symlink)
+	conn = rpc.connect()
+	rpc.call(conn.get, lfn, path, symlink, TRACE_ID)
 
 @timed
 def multiget(stream, symlink):
 	pairs = []
+	hits = []
 	for l in stream.readlines():
 		l = l.strip()
 		if len(l)==0 or l.startswith('#'):
@@ -61,11 +101,140 @@ def multiget(stream, symlink):
 			sys.stderr.write("Path %s already exists. Removing." % path)
 			os.unlink(path)
 		
+		if LOCAL_HITS and local.get_local(lfn, path, symlink, CACHE_DIR):
+			hits.append(lfn)
+			continue
+		
 		pairs.append([lfn, path])
 	
-	conn = cache.connect()
-	conn.multiget(pairs, symlink)
+	report_hits(hits)
+	if len(pairs) == 0:
+		return
+	
+	conn = rpc.connect()
+	rpc.call(conn.multiget, pairs, symlink, TRACE_ID)
+	
+def read_pairs(stream):
+	"""
+	Yield the two fields of each line of stream as soon as it is read
+	"""
+	while True:
+		l = stream.readline()
+		if not l:
+			break
+		l = l.strip()
+		if len(l)==0 or l.startswith('#'):
+			continue
+		yield l.split()
+
+def report(status, a, b, seconds, reason=None):
+	"""
+	Print the result of one streamed item
+	"""
+	if reason is None:
+		print "%s %s %s %.3f" % (status, a, b, seconds)
+	else:
+		print "%s %s %s %.3f %s" % (status, a, b, seconds, reason)
+	sys.stdout.flush()
+
+@timed
+def stream_multiget(stream, symlink, batch=STREAM_BATCH, retries=STREAM_RETRIES):
+	"""
+	Submit LFN PATH pairs to the cache in batches as they are read and
+	print the result of each item as soon as it is linked or fails.
+	Failed items are retried up to retries times. Returns the number 
+	of items that failed.
+	"""
+	conn = rpc.connect()
+	sid = conn.stream_open(symlink, TRACE_ID)
+	state = {'outstanding': 0, 'failed': 0}
+	tries = {}
+	
+	def submit(pairs, retry=False):
+		rpc.call(conn.stream_submit, sid, pairs, retry)
+		state['outstanding'] += len(pairs)
+	
+	def collect(wait):
+		for lfn, path, status, reason, seconds in conn.stream_poll(sid, wait):
+			state['outstanding'] -= 1
+			if status == 'failed' and tries.get(path, 0) < retries:
+				tries[path] = tries.get(path, 0) + 1
+				if os.path.lexists(path):
+					os.unlink(path)
+				submit([[lfn, path]], True)
+				continue
+			if status == 'failed':
+				state['failed'] += 1
+			report(status, lfn, path, seconds, reason)
 	
+	try:
+		pairs = []
+		hits = []
+		for lfn, path in read_pairs(stream):
+			if not os.path.isabs(path):
+				path = os.path.abspath(path)
+			
+			if os.path.exists(path):
+				sys.stderr.write("Path %s already exists. Removing." % path)
+				os.unlink(path)
+			
+			start = time.time()
+			if LOCAL_HITS and local.get_local(lfn, path, symlink, CACHE_DIR):
+				report('ok', lfn, path, time.time() - start)
+				hits.append(lfn)
+				if len(hits) >= batch:
+					report_hits(hits)
+					hits = []
+				continue
+			
+			pairs.append([lfn, path])
+			if len(pairs) >= batch:
+				submit(pairs)
+				pairs = []
+				collect(0)
+		
+		if len(pairs) > 0:
+			submit(pairs)
+		report_hits(hits)
+		while state['outstanding'] > 0:
+			collect(POLL_WAIT)
+	finally:
+		conn.stream_close(sid)
+	return state['failed']
+
+@timed
+def stream_multiput(stream, smart_move, batch=STREAM_BATCH, retries=STREAM_RETRIES):
+	"""
+	Put PATH LFN pairs into the cache in batches as they are read and
+	print the result of each item. Failed items are retried up to 
+	retries times. Returns the number of items that failed.
+	"""
+	conn = rpc.connect()
+	failed = 0
+	tries = {}
+	pairs = []
+	lines = read_pairs(stream)
+	while True:
+		for path, lfn in lines:
+			if not os.path.isabs(path):
+				path = os.path.abspath(path)
+			pairs.append([path, lfn])
+			if len(pairs) >= batch:
+				break
+		if len(pairs) == 0:
+			break
+		results = conn.stream_put(pairs, smart_move, TRACE_ID)
+		pairs = []
+		for path, lfn, status, reason, seconds in results:
+			if status == 'failed' and tries.get(path, 0) < retries:
+				tries[path] = tries.get(path, 0) + 1
+				pairs.append([path, lfn])
+				continue
+			if status == 'failed':
+				failed += 1
+			report(status, path, lfn, seconds, reason)
+	return failed
+
 @timed	
 def put(path, lfn, smart_move):
 	# If the path doesn't exist, then skip it
@@ -76,8 +245,8 @@ def put(path, lfn, smart_move):
 	if not os.path.isabs(path):
 		path = os.path.abspath(path)
 	
-	conn = cache.connect()
-	conn.put(path, lfn, smart_move)
+	conn = rpc.connect()
+	conn.put(path, lfn, smart_move, TRACE_ID)
 
 @timed
 def multiput(stream, symlink):
@@ -97,71 +266,181 @@ def multiput(stream, symlink):
 			
 		pairs.append([path, lfn])
 	
-	conn = cache.connect()
-	conn.multiput(pairs, symlink)
+	conn = rpc.connect()
+	conn.multiput(pairs, symlink, TRACE_ID)
 	
 @timed
 def remove(lfn, force):
-	conn = cache.connect()
+	conn = rpc.connect()
 	conn.remove(lfn, force)
 
+def pages(list_page, pattern, limit):
+	"""
+	Call list_page until all pages have been read, yielding the items
+	of each page as it arrives
+	"""
+	token = None
+	while True:
+		result = list_page(token, limit, pattern)
+		yield result['items']
+		token = result['token']
+		if token is None:
+			break
+
 @timed
-def ls(host):
-	conn = cache.connect(host=host)
-	results = conn.list()
-	for rec in results:
-		print rec['lfn'], rec['status']
+def ls(host, pattern=None, limit=PAGE_SIZE):
+	conn = rpc.connect(host=host)
+	for items in pages(conn.list_page, pattern, limit):
+		for rec in items:
+			print rec['lfn'], rec['status']
+		sys.stdout.flush()
 
 @timed
-def rls_add(lfn, pfn):
-	conn = cache.connect()
-	conn.rls_add(lfn, pfn)
+def rls_list(pattern=None, limit=PAGE_SIZE):
+	conn = rpc.connect()
+	for items in pages(conn.rls_list_page, pattern, limit):
+		for lfn, pfns in items:
+			print lfn, ' '.join(pfns)
+		sys.stdout.flush()
+
+@timed
+def rls_direct_list(rls_host, pattern=None, limit=PAGE_SIZE):
+	from mule import rls
+	conn = rls.connect(rls_host)
+	for items in pages(conn.list_page, pattern, limit):
+		for lfn, pfns in items:
+			print lfn, ' '.join(pfns)
+		sys.stdout.flush()
+
+@timed
+def rls_add(lfn, pfn, attrs=None):
+	conn = rpc.connect()
+	conn.rls_add(lfn, pfn, attrs)
 	
 @timed
 def rls_lookup(lfn):
-	conn = cache.connect()
+	conn = rpc.connect()
 	pfns = conn.rls_lookup(lfn)
 	for pfn in pfns:
 		print pfn
 
 @timed	
 def rls_delete(lfn, pfn):
-	conn = cache.connect()
+	conn = rpc.connect()
 	conn.rls_delete(lfn, pfn)
 	
 @timed
-def rls_direct_add(rls_host, lfn, pfn):
+def rls_direct_add(rls_host, lfn, pfn, attrs=None):
+	from mule import rls
 	conn = rls.connect(rls_host)
-	conn.add(lfn, pfn)
+	seq = conn.add(lfn, pfn, None, attrs)
+	# Pass this to rls_direct_lookup --min-seq to read this write
+	sys.stderr.write("Change %s\n" % seq)
 
 @timed
 def rls_direct_add_bench(rls_host, prefix):
+	from mule import rls
 	conn = rls.connect(rls_host)
 	for i in range(0, 1000):
 		conn.add(prefix+str(i), prefix+str(i))
 
 @timed
-def rls_direct_lookup(rls_host, lfn):
+def rls_direct_lookup(rls_host, lfn, min_seq=None):
+	from mule import rls
 	conn = rls.connect(rls_host)
-	pfns = conn.lookup(lfn)
+	pfns = conn.lookup(lfn, None, None, min_seq)
 	for pfn in pfns:
 		print pfn
 
 @timed
 def rls_direct_delete(rls_host, lfn, pfn):
+	from mule import rls
 	conn = rls.connect(rls_host)
 	conn.delete(lfn, pfn)
 
+def print_bloom(bloom, m):
+	from mule import bits
+	# Always publish the maximum number of chunks so that chunks left
+	# over from a previous, larger filter are cleared
+	for i in range(0, max(len(bloom), bits.num_chunks(m))):
+		if i < len(bloom):
+			print 'BloomFilter%d = "%s"' % (i, bloom[i])
+		else:
+			print 'BloomFilter%d = ""' % i
+
+@timed
+def get_bloom_filter(m, k, fpr, host="localhost"):
+	conn = rpc.connect(host=host)
+	print_bloom(conn.get_bloom_filter(m, k, fpr), m)
+
+def print_json(obj):
+	import json
+	print json.dumps(obj, indent=2, sort_keys=True)
+
+def print_errors(errors):
+	"""Print the hosts that failed, and exit with status 1 if any did"""
+	for host in sorted(errors.keys()):
+		sys.stderr.write("ERROR %s: %s\n" % (host, errors[host]))
+	if len(errors) > 0:
+		sys.exit(1)
+
+@timed
+def cluster_stats(hosts, concurrency, timeout, as_json):
+	from mule import cluster
+	result = cluster.stats(hosts, concurrency, timeout)
+	if as_json:
+		print_json(result)
+	else:
+		row = "%-40s %10s %10s %10s %10s %10s %10s %8s"
+		print row % ('HOST','GETS','HITS','MISSES','NEAR','FAILURES','REJECTED','HIT%')
+		nodes = sorted(result['nodes'].items()) + [('TOTAL', result['total'])]
+		for host, st in nodes:
+			print row % (host, st['gets'], st['hits'], st['misses'],
+						 st['near_misses'], st['failures'], st.get('rejected', 0),
+						 "%.1f" % (100 * st['hit_rate']))
+	print_errors(result['errors'])
+
+@timed
+def cluster_list(hosts, pattern, limit, top, concurrency, timeout, as_json):
+	from mule import cluster
+	result = cluster.replicas(hosts, pattern, limit, top, concurrency, timeout)
+	if as_json:
+		print_json(result)
+	else:
+		print "%d distinct LFNs on %d caches" % (result['lfns'], len(result['nodes']))
+		print
+		print "%-40s %10s" % ('HOST', 'LFNS')
+		for host, n in sorted(result['nodes'].items()):
+			print "%-40s %10d" % (host, n)
+		print
+		print "%8s %s" % ('COPIES', 'LFN')
+		for lfn, n in result['top']:
+			print "%8d %s" % (n, lfn)
+	print_errors(result['errors'])
+
 @timed
-def get_bloom_filter(m, k):
-	conn = cache.connect()
-	bloom = conn.get_bloom_filter(m, k)
-	for i in range(0, len(bloom)):
-		print 'BloomFilter%d = "%s"' % (i, bloom[i])
+def cluster_bloom(hosts, m, k, fpr, concurrency, timeout, as_json):
+	from mule import cluster
+	result = cluster.bloom(hosts, m, k, fpr, concurrency, timeout)
+	if as_json:
+		print_json(result)
+	else:
+		print_bloom(result['filter'], m)
+		sys.stderr.write("Union of %d filters: %d of %d bits set\n" % 
+						 (len(result['nodes']), result['popcount'], result['m']))
+	print_errors(result['errors'])
+
+@timed
+def cluster_clear(hosts, concurrency, timeout):
+	from mule import cluster
+	cleared, errors = cluster.clear(hosts, concurrency, timeout)
+	for host in cleared:
+		print "cleared", host
+	print_errors(errors)
 		
 @timed
 def stats(host):
-	conn = cache.connect(host=host)
+	conn = rpc.connect(host=host)
 	st = conn.stats()
 	for k in st:
 		v = st[k]
@@ -172,19 +451,95 @@ def stats(host):
 			
 @timed
 def clear(host):
-	conn = cache.connect(host=host)
+	conn = rpc.connect(host=host)
 	conn.clear()
 	
+@timed
+def compact(host, threshold):
+	conn = rpc.connect(host=host)
+	n = conn.compact(threshold)
+	print "Reclaimed %d bytes" % n
+	
 @timed
 def rls_clear():
-	conn = cache.connect()
+	conn = rpc.connect()
 	conn.rls_clear()
 	
 @timed
 def rls_direct_clear(rls_host):
+	from mule import rls
 	conn = rls.connect(rls_host)
 	conn.clear()
 
+def add_attr_options(parser):
+	parser.add_option("-P", "--priority", action="store", type="int",
+		dest="priority", default=None,
+		help="Priority of PFN, higher is preferred [default: 0]")
+	parser.add_option("-k", "--rack", action="store", type="string",
+		dest="rack", default=None,
+		help="Rack or site label of PFN")
+
+def get_attrs(options):
+	attrs = {}
+	if options.priority is not None:
+		attrs['priority'] = options.priority
+	if options.rack is not None:
+		attrs['rack'] = options.rack
+	return attrs
+
+def add_cluster_options(parser):
+	parser.add_option("-H", "--host", action="store", type="string",
+		dest="host", default="localhost",
+		help="Host to connect to, or a comma-separated list of hosts")
+	parser.add_option("-F", "--hostfile", action="store", type="string",
+		dest="hostfile", default=None, metavar="FILE",
+		help="Read hosts from FILE, one per line")
+	parser.add_option("-j", "--concurrency", action="store", type="int",
+		dest="concurrency", default=32, metavar="N",
+		help="Number of hosts to call at once [default: %default]")
+	parser.add_option("-T", "--timeout", action="store", type="float",
+		dest="timeout", default=30, metavar="SECONDS",
+		help="Timeout of each call [default: %default]")
+	parser.add_option("-J", "--json", action="store_true",
+		dest="json", default=False,
+		help="Print results as JSON [default: %default]")
+
+def get_hosts(options):
+	"""
+	Return the hosts to call and whether to use the cluster form of
+	the command, which aggregates the results of several hosts
+	"""
+	if options.hostfile:
+		from mule import cluster
+		return cluster.read_hostfile(options.hostfile), True
+	hosts = [h for h in options.host.split(',') if h]
+	return hosts, len(hosts) > 1 or options.json
+
+def add_page_options(parser):
+	parser.add_option("-n", "--page-size", action="store", type="int",
+		dest="limit", default=PAGE_SIZE,
+		help="Number of entries to fetch per call [default: %default]")
+
+def add_stream_options(parser):
+	parser.add_option("-S", "--stream", action="store_true",
+		dest="stream", default=False,
+		help="Submit items in batches as they are read and print the result of each [default: %default]")
+	parser.add_option("-b", "--batch", action="store", type="int",
+		dest="batch", default=STREAM_BATCH,
+		help="Items per batch with --stream [default: %default]")
+	parser.add_option("-r", "--retries", action="store", type="int",
+		dest="retries", default=STREAM_RETRIES,
+		help="Times to retry a failed item with --stream [default: %default]")
+
+def get_pattern(args):
+	# PATTERN is a glob; a plain string is treated as a prefix
+	if len(args) == 0:
+		return None
+	pattern = args[0]
+	if not any([c in pattern for c in "*?["]):
+		pattern += "*"
+	return pattern
+
 def usage():
 	sys.stderr.write("Usage: %s COMMAND\n" % os.path.basename(sys.argv[0]))
 	sys.stderr.write("""
@@ -194,17 +549,20 @@ Commands:
    put PATH LFN                            Upload PATH to LFN
    multiput                                Upload multiple paths
    remove LFN                              Remove LFN from cache
-   list                                    List cache contents
+   list [PATTERN]                          List cache contents
    rls_add LFN PFN                         Add mapping to RLS
    rls_delete LFN                          Remove mappings for LFN from RLS
    rls_lookup LFN                          List RLS mappings for LFN
+   rls_list [PATTERN]                      List RLS mappings
    bloom                                   Retrieve base64-encoded bloom filter for cache
    stats                                   Display cache statistics
    clear                                   Clear all entries from cache
+   compact                                 Reclaim space from pack files
    rls_clear                               Clear all entries from RLS
    rls_direct_add RLSHOST LFN PFN          Add mapping to RLS w/o going through cache
    rls_direct_delete RLSHOST LFN           Remove mappings for LFN from RLS w/o going through cache
    rls_direct_lookup RLSHOST LFN           List RLS mappings for LFN w/o going through cache
+   rls_direct_list RLSHOST [PATTERN]       List RLS mappings w/o going through cache
    rls_direct_clear RLSHOST                Clear all entries from RLS w/o going through cache
    rls_direct_add_bench RLSHOST PREFIX     For benchmarking the RLS by sending it 1000 requests
    help                                    Display this message
@@ -214,6 +572,8 @@ Commands:
 def main():
 	if len(sys.argv) < 2:
 		usage()
+	
+	trace.configure(TRACE_LOG)
 		
 	cmd = sys.argv[1]
 	args = sys.argv[2:]
@@ -237,16 +597,21 @@ def main():
 		parser.add_option("-s", "--symlink", action="store_true", 
 			dest="symlink", default=SYMLINK,
 			help="symlink PATH to cached file [default: %default]")
+		add_stream_options(parser)
 		(options, args) = parser.parse_args(args=args)
-		if options.file:
-			f = None
-			try:
+		f = sys.stdin
+		try:
+			if options.file:
 				f = open(options.file, 'r')
+			if options.stream:
+				failed = stream_multiget(f, options.symlink, 
+										 options.batch, options.retries)
+				if failed > 0:
+					sys.exit(1)
+			else:
 				multiget(f, options.symlink)
-			finally:
-				if f: f.close()
-		else:
-			multiget(sys.stdin, options.symlink)
+		finally:
+			if f is not sys.stdin: f.close()
 	elif cmd in ['put']:
 		parser = OptionParser("Usage: %prog put PATH LFN")
 		parser.add_option("-s", "--smart_move", action="store_true", 
@@ -266,16 +631,21 @@ def main():
 		parser.add_option("-s", "--smart_move", action="store_true", 
 			dest="smart_move", default=SMART_MOVE,
 			help="move PATH to cache and create a symlink back (if move is a simple rename) otherwise copy PATH to cache[default: %default]")
+		add_stream_options(parser)
 		(options, args) = parser.parse_args(args=args)
-		if options.file:
-			f = None
-			try:
+		f = sys.stdin
+		try:
+			if options.file:
 				f = open(options.file, 'r')
+			if options.stream:
+				failed = stream_multiput(f, options.smart_move,
+										 options.batch, options.retries)
+				if failed > 0:
+					sys.exit(1)
+			else:
 				multiput(f, options.smart_move)
-			finally:
-				if f: f.close()
-		else:
-			multiput(sys.stdin, options.smart_move)
+		finally:
+			if f is not sys.stdin: f.close()
 	elif cmd in ['remove','rm']:
 		parser = OptionParser("Usage: %prog remove [options] LFN")
 		parser.add_option("-f", "--force", action="store_true",
@@ -287,22 +657,44 @@ def main():
 		lfn = args[0]
 		remove(lfn, options.force)
 	elif cmd in ['list','ls']:
-		parser = OptionParser("Usage: %prog list")
-		parser.add_option("-H", "--host", action="store", type="string",
-			dest="host", default="localhost",
-			help="Host to connect to")
+		parser = OptionParser("Usage: %prog list [PATTERN]")
+		add_cluster_options(parser)
+		add_page_options(parser)
+		parser.add_option("-t", "--top", action="store", type="int",
+			dest="top", default=20, metavar="N",
+			help="With several hosts, show the N LFNs with most copies [default: %default]")
 		(options, args) = parser.parse_args(args=args)
-		if len(args) > 0:
+		if len(args) > 1:
 			parser.error("Invalid argument")
-		ls(options.host)
+		hosts, many = get_hosts(options)
+		if many:
+			cluster_list(hosts, get_pattern(args), options.limit, options.top,
+						 options.concurrency, options.timeout, options.json)
+		else:
+			ls(hosts[0], get_pattern(args), options.limit)
+	elif cmd in ['rls_list','rls_ls']:
+		parser = OptionParser("Usage: %prog rls_list [PATTERN]")
+		add_page_options(parser)
+		(options, args) = parser.parse_args(args=args)
+		if len(args) > 1:
+			parser.error("Invalid argument")
+		rls_list(get_pattern(args), options.limit)
+	elif cmd in ['rls_direct_list']:
+		parser = OptionParser("Usage: %prog rls_direct_list RLSHOST [PATTERN]")
+		add_page_options(parser)
+		(options, args) = parser.parse_args(args=args)
+		if len(args) not in [1,2]:
+			parser.error("Specify RLSHOST and/or PATTERN")
+		rls_direct_list(args[0], get_pattern(args[1:]), options.limit)
 	elif cmd in ['rls_add','add']:
 		parser = OptionParser("Usage: %prog rls_add LFN PFN")
+		add_attr_options(parser)
 		(options, args) = parser.parse_args(args=args)
 		if len(args) != 2:
 			parser.error("Specify LFN and PFN")
 		lfn = args[0]
 		pfn = args[1]
-		rls_add(lfn, pfn)
+		rls_add(lfn, pfn, get_attrs(options))
 	elif cmd in ['rls_lookup','rls_lu','lookup','lu']:
 		parser = OptionParser("Usage: %prog rls_lookup LFN")
 		(options, args) = parser.parse_args(args=args)
@@ -323,13 +715,14 @@ def main():
 		rls_delete(lfn, pfn)
 	elif cmd in ['rls_direct_add']:
 		parser = OptionParser("Usage: %prog rls_direct_add RLS_HOST LFN PFN")
+		add_attr_options(parser)
 		(options, args) = parser.parse_args(args=args)
 		if len(args) != 3:
 			parser.error("Specify RLSHOST, LFN and PFN")
 		rls_host = args[0]
 		lfn = args[1]
 		pfn = args[2]
-		rls_direct_add(rls_host, lfn, pfn)
+		rls_direct_add(rls_host, lfn, pfn, get_attrs(options))
 	elif cmd in ['rls_direct_add_bench']:
 		parser = OptionParser("Usage: %prog rls_direct_add_bench RLS_HOST PREFIX")
 		(options, args) = parser.parse_args(args=args)
@@ -340,12 +733,15 @@ def main():
 		rls_direct_add_bench(rls_host, prefix)
 	elif cmd in ['rls_direct_lookup']:
 		parser = OptionParser("Usage: %prog rls_direct_lookup RLSHOST LFN")
+		parser.add_option("-s", "--min-seq", action="store", type="int",
+			dest="min_seq", default=None,
+			help="Only read from a replica that has applied change MIN_SEQ")
 		(options, args) = parser.parse_args(args=args)
 		if len(args) != 2:
 			parser.error("Specify RLSHOST and LFN")
 		rls_host = args[0]
 		lfn = args[1]
-		rls_direct_lookup(rls_host, lfn)
+		rls_direct_lookup(rls_host, lfn, options.min_seq)
 	elif cmd in ['rls_direct_delete']:
 		parser = OptionParser("Usage: %prog rls_direct_delete RLSHOST LFN [PFN]")
 		(options, args) = parser.parse_args(args=args)
@@ -359,35 +755,63 @@ def main():
 			pfn = None
 		rls_direct_delete(rls_host, lfn, pfn)
 	elif cmd in ['bloom','bf','get_bloom','get_bloom_filter']:
+		from mule import bits
 		parser = OptionParser("Usage: %prog bloom")
 		parser.add_option("-m", "--size", action="store", type="int",
-			dest="m", metavar="M", default=36*1024*8,
-			help="Size of bloom filter [default: 36*1024*8]")
+			dest="m", metavar="M", default=bits.DEFAULT_SIZE,
+			help="Size (or maximum size with --fpr) of bloom filter [default: %default]")
 		parser.add_option("-k", "--hashes", action="store", 
-			dest="k", default=3, type="int",
-			help="Number of hashes [default: 3]")
+			dest="k", default=bits.DEFAULT_HASHES, type="int",
+			help="Number of hashes [default: %default]")
+		parser.add_option("-p", "--fpr", action="store",
+			dest="fpr", default=None, type="float", metavar="P",
+			help="Choose size and hashes for false-positive rate P")
+		add_cluster_options(parser)
 		(options, args) = parser.parse_args(args=args)
 		if len(args) > 0:
 			parser.error("Invalid argument")
-		get_bloom_filter(options.m, options.k)
+		if options.fpr is not None and (options.fpr <= 0 or options.fpr >= 1):
+			parser.error("--fpr must be between 0 and 1")
+		hosts, many = get_hosts(options)
+		if many:
+			cluster_bloom(hosts, options.m, options.k, options.fpr,
+						  options.concurrency, options.timeout, options.json)
+		else:
+			get_bloom_filter(options.m, options.k, options.fpr, hosts[0])
 	elif cmd in ['stats','stat','st']:
 		parser = OptionParser("Usage: %prog stats")
-		parser.add_option("-H", "--host", action="store", type="string",
-			dest="host", default="localhost",
-			help="Host to connect to")
+		add_cluster_options(parser)
 		(options, args) = parser.parse_args(args=args)
 		if len(args) > 0:
 			parser.error("Invalid argument")
-		stats(options.host)
+		hosts, many = get_hosts(options)
+		if many:
+			cluster_stats(hosts, options.concurrency, options.timeout, options.json)
+		else:
+			stats(hosts[0])
 	elif cmd in ['clear']:
 		parser = OptionParser("Usage: %prog clear")
+		add_cluster_options(parser)
+		(options, args) = parser.parse_args(args=args)
+		if len(args) > 0:
+			parser.error("Invalid argument")
+		hosts, many = get_hosts(options)
+		if many:
+			cluster_clear(hosts, options.concurrency, options.timeout)
+		else:
+			clear(hosts[0])
+	elif cmd in ['compact']:
+		parser = OptionParser("Usage: %prog compact [options]")
 		parser.add_option("-H", "--host", action="store", type="string",
 			dest="host", default="localhost",
 			help="Host to connect to")
+		parser.add_option("-t", "--threshold", action="store", type="float",
+			dest="threshold", default=None,
+			help="Compact packs with less than this fraction live [default: 0.5]")
 		(options, args) = parser.parse_args(args=args)
 		if len(args) > 0:
 			parser.error("Invalid argument")
-		clear(options.host)
+		compact(options.host, options.threshold)
 	elif cmd in ['rls_clear']:
 		parser = OptionParser("Usage: %prog rls_clear")
 		(options, args) = parser.parse_args(args=args)
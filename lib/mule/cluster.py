@@ -0,0 +1,172 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from threading import Thread, Lock
+
+from mule import bits, rpc
+
+__all__ = ["read_hostfile","fanout","stats","replicas","bloom","clear"]
+
+# Number of hosts called at once, and seconds to wait for each call
+CONCURRENCY = 32
+TIMEOUT = 30
+
+# Counters summed by stats
+COUNTERS = ['gets','puts','hits','misses','near_misses','failures','duplicates','rejected']
+
+def read_hostfile(path):
+	"""Read one host per line, ignoring blank lines and comments"""
+	hosts = []
+	f = open(path)
+	try:
+		for line in f:
+			line = line.strip()
+			if len(line) > 0 and not line.startswith('#'):
+				hosts.append(line)
+	finally:
+		f.close()
+	return hosts
+
+def fanout(hosts, call, concurrency=CONCURRENCY, timeout=TIMEOUT):
+	"""
+	Call call(conn, host) for each cache in hosts, on up to concurrency
+	threads, where conn is a connection that times out after timeout 
+	seconds. Returns (results, errors): dicts of host -> result and 
+	host -> error message.
+	"""
+	results = {}
+	errors = {}
+	todo = list(reversed(hosts))
+	lock = Lock()
+	def worker():
+		while True:
+			lock.acquire()
+			try:
+				if len(todo) == 0:
+					return
+				host = todo.pop()
+			finally:
+				lock.release()
+			try:
+				result = call(rpc.connect(host, timeout=timeout), host)
+				lock.acquire()
+				try:
+					results[host] = result
+				finally:
+					lock.release()
+			except Exception, e:
+				lock.acquire()
+				try:
+					errors[host] = str(e) or e.__class__.__name__
+				finally:
+					lock.release()
+	threads = [Thread(target=worker) for i in range(min(concurrency, len(hosts)))]
+	for t in threads:
+		t.setDaemon(True)
+		t.start()
+	for t in threads:
+		t.join()
+	return results, errors
+
+def stats(hosts, concurrency=CONCURRENCY, timeout=TIMEOUT):
+	"""
+	Collect the statistics of every cache. Returns {'total': counters
+	summed over all caches, 'nodes': {host: stats}, 'errors': {host:
+	message}}, where each set of counters has a hit_rate.
+	"""
+	results, errors = fanout(hosts, lambda conn, host: conn.stats(),
+							 concurrency, timeout)
+	total = dict([(c, 0) for c in COUNTERS])
+	nodes = {}
+	for host, st in results.items():
+		for c in COUNTERS:
+			total[c] += st.get(c, 0)
+		st['hit_rate'] = float(st.get('hits', 0)) / max(1, st.get('gets', 0))
+		nodes[host] = st
+	total['hit_rate'] = float(total['hits']) / max(1, total['gets'])
+	return {'total': total, 'nodes': nodes, 'errors': errors}
+
+def replicas(hosts, pattern=None, limit=1000, top=20, 
+			 concurrency=CONCURRENCY, timeout=TIMEOUT):
+	"""
+	List every cache and count the caches holding a ready copy of each
+	lfn. Returns {'lfns': number of distinct lfns, 'top': [[lfn, 
+	copies]...] for the top lfns by copies, 'nodes': {host: lfns}, 
+	'errors': {host: message}}.
+	"""
+	counts = {}
+	lock = Lock()
+	def count(conn, host):
+		token = None
+		n = 0
+		while True:
+			page = conn.list_page(token, limit, pattern)
+			lfns = [r['lfn'] for r in page['items'] if r['status'] == 'ready']
+			n += len(lfns)
+			lock.acquire()
+			try:
+				for lfn in lfns:
+					counts[lfn] = counts.get(lfn, 0) + 1
+			finally:
+				lock.release()
+			token = page['token']
+			if token is None:
+				return n
+	results, errors = fanout(hosts, count, concurrency, timeout)
+	ranked = sorted(counts.items(), key=lambda i: (-i[1], i[0]))
+	return {'lfns': len(counts), 'top': [list(i) for i in ranked[:top]],
+			'nodes': results, 'errors': errors}
+
+def bloom(hosts, m=bits.DEFAULT_SIZE, k=bits.DEFAULT_HASHES, fpr=None,
+		  concurrency=CONCURRENCY, timeout=TIMEOUT):
+	"""
+	Build the union of the bloom filters of every cache. Filters that
+	were autotuned to different sizes are folded to the smallest one.
+	Returns {'filter': chunks, 'm': bits, 'k': hashes, 'popcount': 
+	bits set, 'nodes': {host: bits}, 'errors': {host: message}}.
+	"""
+	if fpr is not None:
+		k = bits.optimal_hashes(fpr)
+	results, errors = fanout(hosts, 
+		lambda conn, host: conn.get_bloom_filter(m, k, fpr),
+		concurrency, timeout)
+	filters = {}
+	for host, chunks in results.items():
+		filters[host] = bits.BloomFilter.decode(chunks, k)
+	result = {'filter': [], 'm': 0, 'k': k, 'popcount': 0,
+			  'nodes': dict([(h, f.m) for h, f in filters.items()]),
+			  'errors': errors}
+	if len(filters) == 0:
+		return result
+	size = min([f.m for f in filters.values()])
+	union = None
+	for f in filters.values():
+		if f.m > size:
+			f = f.fold(size)
+		if union is None:
+			union = f
+		else:
+			union = union | f
+	result['filter'] = union.encode()
+	result['m'] = union.m
+	result['popcount'] = union.popcount()
+	return result
+
+def clear(hosts, concurrency=CONCURRENCY, timeout=TIMEOUT):
+	"""
+	Clear every cache. Returns (cleared hosts, {host: message}).
+	"""
+	results, errors = fanout(hosts, lambda conn, host: conn.clear(),
+							 concurrency, timeout)
+	return sorted(results.keys()), errors
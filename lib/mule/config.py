@@ -13,9 +13,61 @@
 # limitations under the License.
 #
 import os
+from ConfigParser import SafeConfigParser
+
+CONFIG = None
 
 def get_home():
 	home = os.path.realpath(__file__)
 	for i in range(0,3):
 		home = os.path.dirname(home)
-	return home
\ No newline at end of file
+	return home
+
+def get_config_path():
+	path = os.getenv("MULE_CONFIG")
+	if path is None:
+		path = os.path.join(get_home(), "etc", "mule.conf")
+	return path
+
+def get_config():
+	"""
+	Return the parsed config file (MULE_CONFIG or MULE_HOME/etc/mule.conf).
+	A missing file is the same as an empty one.
+	"""
+	global CONFIG
+	if CONFIG is None:
+		c = SafeConfigParser()
+		c.read([get_config_path()])
+		CONFIG = c
+	return CONFIG
+
+def get(section, option, default=None):
+	c = get_config()
+	if c.has_option(section, option):
+		return c.get(section, option)
+	return default
+
+def getint(section, option, default=None):
+	value = get(section, option)
+	if value is None:
+		return default
+	return int(value)
+
+def parse_size(value):
+	"""
+	Parse a size in bytes with an optional K, M or G suffix
+	"""
+	value = value.strip().upper()
+	for suffix, scale in [('K', 1024), ('M', 1024**2), ('G', 1024**3)]:
+		if value.endswith(suffix):
+			return int(float(value[:-1]) * scale)
+	return int(value)
+
+def getsize(section, option, default=None):
+	"""
+	Get a size in bytes. The value can have a K, M or G suffix.
+	"""
+	value = get(section, option)
+	if value is None:
+		return default
+	return parse_size(value)
@@ -0,0 +1,171 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import time
+import shutil
+from threading import Lock, BoundedSemaphore
+
+from mule.local import FAILED
+
+__all__ = ["Device","place"]
+
+class Slot(object):
+	"""Holds one of a device's read or write slots while in a with block"""
+	def __init__(self, device, semaphore):
+		self.device = device
+		self.semaphore = semaphore
+	
+	def __enter__(self):
+		self.semaphore.acquire()
+		self.device.busy(1)
+		return self.device
+	
+	def __exit__(self, *exc):
+		self.device.busy(-1)
+		self.semaphore.release()
+		return False
+
+class Device(object):
+	"""
+	One cache root, normally a disk of its own. At most `writers` 
+	downloads and `readers` serves use it at once, so that a slow disk
+	holds up only its own requests. Once it has failed it gets no new
+	files.
+	"""
+	def __init__(self, index, root, writers=4, readers=16):
+		self.index = index
+		self.root = root
+		self.writers = BoundedSemaphore(writers)
+		self.readers = BoundedSemaphore(readers)
+		self.lock = Lock()
+		self.active = 0
+		self.failed = False
+		# Set once the records and RLS mappings of a failed device are gone
+		self.purged = False
+		self.purge_lock = Lock()
+	
+	def writing(self):
+		return Slot(self, self.writers)
+	
+	def reading(self):
+		return Slot(self, self.readers)
+	
+	def busy(self, n):
+		self.lock.acquire()
+		try:
+			self.active += n
+		finally:
+			self.lock.release()
+	
+	def free(self):
+		"""Bytes available on the device"""
+		st = os.statvfs(self.root)
+		return st.f_bavail * st.f_frsize
+	
+	def check(self):
+		"""
+		Return True if a file can be written to and removed from the
+		device
+		"""
+		probe = os.path.join(self.root, ".mule-probe")
+		try:
+			f = open(probe, 'wb')
+			try:
+				f.write("mule")
+			finally:
+				f.close()
+			os.unlink(probe)
+			return True
+		except (IOError, OSError):
+			return False
+
+	def quarantine(self):
+		"""
+		Stop clients from using the files of a failed device: rename 
+		the directory out of the way, or if that fails, write the 
+		FAILED marker that clients check. Returns False if neither 
+		worked.
+		"""
+		try:
+			os.rename(self.root, "%s.failed-%d" % (self.root, time.time()))
+			return True
+		except OSError:
+			pass
+		try:
+			open(os.path.join(self.root, FAILED), 'wb').close()
+			return True
+		except (IOError, OSError):
+			return False
+	
+	def quarantined(self):
+		"""Return True if the device was marked as failed by an earlier run"""
+		return os.path.exists(os.path.join(self.root, FAILED))
+	
+	def discard(self):
+		"""
+		Remove what is left of a failed device: the renamed directories
+		and, if it was only marked, the files in it. Errors are ignored,
+		since the device may be broken.
+		"""
+		parent, name = os.path.split(self.root)
+		try:
+			names = os.listdir(parent)
+		except OSError:
+			names = []
+		for n in names:
+			if n.startswith(name + ".failed-"):
+				shutil.rmtree(os.path.join(parent, n), True)
+		if self.quarantined():
+			try:
+				for n in os.listdir(self.root):
+					if n != FAILED:
+						path = os.path.join(self.root, n)
+						if os.path.isdir(path):
+							shutil.rmtree(path, True)
+						else:
+							os.unlink(path)
+			except OSError:
+				pass
+
+def place(devices):
+	"""
+	Choose the device for a new file: the working device with the most
+	free space per transfer in progress. Returns None if every device
+	has failed.
+	"""
+	best = None
+	best_score = None
+	for d in devices:
+		if d.failed:
+			continue
+		try:
+			score = float(d.free()) / (1 + d.active)
+		except OSError:
+			continue
+		if best is None or score > best_score:
+			best = d
+			best_score = score
+	return best
+
+if __name__ == '__main__':
+	a = Device(0, "/tmp")
+	b = Device(1, "/tmp")
+	print a.check(), a.free() > 0
+	with a.writing():
+		print place([a, b]).index
+	b.failed = True
+	print place([a, b]).index
+	a.failed = True
+	print place([a, b])
@@ -0,0 +1,185 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import random
+from threading import Lock
+
+__all__ = ["HotTier"]
+
+# Number of residents compared when choosing an entry to evict
+SAMPLES = 5
+
+# Number of generation counters that keys are spread over
+GENERATIONS = 256
+
+class HotTier(object):
+	"""
+	A bounded in-memory store for small, frequently requested files.
+
+	Every request for a key counts towards its frequency, whether or
+	not the key is resident. A new entry is admitted only if it fits,
+	or if it is requested more often than the residents it would push
+	out. Victims are the least frequent of a few randomly sampled
+	residents. Frequencies are halved every `period` requests so that
+	old popularity fades and the table of counts stays bounded.
+	"""
+	def __init__(self, max_bytes, max_size, period=None):
+		self.max_bytes = max_bytes
+		self.max_size = max_size
+		self.period = period or max(1000, 10 * max_bytes / max(1, max_size))
+		self.lock = Lock()
+		self.counts = {}
+		self.requests = 0
+		self.entries = {}
+		self.keys = []
+		self.index = {}
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		# Bumped by invalidate, so that data read before a key was 
+		# invalidated is not admitted after it
+		self.generations = [0] * GENERATIONS
+
+	def enabled(self):
+		return self.max_bytes > 0
+
+	def _touch(self, key):
+		self.counts[key] = self.counts.get(key, 0) + 1
+		self.requests += 1
+		if self.requests >= self.period:
+			self.requests = 0
+			for k, c in self.counts.items():
+				if c > 1:
+					self.counts[k] = c / 2
+				else:
+					del self.counts[k]
+
+	def _remove(self, key):
+		data, mtime = self.entries.pop(key)
+		self.bytes -= len(data)
+		# Swap the last key into the removed key's slot
+		i = self.index.pop(key)
+		last = self.keys.pop()
+		if last != key:
+			self.keys[i] = last
+			self.index[last] = i
+
+	def get(self, key):
+		"""
+		Return (data, mtime) for key, or None if it is not resident.
+		Counts as a request for key.
+		"""
+		self.lock.acquire()
+		try:
+			self._touch(key)
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+			return entry
+		finally:
+			self.lock.release()
+
+	def touch(self, key):
+		"""
+		Count a request for key that was served without asking the
+		tier, so that its frequency stays right
+		"""
+		self.lock.acquire()
+		try:
+			self._touch(key)
+		finally:
+			self.lock.release()
+
+	def generation(self, key):
+		"""
+		Return the generation of key, to pass to admit. Take it before 
+		reading the data.
+		"""
+		return self.generations[hash(key) % GENERATIONS]
+
+	def admit(self, key, data, mtime, generation=None):
+		"""
+		Offer data for key, after a get that missed. Returns True if it
+		was admitted. If generation is given, data is refused if key 
+		may have been invalidated since then.
+		"""
+		size = len(data)
+		if size > self.max_size or size > self.max_bytes:
+			return False
+		self.lock.acquire()
+		try:
+			if generation is not None and generation != self.generation(key):
+				return False
+			if key in self.entries:
+				return True
+			freq = self.counts.get(key, 0)
+			victims = []
+			free = self.max_bytes - self.bytes
+			tried = set()
+			while free < size:
+				candidates = [self.keys[random.randrange(len(self.keys))]
+							  for i in range(min(SAMPLES, len(self.keys)))]
+				candidates = [c for c in candidates if c not in tried]
+				if len(candidates) == 0:
+					return False
+				victim = min(candidates, key=lambda k: self.counts.get(k, 0))
+				if self.counts.get(victim, 0) >= freq:
+					# Not popular enough to displace what is resident
+					return False
+				tried.add(victim)
+				victims.append(victim)
+				free += len(self.entries[victim][0])
+			for victim in victims:
+				self._remove(victim)
+			self.entries[key] = (data, mtime)
+			self.index[key] = len(self.keys)
+			self.keys.append(key)
+			self.bytes += size
+			return True
+		finally:
+			self.lock.release()
+
+	def invalidate(self, key):
+		"""Drop key, for example when the file is removed"""
+		self.lock.acquire()
+		try:
+			self.generations[hash(key) % GENERATIONS] += 1
+			if key in self.entries:
+				self._remove(key)
+		finally:
+			self.lock.release()
+
+	def clear(self):
+		self.lock.acquire()
+		try:
+			self.counts = {}
+			self.generations = [g + 1 for g in self.generations]
+			self.entries = {}
+			self.keys = []
+			self.index = {}
+			self.bytes = 0
+		finally:
+			self.lock.release()
+
+if __name__ == '__main__':
+	h = HotTier(100, 40)
+	for key in ['a','a','b','c','a','b']:
+		if h.get(key) is None:
+			print key, "admitted", h.admit(key, 'x' * 40, 0)
+	print sorted(h.entries.keys()), h.bytes, h.hits, h.misses
+	g = h.generation('d')
+	h.invalidate('d')
+	print "d admitted after invalidate", h.admit('d', 'x', 0, g)
@@ -0,0 +1,101 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import errno
+import hashlib
+
+# The layout of the cache directory, shared by the cache daemon and
+# the client. Files appear at their final name only once they are
+# complete (downloads and copies are written to a .part file and 
+# renamed), so the client can serve a hit itself by finding the file.
+
+__all__ = ["get_uuid","get_cfn","find","get_local","PART","FAILED"]
+
+DEFAULT_DIR = os.getenv("MULE_CACHE_DIR", "/tmp/mule")
+
+# Suffix of files that are still being written
+PART = ".part"
+
+# Written to a cache directory that has failed, if it could not be 
+# renamed out of the way. Its files must not be used.
+FAILED = ".mule-failed"
+
+BLOCK_SIZE = 64*1024
+
+def get_uuid(lfn):
+	"""
+	Generate a unique ID for lfn
+	"""
+	return hashlib.sha1(lfn).hexdigest()
+
+def get_cfn(cache_dir, uuid):
+	"""
+	Generate a path for a given uuid in the cache
+	"""
+	l1 = uuid[0:2]
+	l2 = uuid[2:4]
+	return os.path.join(cache_dir, l1, l2, uuid)
+
+def find(cache_dir, uuid):
+	"""
+	Return the path of the complete file for uuid in any of the comma
+	separated cache directories that have not failed, or None
+	"""
+	for root in cache_dir.split(","):
+		cfn = get_cfn(root, uuid)
+		if os.path.isfile(cfn) and not os.path.exists(os.path.join(root, FAILED)):
+			return cfn
+	return None
+
+def get_local(lfn, path, symlink, cache_dir=DEFAULT_DIR):
+	"""
+	Link or copy the cached copy of lfn to path without asking the
+	cache daemon. cache_dir is a comma separated list of the daemon's
+	directories. Returns False if lfn is not in any of them as a plain
+	file (not cached, still downloading, or packed), in which case the
+	daemon must be asked.
+	"""
+	cfn = find(cache_dir, get_uuid(lfn))
+	if cfn is None:
+		return False
+	d = os.path.dirname(path)
+	if not os.path.isdir(d):
+		try:
+			os.makedirs(d)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+	if symlink:
+		os.symlink(cfn, path)
+		return True
+	# Opening first means a concurrent remove cannot truncate the copy
+	try:
+		f = open(cfn, 'rb')
+	except IOError, e:
+		if e.errno == errno.ENOENT:
+			return False
+		raise
+	try:
+		g = open(path, 'wb')
+		try:
+			while True:
+				buf = f.read(BLOCK_SIZE)
+				if not buf: break
+				g.write(buf)
+		finally:
+			g.close()
+	finally:
+		f.close()
+	return True
@@ -14,12 +14,14 @@
 #
 import os
 import sys
+import atexit
 import logging
 import logging.handlers
-from datetime import datetime
+from threading import Thread, Lock, Event
+from Queue import Queue, Full
 from mule import config
 
-__all__ = ["get_log","DEBUG","INFO","WARNING","ERROR","CRITICAL"]
+__all__ = ["get_log","configure","DEBUG","INFO","WARNING","ERROR","CRITICAL"]
 	
 FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
 
@@ -31,56 +33,201 @@ CRITICAL = logging.CRITICAL
 
 DEFAULT_LEVEL = INFO
 
-CONSOLE = None
-FILE = None
+# Records waiting for the writer thread. When the queue is full records
+# are dropped rather than making the caller wait.
+QUEUE_SIZE = config.getint("log", "queue_size", 10000)
+
+# Log files are rotated when they reach MAX_BYTES
+MAX_BYTES = config.getsize("log", "max_bytes", 10*1024*1024)
+BACKUPS = config.getint("log", "backups", 5)
+
+# Loggers created with sampled=True pass the first and then every 
+# SAMPLE-th DEBUG or INFO record with the same format string
+SAMPLE = config.getint("log", "sample", 100)
+
+# Seconds to wait at exit for queued records to be written
+FLUSH_TIMEOUT = 5
+
+WRITER = None
+
+class Flush(object):
+	"""Queued by LogWriter.flush; set once the records before it are written"""
+	def __init__(self):
+		self.done = Event()
+
+class LogWriter(Thread):
+	"""
+	Writes queued records to the real handlers, so that the threads
+	that log never wait for file writes or rotation
+	"""
+	def __init__(self, handlers, size=QUEUE_SIZE):
+		Thread.__init__(self)
+		self.setDaemon(True)
+		self.handlers = handlers
+		self.queue = Queue(size)
+		self.lock = Lock()
+		self.dropped = 0
+		
+	def put(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except Full:
+			self.lock.acquire()
+			try:
+				self.dropped += 1
+			finally:
+				self.lock.release()
+	
+	def run(self):
+		while True:
+			record = self.queue.get()
+			if isinstance(record, Flush):
+				record.done.set()
+				continue
+			self.lock.acquire()
+			try:
+				dropped = self.dropped
+				self.dropped = 0
+			finally:
+				self.lock.release()
+			if dropped > 0:
+				self.write(logging.LogRecord("log", WARNING, __file__, 0,
+					"Log queue full: dropped %d records", (dropped,), None))
+			self.write(record)
+	
+	def write(self, record):
+		for handler in self.handlers:
+			if record.levelno >= handler.level:
+				try:
+					handler.handle(record)
+				except Exception:
+					handler.handleError(record)
+	
+	def flush(self, timeout=FLUSH_TIMEOUT):
+		"""Wait for the records queued so far to be written"""
+		marker = Flush()
+		try:
+			self.queue.put(marker, True, timeout)
+		except Full:
+			return
+		marker.done.wait(timeout)
+
+class QueueHandler(logging.Handler):
+	"""Hands records to a LogWriter"""
+	def __init__(self, writer):
+		logging.Handler.__init__(self)
+		self.writer = writer
+		self.formatter = logging.Formatter(FORMAT)
+	
+	def emit(self, record):
+		# Render the traceback now, so that the frames it refers to 
+		# can be freed, and so the writer does not see them change
+		if record.exc_info:
+			record.exc_text = self.formatter.formatException(record.exc_info)
+			record.exc_info = None
+		self.writer.put(record)
+
+class Sampler(logging.Filter):
+	"""
+	Passes the first and every n-th DEBUG or INFO record with the same
+	format string. Warnings and errors always pass.
+	"""
+	def __init__(self, n):
+		logging.Filter.__init__(self)
+		self.n = n
+		self.counts = {}
+		self.lock = Lock()
+	
+	def filter(self, record):
+		if record.levelno >= WARNING:
+			return True
+		self.lock.acquire()
+		try:
+			count = self.counts.get(record.msg, 0)
+			self.counts[record.msg] = count + 1
+		finally:
+			self.lock.release()
+		return count % self.n == 0
 
 def create_console_handler():
 	formatter = logging.Formatter(FORMAT)
 	handler = logging.StreamHandler(sys.stdout)
-	handler.setLevel(DEFAULT_LEVEL)
 	handler.setFormatter(formatter)
 	return handler
 	
-def create_file_handler():
+def create_file_handler(logfile=None):
 	exe = os.path.basename(sys.argv[0])
-	if exe == "mule-cache":
-		logfile = os.path.join(config.get_home(),"var","cache.log")
-		formatter = logging.Formatter(FORMAT)
-		handler = logging.handlers.RotatingFileHandler(logfile,maxBytes=100000,backupCount=1)
-		handler.setLevel(DEFAULT_LEVEL)
-		handler.setFormatter(formatter)
-		return handler
-	elif exe == "mule-rls":
-		logfile = os.path.join(config.get_home(),"var","rls.log")
-		formatter = logging.Formatter(FORMAT)
-		handler = logging.handlers.RotatingFileHandler(logfile,maxBytes=100000,backupCount=1)
-		handler.setLevel(DEFAULT_LEVEL)
-		handler.setFormatter(formatter)
-		return handler
-	else:
-		# Everything else has no log file, only console
-		return None
-
-def configure():
-	"""Configure logging for this process"""
-	global CONSOLE
-	global FILE
-	CONSOLE = create_console_handler()
-	FILE = create_file_handler()
-
-def get_log(name, level=DEBUG):
-	"""Get a logger instance with the given name"""
-	global CONSOLE
-	global FILE
+	if logfile is None:
+		if exe == "mule-cache":
+			logfile = os.path.join(config.get_home(),"var","cache.log")
+		elif exe == "mule-rls":
+			logfile = os.path.join(config.get_home(),"var","rls.log")
+		else:
+			# Everything else has no log file, only console
+			return None
+	formatter = logging.Formatter(FORMAT)
+	handler = logging.handlers.RotatingFileHandler(logfile,
+		maxBytes=MAX_BYTES, backupCount=BACKUPS)
+	handler.setFormatter(formatter)
+	return handler
+
+def configure(logfile=None):
+	"""Configure logging for this process. If logfile is None then
+	the default log file for the current program is used. Records are 
+	written by a background thread."""
+	global WRITER
+	handlers = [create_console_handler()]
+	f = create_file_handler(logfile)
+	if f is not None:
+		handlers.append(f)
+	root = logging.getLogger()
+	for h in root.handlers[:]:
+		if isinstance(h, QueueHandler):
+			root.removeHandler(h)
+	WRITER = LogWriter(handlers)
+	WRITER.start()
+	root.addHandler(QueueHandler(WRITER))
+
+def flush():
+	"""Wait for queued records to be written"""
+	if WRITER is not None:
+		WRITER.flush()
+
+atexit.register(flush)
+
+def get_level(name):
+	"""
+	Return the level for a logger from the [log] section of mule.conf.
+	The subsystem is the first word of the logger's name, so that, for
+	example, "downloader = debug" applies to all the download threads.
+	"level" is the default for subsystems that are not listed.
+	"""
+	subsystem = name.split()[0].lower()
+	value = config.get("log", subsystem) or config.get("log", "level")
+	if value is None:
+		return DEFAULT_LEVEL
+	level = logging.getLevelName(value.strip().upper())
+	if not isinstance(level, int):
+		raise ValueError("Invalid log level for %s: %s" % (subsystem, value))
+	return level
+
+def get_log(name, level=None, sampled=False):
+	"""Get a logger instance with the given name. The level defaults
+	to the configured level of its subsystem. Pass format arguments 
+	to the logging calls instead of formatting messages yourself, so
+	that records that are not logged are never formatted."""
 	logger = logging.getLogger(name)
+	if level is None:
+		level = get_level(name)
 	logger.setLevel(level)
-	if CONSOLE is not None: logger.addHandler(CONSOLE)
-	if FILE is not None: logger.addHandler(FILE)
+	if sampled and SAMPLE > 1:
+		if len([f for f in logger.filters if isinstance(f, Sampler)]) == 0:
+			logger.addFilter(Sampler(SAMPLE))
 	return logger
 
 if __name__ == '__main__':
 	configure()
-	log = get_log("foo")
+	log = get_log("foo", DEBUG)
 	log.debug("debug message")
 	log.info("info message")
 	log.warn("warning message")
@@ -89,7 +236,9 @@ if __name__ == '__main__':
 		raise Exception("exception message")
 	except Exception, e:
 		log.exception(e)
-		
-	log2 = get_log("bar")
-	print log.handlers
-	print log2.handlers
\ No newline at end of file
+	
+	log2 = get_log("bar", sampled=True)
+	for i in range(0, 250):
+		log2.info("request %d", i)
+	log2 = get_log("bar", sampled=True)
+	print log.handlers, log2.filters
@@ -0,0 +1,194 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import time
+from bisect import bisect_left
+from thread import get_ident
+from threading import Lock
+
+__all__ = ["Counter","Histogram","Gauge","Registry"]
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+				   0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Counter(object):
+	"""
+	A counter that only goes up. Each thread increments its own cell,
+	so increments never wait on a lock; value() adds up the cells.
+	"""
+	def __init__(self):
+		self._cells = {}
+
+	def increment(self, i=1):
+		tid = get_ident()
+		cells = self._cells
+		cells[tid] = cells.get(tid, 0) + i
+
+	def value(self):
+		return sum(self._cells.values())
+
+	def samples(self, name, labels):
+		return [(name, labels, self.value())]
+
+class Timer(object):
+	"""Context manager that records its duration in a histogram"""
+	def __init__(self, histogram):
+		self.histogram = histogram
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, t, v, tb):
+		self.histogram.observe(time.time() - self.start)
+
+class Histogram(object):
+	"""
+	A histogram of observed values, with per-thread cells like Counter.
+	Each cell holds a count for each bucket, then +Inf, then the sum.
+	"""
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = tuple(buckets)
+		self._cells = {}
+
+	def observe(self, value):
+		tid = get_ident()
+		cell = self._cells.get(tid)
+		if cell is None:
+			cell = [0] * (len(self.buckets) + 2)
+			self._cells[tid] = cell
+		cell[bisect_left(self.buckets, value)] += 1
+		cell[-1] += value
+
+	def time(self):
+		"""Return a context manager that times a block of code"""
+		return Timer(self)
+
+	def samples(self, name, labels):
+		totals = [0] * (len(self.buckets) + 2)
+		for cell in self._cells.values():
+			for i in range(0, len(cell)):
+				totals[i] += cell[i]
+		result = []
+		cumulative = 0
+		for i in range(0, len(self.buckets)):
+			cumulative += totals[i]
+			le = labels + (("le", "%g" % self.buckets[i]),)
+			result.append((name + "_bucket", le, cumulative))
+		cumulative += totals[-2]
+		result.append((name + "_bucket", labels + (("le", "+Inf"),), cumulative))
+		result.append((name + "_count", labels, cumulative))
+		result.append((name + "_sum", labels, totals[-1]))
+		return result
+
+class Gauge(object):
+	"""A value that is computed by calling a function when it is read"""
+	def __init__(self, function):
+		self.function = function
+
+	def value(self):
+		return self.function()
+
+	def samples(self, name, labels):
+		return [(name, labels, self.value())]
+
+class Family(object):
+	"""A metric with labels. Each distinct set of label values gets
+	its own child metric."""
+	def __init__(self, name, help, kind, labels, factory):
+		self.name = name
+		self.help = help
+		self.kind = kind
+		self.label_names = tuple(labels)
+		self.factory = factory
+		self.children = {}
+
+	def labels(self, *values):
+		child = self.children.get(values)
+		if child is None:
+			# setdefault is atomic, so racing threads share one child
+			child = self.children.setdefault(values, self.factory())
+		return child
+
+	def samples(self):
+		result = []
+		for values, child in self.children.items():
+			labels = tuple(zip(self.label_names, values))
+			result.extend(child.samples(self.name, labels))
+		return result
+
+def escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Registry(object):
+	"""
+	A collection of metrics that can be rendered in the Prometheus
+	text exposition format
+	"""
+	def __init__(self):
+		self.lock = Lock()
+		self.families = []
+
+	def _register(self, name, help, kind, labels, factory):
+		family = Family(name, help, kind, labels, factory)
+		self.lock.acquire()
+		try:
+			self.families.append(family)
+		finally:
+			self.lock.release()
+		if len(labels) == 0:
+			return family.labels()
+		return family
+
+	def counter(self, name, help, labels=()):
+		return self._register(name, help, "counter", labels, Counter)
+
+	def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+		return self._register(name, help, "histogram", labels,
+							  lambda: Histogram(buckets))
+
+	def gauge(self, name, help, function):
+		return self._register(name, help, "gauge", (), lambda: Gauge(function))
+
+	def counter_function(self, name, help, function):
+		"""A counter whose total is kept elsewhere and read by function"""
+		return self._register(name, help, "counter", (), lambda: Gauge(function))
+
+	def render(self):
+		"""Render all metrics in the text exposition format"""
+		lines = []
+		for family in list(self.families):
+			lines.append("# HELP %s %s" % (family.name, family.help))
+			lines.append("# TYPE %s %s" % (family.name, family.kind))
+			for name, labels, value in family.samples():
+				if len(labels) > 0:
+					name = "%s{%s}" % (name, ",".join(['%s="%s"' % (k, escape(v))
+						for k, v in labels]))
+				lines.append("%s %s" % (name, value))
+		return "\n".join(lines) + "\n"
+
+if __name__ == '__main__':
+	r = Registry()
+	c = r.counter("test_total", "A test counter")
+	c.increment()
+	c.increment(2)
+	h = r.histogram("test_seconds", "A test histogram", ["phase"])
+	h.labels("download").observe(0.02)
+	h.labels("download").observe(3)
+	with h.labels("link").time():
+		time.sleep(0.01)
+	r.gauge("test_gauge", "A test gauge", lambda: 42)
+	r.counter_function("test_function_total", "A test function counter", lambda: 7)
+	print r.render()
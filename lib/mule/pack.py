@@ -0,0 +1,156 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+from threading import Lock
+
+__all__ = ["PackStore"]
+
+BLOCK_SIZE = 64*1024
+
+class PackStore(object):
+	"""
+	Append-only pack files for small cache entries. Each entry is
+	stored as a byte range (pack, offset, size) of a pack file; the
+	caller keeps the index. New entries are appended to the current
+	pack, and a new pack is started when it reaches max_pack bytes.
+	Space is reclaimed by copying the live entries out of a pack and
+	removing it (see Cache.compact). Callers call done(pack) once an
+	appended entry is in their index; until then the pack is busy and
+	must not be compacted.
+	"""
+	def __init__(self, directory, max_pack=256*1024*1024):
+		self.directory = directory
+		self.max_pack = max_pack
+		self.lock = Lock()
+		# pack -> entries appended but not yet indexed
+		self.pending = {}
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		packs = self.packs()
+		if len(packs) > 0:
+			self.current = packs[-1]
+		else:
+			self.current = 1
+
+	def path(self, pack):
+		return os.path.join(self.directory, "pack-%06d" % pack)
+
+	def packs(self):
+		"""Return the ids of all pack files, oldest first"""
+		result = []
+		for name in os.listdir(self.directory):
+			if name.startswith("pack-"):
+				result.append(int(name[5:]))
+		result.sort()
+		return result
+
+	def size(self, pack):
+		try:
+			return os.path.getsize(self.path(pack))
+		except OSError:
+			return 0
+
+	def _append(self, write):
+		self.lock.acquire()
+		try:
+			pack = self.current
+			f = open(self.path(pack), 'ab')
+			try:
+				f.seek(0, 2)
+				offset = f.tell()
+				size = write(f)
+			finally:
+				f.close()
+			if offset + size >= self.max_pack:
+				self.current += 1
+			self.pending[pack] = self.pending.get(pack, 0) + 1
+			return (pack, offset, size)
+		finally:
+			self.lock.release()
+
+	def append_file(self, path):
+		"""Append the contents of path. Returns (pack, offset, size)."""
+		def write(f):
+			src = open(path, 'rb')
+			try:
+				total = 0
+				while True:
+					buf = src.read(BLOCK_SIZE)
+					if not buf: break
+					f.write(buf)
+					total += len(buf)
+				return total
+			finally:
+				src.close()
+		return self._append(write)
+
+	def append_data(self, data):
+		"""Append a string. Returns (pack, offset, size)."""
+		def write(f):
+			f.write(data)
+			return len(data)
+		return self._append(write)
+
+	def done(self, pack):
+		"""Record that an entry appended to pack has been indexed"""
+		self.lock.acquire()
+		try:
+			n = self.pending.get(pack, 0) - 1
+			if n > 0:
+				self.pending[pack] = n
+			else:
+				self.pending.pop(pack, None)
+		finally:
+			self.lock.release()
+	
+	def busy(self):
+		"""Return the set of packs with entries that are not indexed yet"""
+		self.lock.acquire()
+		try:
+			return set(self.pending.keys())
+		finally:
+			self.lock.release()
+	
+	def open(self, pack, offset):
+		"""Open pack and seek to offset"""
+		f = open(self.path(pack), 'rb')
+		f.seek(offset)
+		return f
+
+	def read(self, pack, offset, size):
+		f = self.open(pack, offset)
+		try:
+			return f.read(size)
+		finally:
+			f.close()
+
+	def remove(self, pack):
+		"""Remove a pack once none of its entries are indexed"""
+		self.lock.acquire()
+		try:
+			if pack == self.current:
+				self.current += 1
+			os.unlink(self.path(pack))
+		finally:
+			self.lock.release()
+
+	def clear(self):
+		self.lock.acquire()
+		try:
+			for pack in self.packs():
+				os.unlink(self.path(pack))
+			self.current = 1
+		finally:
+			self.lock.release()
@@ -0,0 +1,291 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import tempfile
+from threading import Thread, Lock, Semaphore
+from optparse import OptionParser
+
+# Note: mule.bench is imported inside the functions that use it
+# because it imports mule.cache, which imports this module.
+
+__all__ = ["configure","record"]
+
+# Size used for LFNs whose size was not recorded
+DEFAULT_SIZE = 64*1024
+
+RECORDER = None
+
+class Recorder(object):
+	"""
+	Appends one JSON object per cache call to a file. Each record has
+	the operation (op), start time (t), duration (d), host (h), and a
+	list of [lfn, size, outcome] items, plus an error (e) if the call
+	failed.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.host = socket.getfqdn()
+		self.lock = Lock()
+		self.f = open(path, 'a')
+
+	def record(self, op, start, end, items, error=None):
+		rec = {'op': op, 't': start, 'd': end - start, 'h': self.host,
+			   'items': items}
+		if error is not None:
+			rec['e'] = error
+		line = json.dumps(rec, separators=(',',':')) + "\n"
+		self.lock.acquire()
+		try:
+			self.f.write(line)
+			self.f.flush()
+		finally:
+			self.lock.release()
+
+def configure(path):
+	"""Record cache calls in path. If path is None then recording is
+	disabled."""
+	global RECORDER
+	if path is None:
+		RECORDER = None
+	else:
+		RECORDER = Recorder(path)
+
+def record(op, start, items, error=None):
+	"""Record a call that started at start, if recording is enabled"""
+	if RECORDER is not None:
+		RECORDER.record(op, start, time.time(), items, error)
+
+def read_trace(path):
+	"""Read the records in a captured trace, sorted by start time"""
+	records = []
+	f = open(path)
+	try:
+		for line in f:
+			line = line.strip()
+			if len(line) == 0:
+				continue
+			try:
+				records.append(json.loads(line))
+			except ValueError:
+				sys.stderr.write("WARNING: Skipping bad line in %s\n" % path)
+	finally:
+		f.close()
+	records.sort(key=lambda r: r['t'])
+	return records
+
+class Replay(object):
+	"""
+	Replays a captured trace against a LocalCluster. Each host in the
+	trace is mapped to one of the cluster's caches. LFNs that are read
+	before they are written are created on the cluster's origin.
+	"""
+	def __init__(self, cluster, workdir, records, speed, concurrency):
+		self.cluster = cluster
+		self.workdir = workdir
+		self.records = records
+		self.speed = speed
+		self.slots = Semaphore(concurrency)
+		self.lock = Lock()
+		self.hosts = {}
+		self.latency = {}
+		self.errors = {}
+		self.lateness = []
+
+	def prepare(self):
+		"""Put every LFN that is read before it is written on the origin"""
+		sizes = {}
+		written = set()
+		origin = {}
+		for rec in self.records:
+			for lfn, size, outcome in rec['items']:
+				if size is not None:
+					sizes[lfn] = size
+				if rec['op'] in ('put', 'multiput'):
+					written.add(lfn)
+				elif rec['op'] in ('get', 'multiget') and lfn not in written:
+					origin[lfn] = True
+		mappings = []
+		for i, lfn in enumerate(origin):
+			name = "lfn_%d" % i
+			url = self.cluster.add_origin_file(name, sizes.get(lfn, DEFAULT_SIZE))
+			mappings.append([lfn, url])
+		if len(mappings) > 0:
+			self.cluster.rls().multiadd(mappings)
+		self.sizes = sizes
+
+	def cache_for(self, host):
+		self.lock.acquire()
+		try:
+			if host not in self.hosts:
+				self.hosts[host] = len(self.hosts) % len(self.cluster.cache_ports)
+			return self.cluster.cache(self.hosts[host])
+		finally:
+			self.lock.release()
+
+	def call(self, n, rec):
+		conn = self.cache_for(rec.get('h'))
+		op = rec['op']
+		start = time.time()
+		try:
+			try:
+				if op in ('get', 'multiget'):
+					d = os.path.join(self.workdir, "calls", str(n))
+					os.makedirs(d)
+					pairs = [[lfn, os.path.join(d, str(i))]
+						for i, (lfn, size, outcome) in enumerate(rec['items'])]
+					conn.multiget(pairs, True)
+				elif op in ('put', 'multiput'):
+					from mule import bench
+					d = os.path.join(self.workdir, "calls", str(n))
+					os.makedirs(d)
+					pairs = []
+					for i, (lfn, size, outcome) in enumerate(rec['items']):
+						path = os.path.join(d, str(i))
+						bench.write_file(path, self.sizes.get(lfn, DEFAULT_SIZE))
+						pairs.append([path, lfn])
+					conn.multiput(pairs, True)
+				elif op == 'remove':
+					for lfn, size, outcome in rec['items']:
+						conn.remove(lfn, True)
+			except Exception, e:
+				self.lock.acquire()
+				self.errors[op] = self.errors.get(op, 0) + 1
+				self.lock.release()
+				sys.stderr.write("ERROR: %s: %s\n" % (op, e))
+		finally:
+			elapsed = time.time() - start
+			self.lock.acquire()
+			self.latency.setdefault(op, []).append(elapsed)
+			self.lock.release()
+			self.slots.release()
+
+	def run(self):
+		from mule import bench
+		self.prepare()
+		threads = []
+		t0 = self.records[0]['t']
+		start = time.time()
+		for n, rec in enumerate(self.records):
+			if self.speed > 0:
+				due = start + (rec['t'] - t0) / self.speed
+				delay = due - time.time()
+				if delay > 0:
+					time.sleep(delay)
+				else:
+					self.lateness.append(-delay)
+			self.slots.acquire()
+			t = Thread(target=self.call, args=(n, rec))
+			t.start()
+			threads.append(t)
+		for t in threads:
+			t.join()
+		elapsed = time.time() - start
+
+		stats = self.cluster.stats()
+		gets = max(1, stats.get('gets', 0))
+		recorded = {}
+		for rec in self.records:
+			for lfn, size, outcome in rec['items']:
+				recorded[outcome] = recorded.get(outcome, 0) + 1
+		return {
+			'calls': len(self.records),
+			'seconds': elapsed,
+			'speed': self.speed,
+			'latency': dict([(op, bench.summarize(l)) for op, l in self.latency.items()]),
+			'errors': self.errors,
+			'lateness': bench.summarize(self.lateness),
+			'hit_rate': float(stats.get('hits', 0)) / gets,
+			'near_miss_rate': float(stats.get('near_misses', 0)) / gets,
+			'miss_rate': float(stats.get('misses', 0)) / gets,
+			'recorded_outcomes': recorded,
+			'cache_stats': stats
+		}
+
+def main():
+	from mule import bench
+	parser = OptionParser("Usage: %prog [options] TRACE")
+	parser.add_option("-c", "--caches", action="store", dest="caches",
+		default=None, type="int", metavar="N",
+		help="Number of cache daemons [default: one per host in TRACE]")
+	parser.add_option("-t", "--threads", action="store", dest="threads",
+		default=4, type="int", metavar="N",
+		help="Download threads per cache [default: %default]")
+	parser.add_option("-j", "--concurrency", action="store", dest="concurrency",
+		default=64, type="int", metavar="N",
+		help="Maximum number of calls in progress [default: %default]")
+	parser.add_option("-x", "--speed", action="store", dest="speed",
+		default=1.0, type="float", metavar="X",
+		help="Replay X times faster than recorded, 0 for as fast as possible [default: %default]")
+	parser.add_option("-p", "--port", action="store", dest="port",
+		default=bench.BASE_PORT, type="int", metavar="PORT",
+		help="First port to use [default: %default]")
+	parser.add_option("-w", "--workdir", action="store", dest="workdir",
+		default=None, metavar="DIR",
+		help="Working directory [default: temporary directory]")
+	parser.add_option("-k", "--keep", action="store_true", dest="keep",
+		default=False, help="Do not remove the working directory")
+	parser.add_option("-o", "--output", action="store", dest="output",
+		default=None, metavar="FILE",
+		help="Write JSON results to FILE [default: stdout]")
+	(options, args) = parser.parse_args()
+
+	if len(args) != 1:
+		parser.error("Specify TRACE")
+	if options.speed < 0:
+		parser.error("--speed must be >= 0")
+
+	records = read_trace(args[0])
+	if len(records) == 0:
+		parser.error("%s is empty" % args[0])
+
+	caches = options.caches
+	if caches is None:
+		caches = len(set([r.get('h') for r in records]))
+
+	if options.workdir:
+		workdir = os.path.abspath(options.workdir)
+		os.makedirs(workdir)
+	else:
+		workdir = tempfile.mkdtemp(prefix="mule-replay-")
+
+	cluster = bench.LocalCluster(workdir, caches, options.threads, options.port)
+	try:
+		cluster.start()
+		results = Replay(cluster, workdir, records, options.speed,
+						 options.concurrency).run()
+		results['caches'] = caches
+		results['threads'] = options.threads
+	finally:
+		cluster.stop()
+		if not options.keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+	output = json.dumps(results, indent=2, sort_keys=True)
+	if options.output:
+		f = open(options.output, 'w')
+		try:
+			f.write(output + "\n")
+		finally:
+			f.close()
+	else:
+		print output
+
+if __name__ == '__main__':
+	main()
@@ -15,22 +15,278 @@
 import sys
 import os
 import signal
+import socket
+import random
+import time
+import httplib
+from threading import Thread
+from urlparse import urlparse
 from optparse import OptionParser
-from xmlrpclib import ServerProxy
+from xmlrpclib import ServerProxy, Fault, ProtocolError
 
-from mule import config, log, util, server
+from mule import config, log, util, server, metrics, trace, catalog
+from mule.rpc import TimeoutTransport
 from mule import bdb as db
 
 RLS_PORT = 3880
 
-def connect(host='localhost', port=RLS_PORT):
+# Locality classes used to rank PFNs, nearest first
+SAME_HOST = 0
+SAME_RACK = 1
+PEER = 2
+ORIGIN = 3
+
+# Mappings of a host whose lease has lapsed are hidden from lookups
+# immediately, and deleted once the lease has been lapsed for GRACE
+# seconds.
+GRACE = 600
+
+# Maximum number of mappings written per transaction by register,
+# multiadd and multidelete
+REGISTER_BATCH = 1000
+
+# Maximum number of LFNs returned by list_page
+MAX_PAGE = 10000
+
+# Directory that export writes snapshots to. Callers only choose the 
+# file name.
+EXPORT_DIR = config.get("rls", "export_dir") or os.path.join(config.get_home(), "var", "exports")
+
+# Number of change log entries the primary keeps for replicas. A 
+# replica that falls further behind than this copies everything.
+MAX_CHANGES = 1000000
+
+# Maximum number of changes a replica applies per transaction
+REPLICATE_BATCH = 1000
+
+# How often replicas poll the primary for changes
+POLL_INTERVAL = 1
+
+# How long a replica waits to catch up with a read-your-writes
+# sequence number before refusing the read
+CATCHUP_WAIT = 2
+
+# How long the health and distance of a replica are remembered
+HEALTH_TTL = 30
+
+# Timeout for replica health probes
+PROBE_TIMEOUT = 2
+
+# Replicas that were last caught up more than MAX_LAG seconds ago are
+# only read from when no replica is closer to date
+MAX_LAG = float(os.getenv("MULE_RLS_MAX_LAG", 10))
+
+# Methods that replicas can serve
+READS = ['lookup','multilookup','lookup_attrs','list_page','ready']
+
+# Reads that take a min_seq argument, and its position
+MIN_SEQ_ARG = { 'lookup': 3, 'multilookup': 3 }
+
+# Writes that return the sequence number of the change
+WRITES = ['add','multiadd','delete','multidelete']
+
+# Sequence number of the last write by this process
+LAST_SEQ = 0
+
+# host -> ((round trip time, lag in seconds) or None if unusable, 
+# time checked)
+HEALTH = {}
+
+def connect_one(host, port=RLS_PORT, timeout=None):
+	if ':' in host:
+		host, port = host.split(':', 1)
 	uri = "http://%s:%s" % (host,port)
-	return ServerProxy(uri, allow_none=True)
+	if timeout is None:
+		return ServerProxy(uri, allow_none=True)
+	return ServerProxy(uri, transport=TimeoutTransport(timeout), allow_none=True)
+
+def connect(host='localhost', port=RLS_PORT, consistent=False):
+	"""
+	Connect to the RLS running at host:port. The port can also be
+	given as part of host. host can be a comma-separated list of a 
+	primary RLS followed by its replicas, in which case reads go to
+	the nearest healthy replica and writes go to the primary. If 
+	consistent is true then reads see this process's earlier writes.
+	"""
+	if ',' in host:
+		return RoutingProxy(host.split(','), port, consistent)
+	return connect_one(host, port)
+
+def probe(host, port):
+	"""
+	Return (round trip time, lag in seconds) for the RLS at host, or
+	None if it is down or copying the primary. Results are cached for
+	HEALTH_TTL seconds.
+	"""
+	now = time.time()
+	health = HEALTH.get(host)
+	if health is not None and now - health[1] < HEALTH_TTL:
+		return health[0]
+	try:
+		st = connect_one(host, port, PROBE_TIMEOUT).status()
+		state = (time.time() - now, st.get('lag_seconds', 0))
+		if st.get('resyncing'):
+			state = None
+	except Exception:
+		state = None
+	HEALTH[host] = (state, now)
+	return state
+
+class RoutingProxy(object):
+	"""
+	Sends reads to the nearest healthy replica, falling back to the
+	primary (hosts[0]), and sends everything else to the primary
+	"""
+	def __init__(self, hosts, port, consistent):
+		self.primary = hosts[0]
+		self.replicas = hosts[1:]
+		self.port = port
+		self.consistent = consistent
+	
+	def nearest(self):
+		"""
+		Return the usable replicas, the ones that are up to date 
+		(within MAX_LAG seconds) first, nearest first
+		"""
+		up = []
+		for host in self.replicas:
+			state = probe(host, self.port)
+			if state is not None:
+				rtt, lag = state
+				up.append((lag > MAX_LAG, rtt, host))
+		up.sort()
+		return [host for behind, rtt, host in up]
+	
+	def read(self, name, args):
+		if self.consistent and name in MIN_SEQ_ARG and LAST_SEQ > 0:
+			n = MIN_SEQ_ARG[name]
+			args = list(args) + [None] * (n - len(args)) + [LAST_SEQ]
+		for host in self.nearest():
+			try:
+				return getattr(connect_one(host, self.port), name)(*args)
+			except Fault:
+				# Probably behind; try the next one
+				pass
+			except (socket.error, ProtocolError, httplib.HTTPException):
+				# Down or restarting
+				HEALTH[host] = (None, time.time())
+		return getattr(connect_one(self.primary, self.port), name)(*args)
+	
+	def write(self, name, args):
+		global LAST_SEQ
+		result = getattr(connect_one(self.primary, self.port), name)(*args)
+		if name in WRITES and isinstance(result, int):
+			LAST_SEQ = max(LAST_SEQ, result)
+		return result
+	
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		def call(*args):
+			if name in READS:
+				return self.read(name, args)
+			return self.write(name, args)
+		return call
+
+def locality(pfn, attrs, hint):
+	"""
+	Return the locality class of pfn for a client described by hint, 
+	which is a dict with optional 'host' and 'rack' keys.
+	"""
+	host = attrs.get('host') or urlparse(pfn)[1].split(':')[0]
+	rack = attrs.get('rack')
+	if hint:
+		if host and host == hint.get('host'):
+			return SAME_HOST
+		if rack and rack == hint.get('rack'):
+			return SAME_RACK
+	if attrs.get('cache'):
+		return PEER
+	return ORIGIN
+
+def rank(mappings, hint=None):
+	"""
+	Order a list of (pfn, attrs) pairs by locality to hint, then by
+	priority (highest first). Ties are broken randomly so that load
+	is spread across equivalent replicas.
+	"""
+	def key(m):
+		pfn, attrs = m
+		return (locality(pfn, attrs, hint), -attrs.get('priority', 0),
+				random.random())
+	return [pfn for pfn, attrs in sorted(mappings, key=key)]
+
+class ExpiryThread(Thread):
+	"""
+	Deletes the mappings of hosts whose leases have lapsed
+	"""
+	def __init__(self, rls, interval=60):
+		Thread.__init__(self)
+		self.setDaemon(True)
+		self.log = log.get_log("expiry")
+		self.rls = rls
+		self.interval = interval
+	
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				self.rls.expire()
+			except Exception, e:
+				self.log.exception(e)
+
+class ReplicationThread(Thread):
+	"""
+	Applies the primary's changes to a replica
+	"""
+	def __init__(self, rls, interval=POLL_INTERVAL):
+		Thread.__init__(self)
+		self.setDaemon(True)
+		self.log = log.get_log("replication")
+		self.rls = rls
+		self.interval = interval
+	
+	def run(self):
+		while True:
+			try:
+				if not self.rls.replicate():
+					time.sleep(self.interval)
+			except Exception, e:
+				self.log.exception(e)
+				time.sleep(self.interval)
 
 class RLS(object):
-	def __init__(self):
+	def __init__(self, port=RLS_PORT, db_path=None, grace=GRACE, primary=None):
 		self.log = log.get_log("rls")
-		self.server = server.MuleServer('', RLS_PORT)
+		# Per-request messages, sampled so busy servers are not slowed down
+		self.requests = log.get_log("rls requests", sampled=True)
+		self.db_path = db_path
+		self.grace = grace
+		self.primary = primary
+		self.primary_seq = 0
+		self.caught_up = 0
+		self.resyncing = False
+		self.leases = {}
+		self.server = server.MuleServer('', port)
+		self.metrics = metrics.Registry()
+		self.latency = self.metrics.histogram("mule_rls_request_seconds",
+			"Time spent handling each type of request", ["op"])
+		self.lfns = self.metrics.counter("mule_rls_lfns_total",
+			"LFNs handled by each type of request", ["op"])
+		self.expired = self.metrics.counter("mule_rls_expired_total",
+			"Mappings deleted because their host's lease lapsed")
+		self.metrics.gauge("mule_rls_leases",
+			"Hosts holding a lease", lambda: len(self.leases))
+		self.metrics.gauge("mule_rls_seq",
+			"Sequence number of the last change", lambda: self.db.seq)
+		if primary is not None:
+			self.metrics.gauge("mule_rls_replica_lag",
+				"Changes this replica is behind the primary", 
+				lambda: self.status()['lag'])
+			self.metrics.gauge("mule_rls_replica_lag_seconds",
+				"Seconds since this replica was last caught up", 
+				lambda: self.status()['lag_seconds'])
+		self.server.metrics = self.metrics
 		
 	def stop(self, signum=None, frame=None):
 		self.log.info("Shutting down RLS...")
@@ -40,67 +296,364 @@ class RLS(object):
 	def run(self):
 		try:
 			self.log.info("Starting RLS...")
-			self.db = db.RLSDatabase()
+			self.db = db.RLSDatabase(self.db_path, replica=self.primary is not None)
+			self.leases = self.db.get_leases()
+			self.db.register_metrics(self.metrics)
+			if self.primary is None:
+				ExpiryThread(self).start()
+			else:
+				self.log.info("Replicating from %s", self.primary)
+				ReplicationThread(self).start()
 			signal.signal(signal.SIGTERM, self.stop)
 			self.server.register_function(self.lookup)
 			self.server.register_function(self.multilookup)
+			self.server.register_function(self.lookup_attrs)
+			self.server.register_function(self.list_page)
+			self.server.register_function(self.export)
+			self.server.register_function(self.changes)
+			self.server.register_function(self.status)
+			self.server.register_function(self.get_leases)
 			self.server.register_function(self.add)
 			self.server.register_function(self.multiadd)
 			self.server.register_function(self.delete)
 			self.server.register_function(self.multidelete)
+			self.server.register_function(self.heartbeat)
+			self.server.register_function(self.register)
 			self.server.register_function(self.ready)
 			self.server.register_function(self.clear)
 			self.server.serve_forever()
 		except KeyboardInterrupt:
 			self.stop()
 			
-	def lookup(self, lfn):
+	def writable(self):
+		if self.primary is not None:
+			raise Exception("This RLS is a read-only replica of %s" % self.primary)
+	
+	def readable(self):
+		if self.resyncing:
+			raise Exception("Replica is copying %s" % self.primary)
+	
+	def wait_for(self, min_seq):
 		"""
-		Look up all the pfns for lfn
+		Wait for a replica to apply change min_seq, for read-your-writes
 		"""
-		self.log.debug("lookup %s" % lfn)
-		return self.db.lookup(lfn)
+		self.readable()
+		if min_seq is None or self.db.seq >= min_seq:
+			return
+		deadline = time.time() + CATCHUP_WAIT
+		while self.db.seq < min_seq:
+			if time.time() > deadline:
+				raise Exception("Replica is at change %d, behind %d" % (self.db.seq, min_seq))
+			time.sleep(0.05)
 		
-	def multilookup(self, lfns):
+	def lookup(self, lfn, trace_id=None, hint=None, min_seq=None):
 		"""
-		Look up all the pfns for a set of lfns
+		Look up all the pfns for lfn, nearest to hint first. If min_seq
+		is given then the lookup will reflect at least that change.
 		"""
-		self.log.debug("multilookup %d" % len(lfns))
-		results = {}
-		for lfn in lfns:
-			results[lfn] = self.db.lookup(lfn)
-		return results
+		self.requests.debug("lookup %s", lfn)
+		self.wait_for(min_seq)
+		self.lfns.labels('lookup').increment()
+		with self.latency.labels('lookup').time():
+			with trace.span(trace_id, 'rls_lookup', lfn=lfn):
+				return rank(self.live(self.db.lookup_attrs(lfn)), hint)
 		
-	def add(self, lfn, pfn):
+	def multilookup(self, lfns, trace_id=None, hint=None, min_seq=None):
+		"""
+		Look up all the pfns for a set of lfns, nearest to hint first
 		"""
-		Add a mapping
+		self.requests.debug("multilookup %d", len(lfns))
+		self.wait_for(min_seq)
+		self.lfns.labels('multilookup').increment(len(lfns))
+		with self.latency.labels('multilookup').time():
+			with trace.span(trace_id, 'rls_multilookup', lfns=len(lfns)):
+				results = {}
+				for lfn in lfns:
+					results[lfn] = rank(self.live(self.db.lookup_attrs(lfn)), hint)
+				return results
+	
+	def lookup_attrs(self, lfn):
 		"""
-		self.log.debug("add %s %s" % (lfn, pfn))
-		self.db.add(lfn, pfn)
+		Look up all the [pfn, attrs] pairs for lfn, unranked
+		"""
+		self.requests.debug("lookup_attrs %s", lfn)
+		self.readable()
+		return [[pfn, attrs] for pfn, attrs in self.db.lookup_attrs(lfn)]
 		
-	def multiadd(self, mappings):
+	def list_page(self, token=None, limit=1000, pattern=None, attrs=False):
 		"""
-		Add a list of mappings
+		List one page of up to limit LFNs that match the glob pattern,
+		starting after token. Returns {'items': [[lfn, [pfn...]]...],
+		'token': token} where token is None after the last page. If
+		attrs is true then each pfn is a [pfn, attrs] pair.
 		"""
-		self.log.debug("multiadd %d" % len(mappings))
-		for lfn, pfn in mappings:
-			self.db.add(lfn, pfn)
+		self.requests.debug("list_page %s %s %s", token, limit, pattern)
+		self.readable()
+		limit = max(1, min(limit, MAX_PAGE))
+		with self.latency.labels('list_page').time():
+			items, token = self.db.list_page(token, limit, pattern, attrs)
+			self.lfns.labels('list_page').increment(len(items))
+			return { 'items': items, 'token': token }
 		
-	def delete(self, lfn, pfn=None):
+	def export(self, name):
+		"""
+		Write all mappings to the file name in EXPORT_DIR on this host,
+		in mule-rls-admin load format. A snapshot transaction is used,
+		so writers are not blocked. Returns the number of mappings 
+		exported.
+		"""
+		if (name != os.path.basename(name) or name.startswith('.') or 
+			len(name) == 0):
+			raise Exception("Invalid export name: %s" % name)
+		path = os.path.join(EXPORT_DIR, name)
+		self.log.info("export %s", path)
+		if not os.path.isdir(EXPORT_DIR):
+			os.makedirs(EXPORT_DIR)
+		tmp = path + ".tmp"
+		f = open(tmp, 'w')
+		try:
+			def write(lfn, pfn, attrs):
+				f.write(catalog.format_mapping(lfn, pfn, attrs))
+			n = self.db.export(write)
+		finally:
+			f.close()
+		os.rename(tmp, path)
+		return n
+	
+	def changes(self, since, limit=REPLICATE_BATCH):
+		"""
+		Return the changes after sequence number since, for replicas.
+		'first' is the oldest change still in the log; a replica that
+		needs an older one must copy everything instead.
+		"""
+		return {
+			'seq': self.db.seq,
+			'first': self.db.first_seq(),
+			'changes': self.db.get_changes(since, max(1, min(limit, MAX_PAGE)))
+		}
+	
+	def status(self):
+		"""
+		Return the role and replication state of this RLS
+		"""
+		if self.primary is None:
+			return { 'role': 'primary', 'seq': self.db.seq }
+		lag = max(0, self.primary_seq - self.db.seq)
+		if lag == 0:
+			lag_seconds = 0
+		else:
+			lag_seconds = time.time() - self.caught_up
+		return {
+			'role': 'replica',
+			'primary': self.primary,
+			'seq': self.db.seq,
+			'primary_seq': self.primary_seq,
+			'lag': lag,
+			'lag_seconds': lag_seconds,
+			'resyncing': self.resyncing
+		}
+	
+	def get_leases(self):
+		"""
+		Return a dict of host -> lease expiry time
+		"""
+		return self.leases
+	
+	def replicate(self):
+		"""
+		Apply the next batch of changes from the primary. Returns True
+		if there may be more changes waiting.
+		"""
+		conn = connect_one(self.primary)
+		result = conn.changes(self.db.seq, REPLICATE_BATCH)
+		self.primary_seq = result['seq']
+		if self.db.seq + 1 < result['first'] or self.db.seq > result['seq']:
+			self.resync(conn)
+			return True
+		changes = result['changes']
+		for i, change in enumerate(changes):
+			if change[1] == 'load':
+				# Bulk loads are not in the change log
+				if i > 0:
+					self.db.apply(changes[:i])
+				self.resync(conn)
+				return True
+		if len(changes) > 0:
+			self.db.apply(changes)
+			if len([c for c in changes if c[1] in ('lease','unlease','clear')]) > 0:
+				self.leases = self.db.get_leases()
+		if self.db.seq >= self.primary_seq:
+			self.caught_up = time.time()
+		return len(changes) == REPLICATE_BATCH
+	
+	def resync(self, conn):
+		"""
+		Replace the contents of this replica with a copy of the primary.
+		Changes made during the copy are applied again afterwards, 
+		which is safe because applying a change twice has no effect.
+		Reads are refused during the copy, so that clients go to 
+		another replica or the primary instead of seeing missing 
+		mappings.
+		"""
+		self.log.warning("Replica cannot follow the change log of %s, copying all mappings", self.primary)
+		self.resyncing = True
+		try:
+			self._resync(conn)
+		finally:
+			self.resyncing = False
+	
+	def _resync(self, conn):
+		seq = conn.status()['seq']
+		self.db.clear()
+		token = None
+		n = 0
+		while True:
+			result = conn.list_page(token, MAX_PAGE, None, True)
+			mappings = []
+			for lfn, pfns in result['items']:
+				for pfn, attrs in pfns:
+					mappings.append((lfn, pfn, attrs))
+			self.db.add_many(mappings)
+			n += len(mappings)
+			token = result['token']
+			if token is None:
+				break
+		for host, expires in conn.get_leases().items():
+			self.db.set_lease(host, expires)
+		self.db.set_seq(seq)
+		self.leases = self.db.get_leases()
+		self.log.info("Copied %d mappings, now at change %d", n, seq)
+		
+	def add(self, lfn, pfn, trace_id=None, attrs=None):
+		"""
+		Add a mapping. attrs is an optional dict of attributes
+		such as priority, host, rack and size.
+		"""
+		self.requests.debug("add %s %s", lfn, pfn)
+		self.lfns.labels('add').increment()
+		self.writable()
+		with self.latency.labels('add').time():
+			with trace.span(trace_id, 'rls_add', lfn=lfn):
+				self.db.add(lfn, pfn, attrs)
+				return self.db.seq
+		
+	def multiadd(self, mappings, trace_id=None):
+		"""
+		Add a list of [lfn, pfn] or [lfn, pfn, attrs] mappings
+		"""
+		self.requests.debug("multiadd %d", len(mappings))
+		self.lfns.labels('multiadd').increment(len(mappings))
+		self.writable()
+		with self.latency.labels('multiadd').time():
+			with trace.span(trace_id, 'rls_multiadd', lfns=len(mappings)):
+				for i in range(0, len(mappings), REGISTER_BATCH):
+					batch = []
+					for m in mappings[i:i+REGISTER_BATCH]:
+						attrs = None
+						if len(m) > 2:
+							attrs = m[2]
+						batch.append((m[0], m[1], attrs))
+					self.db.add_many(batch)
+				return self.db.seq
+		
+	def delete(self, lfn, pfn=None, trace_id=None):
 		"""
 		Delete a mapping
 		"""
-		self.log.debug("delete %s %s" % (lfn, pfn))
-		self.db.delete(lfn, pfn)
+		self.requests.debug("delete %s %s", lfn, pfn)
+		self.lfns.labels('delete').increment()
+		self.writable()
+		with self.latency.labels('delete').time():
+			with trace.span(trace_id, 'rls_delete', lfn=lfn):
+				self.db.delete(lfn, pfn)
+				return self.db.seq
 		
-	def multidelete(self, mappings):
+	def multidelete(self, mappings, trace_id=None):
 		"""
 		Delete a list of mappings
 		"""
-		self.log.debug("multidelete %d" % len(mappings))
-		for lfn, pfn in mappings:
-			self.db.delete(lfn, pfn)
+		self.requests.debug("multidelete %d", len(mappings))
+		self.lfns.labels('multidelete').increment(len(mappings))
+		self.writable()
+		with self.latency.labels('multidelete').time():
+			with trace.span(trace_id, 'rls_multidelete', lfns=len(mappings)):
+				for i in range(0, len(mappings), REGISTER_BATCH):
+					self.db.delete_many(mappings[i:i+REGISTER_BATCH])
+				return self.db.seq
 		
+	def live(self, mappings):
+		"""
+		Remove (pfn, attrs) pairs registered by hosts whose lease 
+		has lapsed. Mappings from hosts without a lease are kept.
+		"""
+		now = time.time()
+		result = []
+		for pfn, attrs in mappings:
+			expires = self.leases.get(attrs.get('owner', attrs.get('host')))
+			if expires is None or expires > now:
+				result.append((pfn, attrs))
+		return result
+	
+	def heartbeat(self, host, ttl):
+		"""
+		Renew the lease of host for ttl seconds. host identifies the
+		cache as host:port. Returns False if the
+		host had no lease, in which case any mappings it registered
+		before have been deleted and it should call register.
+		"""
+		self.requests.debug("heartbeat %s %s", host, ttl)
+		self.writable()
+		known = host in self.leases
+		expires = time.time() + ttl
+		self.db.set_lease(host, expires)
+		self.leases[host] = expires
+		return known
+	
+	def register(self, host, mappings, ttl, trace_id=None):
+		"""
+		Replace all the mappings registered by host with a list of
+		[lfn, pfn, attrs] mappings, and renew its lease for ttl
+		seconds. Used by caches to re-register their contents when
+		they start. The new mappings are added before the stale ones
+		are deleted, so lookups never see the host's files missing.
+		Returns the number of mappings registered.
+		"""
+		self.log.info("register %s %d", host, len(mappings))
+		self.writable()
+		self.lfns.labels('register').increment(len(mappings))
+		with self.latency.labels('register').time():
+			with trace.span(trace_id, 'rls_register', lfns=len(mappings)):
+				keep = set()
+				for i in range(0, len(mappings), REGISTER_BATCH):
+					batch = []
+					for lfn, pfn, attrs in mappings[i:i+REGISTER_BATCH]:
+						attrs = dict(attrs)
+						attrs['owner'] = host
+						attrs.setdefault('host', host.rsplit(':', 1)[0])
+						batch.append((lfn, pfn, attrs))
+						keep.add("%s\0%s" % (lfn, pfn))
+					self.db.add_many(batch)
+				self.db.delete_host(host, keep=keep)
+				self.heartbeat(host, ttl)
+				return len(mappings)
+	
+	def expire(self):
+		"""
+		Delete the mappings of hosts whose lease lapsed more than
+		grace seconds ago
+		"""
+		now = time.time()
+		for host, expires in self.leases.items():
+			if expires + self.grace < now:
+				n = self.db.delete_host(host)
+				self.db.delete_lease(host)
+				del self.leases[host]
+				self.expired.increment(n)
+				self.log.info("Lease of %s lapsed: deleted %d mappings", host, n)
+		n = self.db.trim_changes(MAX_CHANGES)
+		if n > 0:
+			self.log.debug("Trimmed %d changes from the log", n)
+	
 	def ready(self):
 		"""
 		This is just so that the agent can tell 
@@ -110,31 +663,56 @@ class RLS(object):
 		
 	def clear(self):
 		"""Clear all entries from db"""
+		self.writable()
 		self.db.clear()
+		self.leases = {}
 		
 def main():
 	parser = OptionParser()
 	parser.add_option("-f", "--foreground", action="store_true", 
 		dest="foreground", default=False,
 		help="Do not fork [default: %default]")
+	parser.add_option("-T", "--trace", action="store", dest="trace",
+		default=None, metavar="FILE",
+		help="Record request spans in FILE [default: no tracing]")
+	parser.add_option("-p", "--port", action="store", dest="port",
+		default=RLS_PORT, type="int", metavar="PORT",
+		help="Port to listen on [default: %default]")
+	parser.add_option("-D", "--db", action="store", dest="db",
+		default=None, metavar="DIR",
+		help="Database directory [default: MULE_HOME/var/rls]")
+	parser.add_option("-l", "--log", action="store", dest="log",
+		default=None, metavar="FILE",
+		help="Log file [default: MULE_HOME/var/rls.log]")
+	parser.add_option("-g", "--grace", action="store", dest="grace",
+		default=GRACE, type="int", metavar="SECONDS",
+		help="Delete a host's mappings when its lease has lapsed for SECONDS [default: %default]")
+	parser.add_option("-R", "--replica-of", action="store", dest="primary",
+		default=None, metavar="HOST",
+		help="Run as a read-only replica of the RLS at HOST [default: primary]")
 
 	(options, args) = parser.parse_args()
 	
 	if len(args) > 0:
 		parser.error("Invalid argument")
 	
+	for opt in ['trace','db','log']:
+		if getattr(options, opt):
+			setattr(options, opt, os.path.abspath(getattr(options, opt)))
+	
 	# Fork
 	if not options.foreground:
 		util.daemonize()
 	
 	os.chdir(config.get_home())
 	
-	# Configure logging (after the fork)
-	log.configure()
+	# Configure logging and tracing (after the fork)
+	log.configure(options.log)
+	trace.configure(options.trace)
 	
 	l = log.get_log("rls")
 	try:
-		r = RLS()
+		r = RLS(options.port, options.db, options.grace, options.primary)
 		r.run()
 	except Exception, e:
 		l.exception(e)
@@ -0,0 +1,100 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import re
+import time
+import random
+from xmlrpclib import ServerProxy, Transport, Fault
+
+# This module only depends on the standard library so that the client
+# can talk to the cache daemon without importing the daemon's modules
+# (and Berkeley DB), which dominates the run time of short commands.
+
+__all__ = ["CACHE_PORT","BUSY","Busy","TimeoutTransport","connect","retry_after","call"]
+
+CACHE_PORT = 3881
+
+# Fault code of a request that the daemon is too busy to take on
+BUSY = 503
+
+# Calls refused as busy are retried up to BUSY_RETRIES times, waiting 
+# at least as long as the daemon asks, doubling the wait each time 
+# from MIN_BACKOFF up to MAX_BACKOFF seconds
+BUSY_RETRIES = int(os.getenv("MULE_BUSY_RETRIES", 10))
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 60
+
+class Busy(Fault):
+	"""Raised by a daemon to turn a request away until it has capacity"""
+	def __init__(self, retry_after):
+		Fault.__init__(self, BUSY, 
+			"Server busy, retry after %.1f seconds" % retry_after)
+		self.retry_after = retry_after
+
+class TimeoutTransport(Transport):
+	"""XML-RPC transport with a socket timeout"""
+	def __init__(self, timeout):
+		Transport.__init__(self)
+		self.timeout = timeout
+	
+	def make_connection(self, host):
+		conn = Transport.make_connection(self, host)
+		# Python 2.6 wraps the HTTPConnection in an HTTP object
+		getattr(conn, '_conn', conn).timeout = self.timeout
+		return conn
+
+def connect(host='localhost', port=CACHE_PORT, timeout=None):
+	"""
+	Connect to the cache server running at host:port. The port can 
+	also be given as part of host.
+	"""
+	if ':' in host:
+		host, port = host.split(':', 1)
+	uri = "http://%s:%s" % (host, port)
+	if timeout is None:
+		return ServerProxy(uri, allow_none=True)
+	return ServerProxy(uri, transport=TimeoutTransport(timeout), allow_none=True)
+
+def retry_after(fault):
+	"""
+	Return the number of seconds a busy daemon asked the client to wait,
+	or None if fault is some other error
+	"""
+	if fault.faultCode != BUSY:
+		return None
+	m = re.search(r"retry after ([0-9.]+)", fault.faultString)
+	if m is None:
+		return 1.0
+	return float(m.group(1))
+
+def call(method, *args):
+	"""
+	Call an XML-RPC method, and retry with jittered exponential backoff 
+	while the daemon is busy. Busy requests are refused before they 
+	change anything, so they can always be retried.
+	"""
+	delay = 0
+	attempt = 0
+	while True:
+		try:
+			return method(*args)
+		except Fault, e:
+			wait = retry_after(e)
+			if wait is None or attempt >= BUSY_RETRIES:
+				raise
+			attempt += 1
+			delay = min(MAX_BACKOFF, max(wait, delay * 2, MIN_BACKOFF))
+			# Spread the retries of clients refused at the same time
+			time.sleep(delay * random.uniform(1, 1.5))
@@ -14,29 +14,46 @@
 #
 from SocketServer import ThreadingMixIn
 from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from xmlrpclib import Fault
 
 from mule import log
 
+# One logger for all requests: a logger per client address would never
+# be freed. Every request is logged, so the messages are sampled.
+HTTP_LOG = log.get_log("http", sampled=True)
+
 class MuleRequestHandler(SimpleXMLRPCRequestHandler):
-	def __init__(self, request, client_address, server):
-		self.log = log.get_log("client %s:%d" % client_address)
-		SimpleXMLRPCRequestHandler.__init__(self, request, client_address, server)
-		
 	def log_error(self, format, *args):
-		self.log.error(format % args)
+		HTTP_LOG.error("%s:%d " + format, *(self.client_address + args))
 		
 	def log_message(self, format, *args):
-		self.log.debug(format % args)
+		HTTP_LOG.debug("%s:%d " + format, *(self.client_address + args))
+	
+	def do_GET(self):
+		"""Serve the server's metrics in text format at /metrics"""
+		if self.path != '/metrics' or self.server.metrics is None:
+			self.send_error(404, "File not found")
+			return
+		body = self.server.metrics.render()
+		self.send_response(200)
+		self.send_header("Content-type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
 		
 class MuleServer(ThreadingMixIn, SimpleXMLRPCServer):
 	def __init__(self, host, port, requestHandler=MuleRequestHandler):
 		self.log = log.get_log("mule server")
+		self.metrics = None
 		SimpleXMLRPCServer.__init__(self, (host, port), requestHandler=requestHandler, 
 									allow_none=True, encoding=None, logRequests=True)
 	
 	def _dispatch(self, method, params):
 		try:
 			return SimpleXMLRPCServer._dispatch(self, method, params)
+		except Fault:
+			# Raised on purpose, e.g. rpc.Busy, and returned as is
+			raise
 		except Exception, e:
 			self.log.exception(e)
 			raise e
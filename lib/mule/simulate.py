@@ -0,0 +1,381 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import re
+import sys
+import json
+import random
+from optparse import OptionParser
+
+from mule import bits, cluster
+
+__all__ = ["snapshot","read_jobs","Simulation"]
+
+# Size used for inputs whose size is not known
+DEFAULT_SIZE = 64*1024
+
+match_get = re.compile("mule[ ]+get[ ]+([^ ]+)")
+
+def snapshot(hosts, m=bits.DEFAULT_SIZE, k=bits.DEFAULT_HASHES, fpr=None,
+			 concurrency=cluster.CONCURRENCY):
+	"""
+	Fetch the bloom filter of every cache in hosts, concurrency at a
+	time. Returns {'k': k, 'filters': {host: chunks}, 'errors': {host:
+	message}}.
+	"""
+	if fpr is not None:
+		k = bits.optimal_hashes(fpr)
+	filters, errors = cluster.fanout(hosts, 
+		lambda conn, host: conn.get_bloom_filter(m, k, fpr), concurrency)
+	return {'k': k, 'filters': filters, 'errors': errors}
+
+def read_jobs(directory):
+	"""
+	Return a list of (name, inputs, chunks) for the jobs in directory,
+	sorted by name, where chunks is the job's filter from its .bloom 
+	file, or None if it does not have one
+	"""
+	jobs = []
+	for root, dirs, files in os.walk(directory):
+		for f in files:
+			if not f.endswith(".in"):
+				continue
+			path = os.path.join(root, f)
+			inputs = []
+			g = open(path)
+			try:
+				for line in g:
+					m = match_get.search(line)
+					if m:
+						inputs.append(m.group(1))
+			finally:
+				g.close()
+			if len(inputs) == 0:
+				continue
+			chunks = None
+			bloomfile = path[:-len(".in")] + ".bloom"
+			if os.path.isfile(bloomfile):
+				g = open(bloomfile)
+				try:
+					chunks = [g.read().strip()]
+				finally:
+					g.close()
+			name = os.path.relpath(path, directory)[:-len(".in")]
+			jobs.append((name, sorted(set(inputs)), chunks))
+	jobs.sort()
+	return jobs
+
+class Node(object):
+	def __init__(self, host, bloom, slots):
+		self.host = host
+		self.bloom = bloom
+		self.slots = slots
+		self.free = slots
+		self.jobs = 0
+		self.hits = 0
+		self.misses = 0
+		self.bytes_in = 0
+		self.running = []
+		# Folded copies of the filter by size, until it changes
+		self.folded = {}
+
+	def rank(self, positions, size):
+		"""
+		bloom_compare of a job filter of size bits, given the positions
+		of its set bits, with this node's filter. The larger filter is
+		folded to the size of the smaller one.
+		"""
+		m = self.bloom.m
+		if m > size:
+			folded = self.folded.get(size)
+			if folded is None:
+				folded = self.bloom.bits.fold(size).bits
+				self.folded[size] = folded
+			m = size
+		else:
+			folded = self.bloom.bits.bits
+		common = set([p % m for p in positions])
+		return len([p for p in common if (folded[p >> 3] >> (p & 7)) & 1])
+
+class Simulation(object):
+	"""
+	Replays the placement of jobs on caches the way the negotiator
+	would: in each cycle every node has slots free, and each job in turn
+	goes to the free node with the highest bloom_compare rank that meets
+	the --require threshold. Jobs finish at the end of the cycle, and 
+	their inputs are added to the filter of the node that ran them. An
+	input counts as a hit if it was in that node's filter when the job
+	started, so hit rates include the filters' false positives.
+	"""
+	def __init__(self, snapshot, jobs, slots=1, require=None, ranked=True,
+				 sizes=None, size=bits.DEFAULT_SIZE, hashes=None):
+		self.k = snapshot['k']
+		self.nodes = []
+		for host in sorted(snapshot['filters'].keys()):
+			bloom = bits.BloomFilter.decode(snapshot['filters'][host], self.k)
+			self.nodes.append(Node(host, bloom, slots))
+		self.jobs = jobs
+		self.require = require
+		self.ranked = ranked
+		self.sizes = sizes or {}
+		self.size = size
+		self.hashes = hashes or self.k
+		self.unmatched = 0
+		self.cycles = 0
+
+	def job_filter(self, inputs, chunks):
+		"""Return (positions, size) of a job's filter"""
+		if chunks is not None:
+			bf = bits.BloomFilter.decode(chunks, self.hashes)
+		else:
+			# Built the same way as mule-update-jobs
+			bf = bits.BloomFilter(self.size, self.hashes)
+			bf.add_many(inputs)
+		positions = []
+		for i, byte in enumerate(bf.bits.bits):
+			if byte:
+				for j in xrange(8):
+					if (byte >> j) & 1:
+						positions.append(i*8 + j)
+		return positions, bf.m
+
+	def place(self, inputs, positions, size):
+		"""Choose a node with a free slot for a job, or None"""
+		required = 0
+		if self.require is not None:
+			required = self.require * self.hashes * len(inputs)
+		best = []
+		best_rank = -1
+		for node in self.nodes:
+			if node.free == 0:
+				continue
+			rank = 0
+			if self.ranked or required > 0:
+				rank = node.rank(positions, size)
+			if rank < required:
+				continue
+			if not self.ranked:
+				rank = 0
+			if rank > best_rank:
+				best = [node]
+				best_rank = rank
+			elif rank == best_rank:
+				best.append(node)
+		if len(best) == 0:
+			return None
+		# Among equally ranked nodes prefer the least loaded
+		fewest = min([n.jobs for n in best])
+		return random.choice([n for n in best if n.jobs == fewest])
+
+	def run(self):
+		waiting = []
+		for name, inputs, chunks in self.jobs:
+			positions, size = self.job_filter(inputs, chunks)
+			waiting.append((name, inputs, positions, size))
+		while len(waiting) > 0:
+			self.cycles += 1
+			for node in self.nodes:
+				node.free = node.slots
+				node.running = []
+			idle = []
+			for job in waiting:
+				name, inputs, positions, size = job
+				node = self.place(inputs, positions, size)
+				if node is None:
+					idle.append(job)
+					continue
+				node.free -= 1
+				node.jobs += 1
+				for lfn, hit in zip(inputs, node.bloom.contains_many(inputs)):
+					if hit:
+						node.hits += 1
+					else:
+						node.misses += 1
+						node.bytes_in += self.sizes.get(lfn, DEFAULT_SIZE)
+				node.running.append(inputs)
+			for node in self.nodes:
+				for inputs in node.running:
+					node.bloom.add_many(inputs)
+				node.folded = {}
+			if len(idle) == len(waiting):
+				# Nothing could run, so nothing will change
+				self.unmatched = len(idle)
+				break
+			waiting = idle
+		return self.results()
+
+	def results(self):
+		hits = sum([n.hits for n in self.nodes])
+		misses = sum([n.misses for n in self.nodes])
+		nodes = {}
+		for n in self.nodes:
+			nodes[n.host] = {
+				'jobs': n.jobs,
+				'hits': n.hits,
+				'misses': n.misses,
+				'bytes_in': n.bytes_in
+			}
+		return {
+			'jobs': len(self.jobs),
+			'unmatched': self.unmatched,
+			'cycles': self.cycles,
+			'inputs': hits + misses,
+			'hits': hits,
+			'hit_rate': float(hits) / max(1, hits + misses),
+			'bytes_moved': sum([n.bytes_in for n in self.nodes]),
+			'nodes': nodes
+		}
+
+def lookup_sizes(rls_host, lfns):
+	"""
+	Look up the sizes that caches registered for lfns in the RLS.
+	Returns a dict of lfn -> size for the lfns that have one.
+	"""
+	from mule import rls
+	conn = rls.connect(rls_host)
+	sizes = {}
+	for lfn in lfns:
+		for pfn, attrs in conn.lookup_attrs(lfn):
+			if 'size' in attrs:
+				sizes[lfn] = int(attrs['size'])
+				break
+	return sizes
+
+def write_json(obj, path):
+	output = json.dumps(obj, indent=2, sort_keys=True)
+	if path:
+		f = open(path, 'w')
+		try:
+			f.write(output + "\n")
+		finally:
+			f.close()
+	else:
+		print output
+
+def usage():
+	sys.stderr.write("Usage: %s COMMAND\n" % os.path.basename(sys.argv[0]))
+	sys.stderr.write("""
+Commands:
+   snapshot [HOST...]     Save the bloom filters of caches
+   run SNAPSHOT DIR...    Simulate placing the jobs in DIR on the caches
+""")
+	sys.exit(1)
+
+def main():
+	if len(sys.argv) < 2:
+		usage()
+
+	cmd = sys.argv[1]
+	args = sys.argv[2:]
+
+	if cmd == 'snapshot':
+		parser = OptionParser("Usage: %prog snapshot [options] [HOST[:PORT]...]")
+		parser.add_option("-F", "--hostfile", action="store", dest="hostfile",
+			default=None, metavar="FILE",
+			help="Read hosts from FILE, one per line")
+		parser.add_option("-m", "--size", action="store", type="int",
+			dest="m", metavar="M", default=bits.DEFAULT_SIZE,
+			help="Size of bloom filter [default: %default]")
+		parser.add_option("-k", "--hashes", action="store", type="int",
+			dest="k", metavar="K", default=bits.DEFAULT_HASHES,
+			help="Number of hashes [default: %default]")
+		parser.add_option("-f", "--fpr", action="store", type="float",
+			dest="fpr", metavar="P", default=None,
+			help="Autotune the filters for false-positive rate P, as 'mule bloom --fpr'")
+		parser.add_option("-o", "--output", action="store", dest="output",
+			default=None, metavar="FILE",
+			help="Write the snapshot to FILE [default: stdout]")
+		(options, args) = parser.parse_args(args=args)
+		hosts = args
+		if options.hostfile:
+			hosts = hosts + cluster.read_hostfile(options.hostfile)
+		if len(hosts) == 0:
+			parser.error("Specify HOST or --hostfile")
+		snap = snapshot(hosts, options.m, options.k, options.fpr)
+		for host, error in sorted(snap['errors'].items()):
+			sys.stderr.write("WARNING: %s: %s\n" % (host, error))
+		write_json(snap, options.output)
+	elif cmd == 'run':
+		parser = OptionParser("Usage: %prog run [options] SNAPSHOT DIR...")
+		parser.add_option("-s", "--slots", action="store", type="int",
+			dest="slots", default=1, metavar="N",
+			help="Job slots per cache node [default: %default]")
+		parser.add_option("-r", "--require", action="store", type="float",
+			dest="require", default=None, metavar="P",
+			help="Require the rank to be >= P fraction of # inputs, as mule-update-jobs --require")
+		parser.add_option("-u", "--unranked", action="store_false",
+			dest="ranked", default=True,
+			help="Ignore rank, to compare with placement without bloom filters")
+		parser.add_option("-b", "--rebuild", action="store_true",
+			dest="rebuild", default=False,
+			help="Build job filters from the .in files instead of reading .bloom files")
+		parser.add_option("-m", "--size", action="store", type="int",
+			dest="m", metavar="M", default=bits.DEFAULT_SIZE,
+			help="Size of rebuilt job filters [default: %default]")
+		parser.add_option("-k", "--hashes", action="store", type="int",
+			dest="k", metavar="K", default=None,
+			help="Number of hashes in job filters [default: same as SNAPSHOT]")
+		parser.add_option("-R", "--rls", action="store", dest="rls",
+			default=None, metavar="HOST",
+			help="Look up input sizes in this RLS [default: %d bytes each]" % DEFAULT_SIZE)
+		parser.add_option("-S", "--seed", action="store", type="int",
+			dest="seed", default=None,
+			help="Random seed used to break ties")
+		parser.add_option("-o", "--output", action="store", dest="output",
+			default=None, metavar="FILE",
+			help="Write JSON results to FILE [default: stdout]")
+		(options, args) = parser.parse_args(args=args)
+		if len(args) < 2:
+			parser.error("Specify SNAPSHOT and DIR")
+		if options.require is not None and not 0 <= options.require <= 1:
+			parser.error("--require must be between 0 and 1")
+		random.seed(options.seed)
+
+		f = open(args[0])
+		try:
+			snap = json.load(f)
+		finally:
+			f.close()
+		# json gives unicode, but the filters are ASCII
+		for host in snap['filters'].keys():
+			snap['filters'][str(host)] = [str(c) for c in snap['filters'].pop(host)]
+		if len(snap['filters']) == 0:
+			parser.error("%s has no filters" % args[0])
+
+		jobs = []
+		for d in args[1:]:
+			jobs += read_jobs(d)
+		if options.rebuild:
+			jobs = [(name, inputs, None) for name, inputs, chunks in jobs]
+
+		sizes = None
+		if options.rls:
+			lfns = set()
+			for name, inputs, chunks in jobs:
+				lfns.update(inputs)
+			sizes = lookup_sizes(options.rls, sorted(lfns))
+
+		sim = Simulation(snap, jobs, options.slots, options.require,
+						 options.ranked, sizes, options.m, options.k)
+		results = sim.run()
+		results['slots'] = options.slots
+		results['require'] = options.require
+		results['ranked'] = options.ranked
+		write_json(results, options.output)
+	else:
+		usage()
+
+if __name__ == '__main__':
+	main()
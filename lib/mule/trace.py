@@ -0,0 +1,186 @@
+# Copyright 2010 University Of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import time
+import socket
+import binascii
+from threading import Lock
+from optparse import OptionParser
+
+__all__ = ["new_id","configure","span","HEADER"]
+
+# HTTP header used to pass the trace ID to peers
+HEADER = "X-Mule-Trace"
+
+TRACER = None
+
+def new_id():
+	"""Generate a new random trace ID"""
+	return binascii.hexlify(os.urandom(8))
+
+class Tracer(object):
+	"""Appends spans to a trace log, one JSON object per line"""
+	def __init__(self, path):
+		self.path = path
+		self.host = socket.getfqdn()
+		self.pid = os.getpid()
+		self.lock = Lock()
+		self.f = open(path, 'a')
+
+	def record(self, trace, name, start, end, attrs):
+		rec = {
+			'trace': trace,
+			'span': name,
+			'host': self.host,
+			'pid': self.pid,
+			'start': start,
+			'end': end
+		}
+		rec.update(attrs)
+		# Imported here so that clients that do not trace never load it
+		import json
+		line = json.dumps(rec) + "\n"
+		self.lock.acquire()
+		try:
+			self.f.write(line)
+			self.f.flush()
+		finally:
+			self.lock.release()
+
+class Span(object):
+	"""
+	Context manager that records a span when it exits. Extra
+	attributes can be added with set() while the span is open.
+	"""
+	def __init__(self, tracer, trace, name, attrs):
+		self.tracer = tracer
+		self.trace = trace
+		self.name = name
+		self.attrs = attrs
+
+	def set(self, key, value):
+		self.attrs[key] = value
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, t, v, tb):
+		if t is not None:
+			self.attrs['error'] = str(v)
+		self.tracer.record(self.trace, self.name, self.start,
+						   time.time(), self.attrs)
+
+class NullSpan(object):
+	"""Span used when tracing is disabled"""
+	def set(self, key, value):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, t, v, tb):
+		pass
+
+NULL_SPAN = NullSpan()
+
+def configure(path):
+	"""Record spans in path for this process. If path is None then
+	tracing is disabled."""
+	global TRACER
+	if path is None:
+		TRACER = None
+	else:
+		TRACER = Tracer(path)
+
+def span(trace, name, **attrs):
+	"""
+	Return a context manager that records a span called name for
+	trace. Nothing is recorded if trace is None or tracing has not
+	been configured.
+	"""
+	if TRACER is None or trace is None:
+		return NULL_SPAN
+	return Span(TRACER, trace, name, attrs)
+
+def read_spans(paths):
+	"""Read all the spans from a list of trace logs"""
+	import json
+	spans = []
+	for path in paths:
+		f = open(path)
+		try:
+			for line in f:
+				line = line.strip()
+				if len(line) == 0:
+					continue
+				try:
+					spans.append(json.loads(line))
+				except ValueError:
+					sys.stderr.write("WARNING: Skipping bad line in %s\n" % path)
+		finally:
+			f.close()
+	return spans
+
+def timeline(spans, trace):
+	"""Print the spans for trace in the order they started"""
+	spans = [s for s in spans if s['trace'] == trace]
+	if len(spans) == 0:
+		sys.stderr.write("No spans found for trace %s\n" % trace)
+		return
+	spans.sort(key=lambda s: s['start'])
+	base = spans[0]['start']
+	print "%10s %10s  %-30s %-16s %s" % ("OFFSET", "DURATION", "HOST", "SPAN", "ATTRIBUTES")
+	for s in spans:
+		attrs = ' '.join(['%s=%s' % (k, s[k]) for k in sorted(s.keys())
+			if k not in ('trace','span','host','pid','start','end')])
+		print "%10.4f %10.4f  %-30s %-16s %s" % (s['start'] - base,
+			s['end'] - s['start'], s['host'], s['span'], attrs)
+
+def summary(spans, limit):
+	"""Print the slowest traces"""
+	traces = {}
+	for s in spans:
+		start, end, hosts = traces.get(s['trace'], (s['start'], s['end'], set()))
+		hosts.add(s['host'])
+		traces[s['trace']] = (min(start, s['start']), max(end, s['end']), hosts)
+	items = [(end - start, trace, len(hosts)) for trace, (start, end, hosts) in traces.items()]
+	items.sort(reverse=True)
+	print "%-16s %10s %6s" % ("TRACE", "DURATION", "HOSTS")
+	for duration, trace, hosts in items[:limit]:
+		print "%-16s %10.4f %6d" % (trace, duration, hosts)
+
+def main():
+	parser = OptionParser("Usage: %prog [options] TRACELOG...")
+	parser.add_option("-t", "--trace", action="store", dest="trace",
+		default=None, metavar="ID",
+		help="Print the timeline for trace ID [default: list slowest traces]")
+	parser.add_option("-n", "--limit", action="store", dest="limit",
+		default=20, type="int", metavar="N",
+		help="Number of traces to list [default: %default]")
+	(options, args) = parser.parse_args()
+
+	if len(args) == 0:
+		parser.error("Specify at least one trace log")
+
+	spans = read_spans(args)
+	if options.trace:
+		timeline(spans, options.trace)
+	else:
+		summary(spans, options.limit)
+
+if __name__ == '__main__':
+	main()
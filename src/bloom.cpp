@@ -22,102 +22,440 @@ static int b64_value(unsigned char c)
 	return c != '=' ? -1 : 0;
 }
 
-/* decodes a base64-encoded string */
-static char * b64_decode(const char *s, int *n)
+/* a growable byte buffer */
+typedef struct {
+	unsigned char *data;
+	int len;
+	int cap;
+} buffer;
+
+/* makes room for n more bytes at the end of b */
+static unsigned char * buffer_extend(buffer *b, int n)
+{
+	if (b->len + n > b->cap) {
+		int cap = b->cap ? b->cap : 1024;
+		while (cap < b->len + n) cap *= 2;
+		unsigned char *data = (unsigned char *)realloc(b->data, cap);
+		if (data == NULL) return NULL;
+		b->data = data;
+		b->cap = cap;
+	}
+	unsigned char *result = b->data + b->len;
+	b->len += n;
+	return result;
+}
+
+/* decodes len characters of base64 s into out, which must have room for
+   (len / 4) * 3 bytes. returns the number of bytes decoded or -1. */
+static int b64_decode(const char *s, int len, unsigned char *out)
 {
-	int s_length = strlen(s);
-	if (s_length == 0) return NULL;
-	int i = 0;
-	for(int j = s_length - 1; j > 0 && s[j] == '='; j--) {
-		i++;
+	if (len % 4 != 0) return -1;
+	int pad = 0;
+	for(int j = len - 1; j >= 0 && j >= len - 2 && s[j] == '='; j--) {
+		pad++;
 	}
 	 
-	int k = (s_length * 6) / 8 - i;
-	*n = k;
-	char *result = new char[k];
+	int k = (len / 4) * 3 - pad;
 	int l = 0;
-	for(int i1 = 0; i1 < s_length; i1 += 4) {
-		int j1 = (b64_value(s[i1])     << 18) + 
-				 (b64_value(s[i1 + 1]) << 12) + 
-				 (b64_value(s[i1 + 2]) << 6) + 
-				  b64_value(s[i1 + 3]);
+	for(int i1 = 0; i1 < len; i1 += 4) {
+		int v0 = b64_value(s[i1]);
+		int v1 = b64_value(s[i1 + 1]);
+		int v2 = b64_value(s[i1 + 2]);
+		int v3 = b64_value(s[i1 + 3]);
+		if (v0 < 0 || v1 < 0 || v2 < 0 || v3 < 0) return -1;
+		int j1 = (v0 << 18) + (v1 << 12) + (v2 << 6) + v3;
 		for(int k1 = 0; k1 < 3 && l + k1 < k; k1++) {
-			result[l + k1] = (char)(j1 >> 8 * (2 - k1) & 0xff);
+			out[l + k1] = (unsigned char)(j1 >> 8 * (2 - k1) & 0xff);
 		}
 		l += 3;
 	}
-	return result;
+	return k;
+}
+
+/* decodes a dense (plain base64) filter chunk and appends it to b */
+static int dense_decode(const char *s, buffer *b)
+{
+	int len = strlen(s);
+	unsigned char *out = buffer_extend(b, (len / 4) * 3);
+	if (out == NULL) return -1;
+	int n = b64_decode(s, len, out);
+	if (n < 0) return -1;
+	b->len = (out - b->data) + n;
+	return 0;
+}
+
+/* decodes a sparse filter "!<bits>:<base64 varint deltas>" into b */
+static int sparse_decode(const char *s, buffer *b)
+{
+	char *end;
+	long m = strtol(s + 1, &end, 10);
+	if (*end != ':' || m <= 0 || m % 8 != 0) return -1;
+
+	const char *data = end + 1;
+	int len = strlen(data);
+	if (len % 4 != 0) return -1;
+	unsigned char *deltas = (unsigned char *)malloc(len / 4 * 3 + 1);
+	if (deltas == NULL) return -1;
+	int n = b64_decode(data, len, deltas);
+
+	unsigned char *out = buffer_extend(b, m / 8);
+	if (n < 0 || out == NULL) {
+		free(deltas);
+		return -1;
+	}
+	memset(out, 0, m / 8);
+
+	long pos = 0;
+	long delta = 0;
+	int shift = 0;
+	for (int i = 0; i < n; i++) {
+		delta |= (long)(deltas[i] & 0x7f) << shift;
+		if (deltas[i] & 0x80) {
+			shift += 7;
+			continue;
+		}
+		pos += delta;
+		if (pos >= m) {
+			free(deltas);
+			return -1;
+		}
+		out[pos / 8] |= 1 << (pos % 8);
+		delta = 0;
+		shift = 0;
+	}
+
+	free(deltas);
+	return 0;
+}
+
+/* decodes one chunk of a filter, which may be undefined (empty) */
+static int chunk_decode(const ClassAdSharedValue *arg, buffer *b)
+{
+	if (arg->type == ClassAdSharedType_Undefined)
+		return 0;
+	if (arg->type != ClassAdSharedType_String)
+		return -1;
+	if (arg->text[0] == '!')
+		return sparse_decode(arg->text, b);
+	return dense_decode(arg->text, b);
+}
+
+/* decoded filters are cached, because the negotiator compares the same
+   job and machine filters many times in each cycle. the cache is keyed
+   by the text of the filter's chunks and is direct mapped: a filter
+   replaces whatever was in its slot. the negotiator calls us from one
+   thread, so there is no locking.
+
+   the negotiator passes the same strings again and again, so a second
+   table finds the slot from the addresses of the chunks without
+   reading them. an address can be reused for a different string once
+   the old one is freed, so the text is still checked against the key,
+   but in one pass without copying or hashing it. */
+#define CACHE_SLOTS 4096
+#define CACHE_BYTES (64L * 1024 * 1024)
+
+typedef struct {
+	unsigned long long hash;
+	char *key;            /* the chunks of the filter, see filter_key */
+	int key_len;
+	unsigned char *data;  /* the decoded filter */
+	int len;
+	const char **ptrs;    /* the addresses of the chunks last seen */
+	int nptrs;
+} cache_entry;
+
+static cache_entry cache[CACHE_SLOTS];
+static long cache_bytes = 0;
+
+/* slot of the filter last seen with each hash of chunk addresses, +1 */
+static int ptr_slots[CACHE_SLOTS];
+
+/* scratch space for building keys */
+static buffer key = { NULL, 0, 0 };
+
+/* sets key to the chunks of one filter (every other argument starting
+   at first), each terminated by a newline, with undefined chunks as a
+   lone tab. returns -1 if a chunk is not a string or undefined. */
+static int filter_key(int n, const ClassAdSharedValue *args, int first)
+{
+	key.len = 0;
+	for (int i = first; i < n; i += 2) {
+		if (args[i].type == ClassAdSharedType_Undefined) {
+			unsigned char *out = buffer_extend(&key, 2);
+			if (out == NULL) return -1;
+			out[0] = '\t';
+			out[1] = '\n';
+		} else if (args[i].type == ClassAdSharedType_String) {
+			int len = strlen(args[i].text);
+			unsigned char *out = buffer_extend(&key, len + 1);
+			if (out == NULL) return -1;
+			memcpy(out, args[i].text, len);
+			out[len] = '\n';
+		} else {
+			return -1;
+		}
+	}
+	return 0;
+}
+
+/* FNV-1a */
+static unsigned long long hash_bytes(const unsigned char *s, int len)
+{
+	unsigned long long h = 14695981039346656037ULL;
+	for (int i = 0; i < len; i++) {
+		h ^= s[i];
+		h *= 1099511628211ULL;
+	}
+	return h;
 }
 
-/* count the bits in a bit array */
-static inline int popcount(char *buf, int n)
+/* hashes the addresses of the chunks of one filter */
+static unsigned long long hash_ptrs(int n, const ClassAdSharedValue *args,
+									int first)
 {
-	int cnt=0;
-	do {
-		unsigned v = (unsigned)(*buf++);
-		v = v - ((v >> 1) & 0x55555555);
-		v = (v & 0x33333333) + ((v >> 2) & 0x33333333);
-		cnt += (((v + (v >> 4)) & 0xF0F0F0F) * 0x1010101) >> 24;
-	} while(--n);
+	unsigned long long h = 14695981039346656037ULL;
+	for (int i = first; i < n; i += 2) {
+		const char *p = args[i].type == ClassAdSharedType_String ?
+			args[i].text : NULL;
+		h ^= (unsigned long long)(size_t)p;
+		h *= 1099511628211ULL;
+	}
+	return h;
+}
+
+/* returns 1 if the chunks of one filter are at the addresses recorded
+   in e and still match its key */
+static int same_chunks(const cache_entry *e, int n,
+					   const ClassAdSharedValue *args, int first)
+{
+	if (e->key == NULL || e->ptrs == NULL || e->nptrs != (n - first + 1) / 2)
+		return 0;
+	const char *k = e->key;
+	const char *end = e->key + e->key_len;
+	for (int i = first, c = 0; i < n; i += 2, c++) {
+		if (args[i].type == ClassAdSharedType_Undefined) {
+			if (e->ptrs[c] != NULL || end - k < 2 || k[0] != '\t' || k[1] != '\n')
+				return 0;
+			k += 2;
+			continue;
+		}
+		if (args[i].type != ClassAdSharedType_String ||
+			args[i].text != e->ptrs[c])
+			return 0;
+		/* the key holds no NULs, so this stops at the end of a shorter
+		   text, and the text is known to be long enough to read t[j] */
+		const char *t = args[i].text;
+		int j = 0;
+		while (k + j < end && k[j] != '\n' && t[j] == k[j])
+			j++;
+		if (k + j == end || k[j] != '\n' || t[j] != '\0')
+			return 0;
+		k += j + 1;
+	}
+	return k == end;
+}
+
+/* records the chunk addresses of the filter cached in slot s */
+static void remember_chunks(int s, unsigned long long ph, int n,
+							const ClassAdSharedValue *args, int first)
+{
+	cache_entry *e = &cache[s];
+	int count = (n - first + 1) / 2;
+	if (e->nptrs != count) {
+		free(e->ptrs);
+		e->ptrs = (const char **)malloc(count * sizeof(char *));
+		e->nptrs = e->ptrs != NULL ? count : 0;
+		if (e->ptrs == NULL) return;
+	}
+	for (int i = first, c = 0; i < n; i += 2, c++) {
+		e->ptrs[c] = args[i].type == ClassAdSharedType_String ?
+			args[i].text : NULL;
+	}
+	ptr_slots[ph % CACHE_SLOTS] = s + 1;
+}
+
+/* finds the decoded filter made of every other argument starting at
+   first, decoding and caching it if needed. if it cannot be cached it
+   is left in tmp, which the caller must free. slot is set to the cache
+   slot used, and the slot is pinned (if not -1) is never replaced. */
+static int get_filter(int n, const ClassAdSharedValue *args, int first,
+					  int pinned, int *slot, buffer *tmp,
+					  const unsigned char **data, int *len)
+{
+	unsigned long long ph = hash_ptrs(n, args, first);
+	int s = ptr_slots[ph % CACHE_SLOTS] - 1;
+	if (s >= 0 && same_chunks(&cache[s], n, args, first)) {
+		*slot = s;
+		*data = cache[s].data;
+		*len = cache[s].len;
+		return 0;
+	}
+
+	if (filter_key(n, args, first) < 0) return -1;
+	unsigned long long h = hash_bytes(key.data, key.len);
+	s = (int)(h % CACHE_SLOTS);
+	cache_entry *e = &cache[s];
+	*slot = s;
+
+	if (e->key != NULL && e->hash == h && e->key_len == key.len &&
+		memcmp(e->key, key.data, key.len) == 0) {
+		remember_chunks(s, ph, n, args, first);
+		*data = e->data;
+		*len = e->len;
+		return 0;
+	}
+
+	for (int i = first; i < n; i += 2) {
+		if (chunk_decode(&args[i], tmp) < 0) return -1;
+	}
+	*data = tmp->data;
+	*len = tmp->len;
+
+	if (s == pinned) {
+		*slot = -1;
+		return 0;
+	}
+	if (e->key != NULL) {
+		cache_bytes -= e->key_len + e->len;
+		free(e->key);
+		free(e->data);
+		e->key = NULL;
+		e->data = NULL;
+	}
+	if (cache_bytes + key.len + tmp->len > CACHE_BYTES) {
+		*slot = -1;
+		return 0;
+	}
+	char *k = (char *)malloc(key.len);
+	if (k == NULL) {
+		*slot = -1;
+		return 0;
+	}
+	memcpy(k, key.data, key.len);
+	e->hash = h;
+	e->key = k;
+	e->key_len = key.len;
+	/* the cache takes over the decoded data */
+	e->data = tmp->data;
+	e->len = tmp->len;
+	cache_bytes += e->key_len + e->len;
+	tmp->data = NULL;
+	tmp->len = tmp->cap = 0;
+	remember_chunks(s, ph, n, args, first);
+	return 0;
+}
+
+/* returns the size a filter of len bytes is folded to in order to be
+   compared with one of other bytes. folding a filter in half by ORing
+   the two halves together gives the same filter as building it with
+   half the number of bits. */
+static int folded_len(int len, int other)
+{
+	while (len > other && len % 2 == 0 && len / 2 >= other)
+		len /= 2;
+	return len;
+}
+
+/* loads the word at offset j of a filter of len bytes folded to n */
+static inline unsigned long long folded_word(const unsigned char *data,
+											 int len, int n, int j)
+{
+	unsigned long long w = 0;
+	for (int i = j; i < len; i += n) {
+		unsigned long long v;
+		memcpy(&v, data + i, sizeof(v));
+		w |= v;
+	}
+	return w;
+}
+
+/* loads the byte at offset j of a filter of len bytes folded to n */
+static inline unsigned char folded_byte(const unsigned char *data,
+										int len, int n, int j)
+{
+	unsigned char c = 0;
+	for (int i = j; i < len; i += n)
+		c |= data[i];
+	return c;
+}
+
+/* counts the bits set in both filters, folded to n bytes. stops early
+   once the count reaches limit (if limit > 0). */
+static int count_common(const unsigned char *a, int alen,
+						const unsigned char *b, int blen,
+						int n, int limit)
+{
+	int cnt = 0;
+	int j = 0;
+	for (; j + 8 <= n; j += 8) {
+		cnt += __builtin_popcountll(folded_word(a, alen, n, j) &
+									folded_word(b, blen, n, j));
+		if (limit > 0 && cnt >= limit)
+			return cnt;
+	}
+	for (; j < n; j++) {
+		cnt += __builtin_popcount(folded_byte(a, alen, n, j) &
+								  folded_byte(b, blen, n, j));
+	}
 	return cnt;
 }
 
-/* compares two bloom filters to see how many bits they have in common */
+/* compares two bloom filters to see how many bits they have in common.
+   the arguments are pairs of chunks (one from each filter) and the
+   chunks for each filter are concatenated. either filter may be sparse
+   encoded, have undefined chunks, or be a power of two times larger
+   than the other, in which case it is folded down to the same size.
+   an optional last argument is a threshold: counting stops once it is
+   reached, so the result is only exact if it is below the threshold,
+   which is all a requirements expression needs. */
 void bloom_compare(const int number_of_arguments,
 				   const ClassAdSharedValue *arguments,
 				   ClassAdSharedValue *result)
 {
-	int count = 0;
+	buffer a = { NULL, 0, 0 };
+	buffer b = { NULL, 0, 0 };
+	const unsigned char *adata, *bdata;
+	int alen, blen, aslot, bslot;
+	int n = number_of_arguments;
+	int limit = 0;
 
-	if (number_of_arguments % 2 != 0) { 
-		fprintf(stderr, "ERROR: invalid arguments: must be even number\n");
-		result->type = ClassAdSharedType_Error;
-		return;
-	}
+	result->type = ClassAdSharedType_Error;
 
-	int i;
-	for (i=0; i<number_of_arguments; i+=2) {
-		if (arguments[i].type != ClassAdSharedType_String ||
-			arguments[i+1].type != ClassAdSharedType_String) {
-			fprintf(stderr, "ERROR: invalid argument: expected string\n");
-			result->type = ClassAdSharedType_Error;
+	if (n % 2 != 0) {
+		const ClassAdSharedValue *t = &arguments[n - 1];
+		if (t->type == ClassAdSharedType_Integer) {
+			limit = t->integer;
+		} else if (t->type == ClassAdSharedType_Float) {
+			limit = (int)t->real;
+			if (limit < t->real) limit++;
+		} else {
+			fprintf(stderr, "ERROR: invalid arguments: threshold must be a number\n");
 			return;
 		}
+		n--;
+	}
 
-		int n1, n2;
-		char *r1 = b64_decode(arguments[i].text, &n1);
-		char *r2 = b64_decode(arguments[i+1].text, &n2);
+	if (get_filter(n, arguments, 0, -1, &aslot, &a, &adata, &alen) < 0 ||
+		get_filter(n, arguments, 1, aslot, &bslot, &b, &bdata, &blen) < 0) {
+		fprintf(stderr, "ERROR: invalid argument\n");
+		goto done;
+	}
 
-		if (r1 == NULL || r2 == NULL) {
-			fprintf(stderr, "ERROR: invalid argument\n");
-			result->type = ClassAdSharedType_Error;
-			if (r1) delete[] r1;
-			if (r2) delete[] r2;
-		}
-		
-		if (n1 != n2) {
+	{
+		int an = folded_len(alen, blen);
+		int bn = folded_len(blen, alen);
+		if (an != bn) {
 			fprintf(stderr, "ERROR: bloom filters are different lengths\n");
-			result->type = ClassAdSharedType_Error;
-			delete [] r1;
-			delete [] r2;
-			return;
+			goto done;
 		}
 
-		// AND the bits together
-		for (int j=0; j<n1; j++) {
-			r1[j] = r1[j] & r2[j];
-		}
-
-		// Count the # of bits in ANDed bitstring	
-		count += popcount(r1, n1);
-
-		delete [] r1;
-		delete [] r2;
+		result->type = ClassAdSharedType_Integer;
+		result->integer = count_common(adata, alen, bdata, blen, an, limit);
 	}
-	
-	result->type = ClassAdSharedType_Integer;
-	result->integer = count;
 
+done:
+	free(a.data);
+	free(b.data);
 	return;
 }
 